@@ -0,0 +1,124 @@
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.stats import t
+
+LEVELS = (0.95, 0.99)
+WINDOW = int(os.environ.get('ANOMALY_WINDOW', 30))
+HORIZON = int(os.environ.get('ANOMALY_HORIZON', 60))
+CHUNK_SIZE = 8192
+
+COLUMNS = ['pid', 'timestamp', 'lower_bound', 'upper_bound', 'actual_value', 'predicted_value', 'is_anomaly']
+
+
+def window_sums(values, x, window):
+    # Sums over the `window` rows before every row, computed from cumulative
+    # sums so each window costs O(1) regardless of its length. Missing
+    # observations drop out through the weight matrix.
+    weight = ~np.isnan(values)
+    y = np.where(weight, values, 0.0)
+    xw = weight * x[:, None]
+
+    sums = {}
+    for name, term in (('n', weight.astype(np.float64)), ('x', xw), ('xx', xw * x[:, None]),
+                       ('y', y), ('xy', xw * y), ('yy', y * y)):
+        cumulative = np.zeros((term.shape[0] + 1, term.shape[1]))
+        np.cumsum(term, axis=0, out=cumulative[1:])
+        sums[name] = cumulative[window:-1] - cumulative[:-window - 1]
+    return sums
+
+
+def predict_chunk(values, x, window, levels):
+    # values: (window + horizon, pids); predictions for the last `horizon` rows,
+    # each from an OLS trend over the `window` rows before it.
+    s = window_sums(values, x, window)
+    x0 = x[window:, None]
+    actual = values[window:]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n = s['n']
+        x_mean = s['x'] / n
+        y_mean = s['y'] / n
+        sxx = s['xx'] - s['x'] * x_mean
+        sxy = s['xy'] - s['x'] * y_mean
+        syy = s['yy'] - s['y'] * y_mean
+
+        slope = sxy / sxx
+        predicted = y_mean + slope * (x0 - x_mean)
+        dof = n - 2
+        residual_var = np.maximum(syy - slope * sxy, 0.0) / dof
+        spread = np.sqrt(residual_var * (1.0 + 1.0 / n + (x0 - x_mean) ** 2 / sxx))
+
+    valid = dof > 0
+    dof_values, dof_inverse = np.unique(np.where(valid, dof, 1), return_inverse=True)
+
+    bounds = {}
+    for level in levels:
+        quantile = t.ppf(1 - (1 - level) / 2, dof_values)[dof_inverse].reshape(dof.shape)
+        half_width = np.where(valid, quantile * spread, np.nan)
+        lower = predicted - half_width
+        upper = predicted + half_width
+        bounds[level] = (lower, upper, (actual < lower) | (actual > upper))
+    return actual, predicted, bounds
+
+
+def detect_anomalies(matrix, dates, window=WINDOW, horizon=HORIZON, levels=LEVELS,
+                     chunk_size=CHUNK_SIZE, max_workers=None):
+    # matrix: wide (dates x pids) displacement frame. Returns one frame per
+    # confidence level with the schema of the anomaly_output*.csv files plus
+    # the date of each row, `horizon` rows per pid in date order.
+    horizon = min(horizon, len(dates) - window)
+    if horizon <= 0:
+        return {level: pd.DataFrame(columns=COLUMNS) for level in levels}
+
+    dates = pd.to_datetime(pd.Index(dates))
+    tail = slice(len(dates) - window - horizon, len(dates))
+    x = ((dates[tail] - dates[tail][0]).days.to_numpy() / 365.0).astype(np.float64)
+    values = matrix.to_numpy(dtype=np.float64)[tail]
+    pids = matrix.columns.to_numpy()
+
+    chunks = [slice(i, min(i + chunk_size, len(pids))) for i in range(0, len(pids), chunk_size)]
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        results = list(executor.map(lambda c: predict_chunk(values[:, c], x, window, levels), chunks))
+
+    def pid_major(arrays):
+        # (horizon, pids) chunks -> one flat array ordered by pid, then step.
+        return np.concatenate([a.T.ravel() for a in arrays])
+
+    actual = pid_major([r[0] for r in results])
+    predicted = pid_major([r[1] for r in results])
+    pid_column = np.repeat(pids, horizon)
+    timestamp = np.tile(dates[-horizon:].to_numpy(), len(pids))
+
+    output = {}
+    for level in levels:
+        output[level] = pd.DataFrame({
+            'pid': pid_column,
+            'timestamp': timestamp,
+            'lower_bound': pid_major([r[2][level][0] for r in results]),
+            'upper_bound': pid_major([r[2][level][1] for r in results]),
+            'actual_value': actual,
+            'predicted_value': predicted,
+            'is_anomaly': pid_major([r[2][level][2] for r in results]),
+        }, columns=COLUMNS)
+    return output
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write anomaly_output-style CSVs for a wide displacement CSV.')
+    parser.add_argument('displacement_csv')
+    parser.add_argument('output_prefix', help="e.g. 'anomaly_output2' writes anomaly_output2_95.csv and anomaly_output2_99.csv")
+    parser.add_argument('--window', type=int, default=WINDOW)
+    parser.add_argument('--horizon', type=int, default=HORIZON)
+    args = parser.parse_args()
+
+    wide = pd.read_csv(args.displacement_csv, parse_dates=['Date']).set_index('Date')
+    for level, df in detect_anomalies(wide, wide.index, args.window, args.horizon).items():
+        df.to_csv('%s_%d.csv' % (args.output_prefix, round(level * 100)), index=False)
+
+
+if __name__ == '__main__':
+    main()
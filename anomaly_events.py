@@ -0,0 +1,174 @@
+import argparse
+import os
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+
+import dataset
+import datastore
+from spatial import EARTH_RADIUS, haversine, metres_to_chord, to_unit_vectors
+
+# Anomaly set the events are found in, '95' or '99'.
+EVENT_LEVEL = os.environ.get('EVENT_LEVEL', '99')
+# Two anomalous runs are neighbours when they are this close in space and
+# onset together: within an ellipsoid of EVENT_RADIUS_METRES and
+# EVENT_WINDOW_DAYS.
+EVENT_RADIUS_METRES = float(os.environ.get('EVENT_RADIUS_METRES', 50))
+EVENT_WINDOW_DAYS = float(os.environ.get('EVENT_WINDOW_DAYS', 30))
+# Runs with at least this many neighbours (counting themselves) seed an
+# event, and events need this many distinct points; isolated flags are
+# left out as noise.
+EVENT_MIN_POINTS = int(os.environ.get('EVENT_MIN_POINTS', 5))
+EVENT_CACHE_SIZE = int(os.environ.get('EVENT_CACHE_SIZE', 4))
+
+EVENT_COLUMNS = ['event', 'latitude', 'longitude', 'radius', 'points', 'share', 'runs', 'onset', 'end',
+                 'peak_deviation', 'tracks']
+
+
+def anomaly_runs(track, level=EVENT_LEVEL):
+    # One row per run of consecutive anomalous steps of every point of
+    # `track`: pid, position, onset and end date and the deviation from the
+    # prediction furthest from zero. Only dated anomaly rows take part.
+    anomaly_index = getattr(track, 'anomaly_index_' + level)
+    frame = anomaly_index.frame
+    rows = np.flatnonzero(~np.isnat(frame['timestamp'].to_numpy()))
+    times = frame['timestamp'].to_numpy()[rows]
+    point = np.searchsorted(anomaly_index.starts, rows, side='right') - 1
+
+    flags = frame['is_anomaly'].to_numpy(dtype=bool)[rows]
+    deviation = frame['actual_value'].to_numpy(dtype=np.float64)[rows] - frame['predicted_value'].to_numpy()[rows]
+
+    # Run-length encoding as in anomaly_streaks, keeping the anomalous runs.
+    new_run = np.ones(len(rows), dtype=bool)
+    new_run[1:] = (point[1:] != point[:-1]) | (flags[1:] != flags[:-1])
+    starts = np.flatnonzero(new_run)
+    lengths = np.diff(np.append(starts, len(rows)))
+    anomalous = flags[starts] if len(starts) else np.zeros(0, dtype=bool)
+    starts, lengths = starts[anomalous], lengths[anomalous]
+
+    highest = np.maximum.reduceat(deviation, starts) if len(starts) else np.zeros(0)
+    lowest = np.minimum.reduceat(deviation, starts) if len(starts) else np.zeros(0)
+    pids = anomaly_index.keys[point[starts]]
+    located = track.point_data.set_index('pid').reindex(pids)
+    return pd.DataFrame({
+        'pid': pids,
+        'latitude': located['latitude'].to_numpy(),
+        'longitude': located['longitude'].to_numpy(),
+        'onset': times[starts],
+        'end': times[starts + lengths - 1],
+        'steps': lengths,
+        'peak_deviation': np.where(np.abs(highest) >= np.abs(lowest), highest, lowest),
+        'track': track.name,
+    }).dropna(subset=['latitude', 'longitude'])
+
+
+def cluster_runs(runs, radius=EVENT_RADIUS_METRES, window_days=EVENT_WINDOW_DAYS, min_points=EVENT_MIN_POINTS):
+    # DBSCAN over space and onset time: every run is placed on the sphere in
+    # metres plus its onset scaled so that `window_days` spans `radius`, and
+    # one KD-tree pass finds all neighbouring pairs. Core runs are joined
+    # through their pairs into connected components; other runs next to a
+    # core run join its cluster, the rest are noise (-1).
+    n = len(runs)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64)
+    onset = runs['onset'].to_numpy()
+    days = (onset - onset.min()) / np.timedelta64(1, 'D')
+    coordinates = np.column_stack([to_unit_vectors(runs['latitude'], runs['longitude']) * EARTH_RADIUS,
+                                   days * (radius / window_days)])
+    pairs = cKDTree(coordinates).query_pairs(radius, output_type='ndarray')
+
+    core = np.bincount(pairs.ravel(), minlength=n) + 1 >= min_points
+    both = core[pairs[:, 0]] & core[pairs[:, 1]]
+    graph = coo_matrix((np.ones(both.sum()), (pairs[both, 0], pairs[both, 1])), shape=(n, n))
+    _, components = connected_components(graph, directed=False)
+
+    labels = np.where(core, components, -1)
+    for a, b in ((0, 1), (1, 0)):
+        border = core[pairs[:, a]] & ~core[pairs[:, b]]
+        labels[pairs[border, b]] = components[pairs[border, a]]
+    # Numbered from 0 in order of first appearance.
+    clustered = labels >= 0
+    labels[clustered] = pd.factorize(labels[clustered])[0]
+    return labels
+
+
+def summarize_events(runs, labels, locations, min_points=EVENT_MIN_POINTS):
+    # One row per cluster: centroid, radius in metres around it, number of
+    # points and their share of all points in `locations` (lat, lon) within
+    # that radius, number of runs, first onset, last anomalous date, the
+    # deviation furthest from zero and the tracks involved. Sorted by onset.
+    runs = runs[labels >= 0].assign(label=labels[labels >= 0])
+    if runs.empty:
+        return empty_events()
+
+    grouped = runs.groupby('label', sort=False)
+    events = grouped.agg(latitude=('latitude', 'mean'), longitude=('longitude', 'mean'),
+                         points=('pid', 'nunique'), runs=('pid', 'size'),
+                         onset=('onset', 'min'), end=('end', 'max'))
+    peak = runs['peak_deviation'].abs().groupby(runs['label'], sort=False).idxmax()
+    events['peak_deviation'] = runs.loc[peak.to_numpy(), 'peak_deviation'].to_numpy()
+    events['tracks'] = grouped['track'].agg(lambda tracks: ', '.join(sorted(set(tracks))))
+
+    centre = events.loc[runs['label']]
+    distances = haversine(runs['latitude'], runs['longitude'], centre['latitude'], centre['longitude'])
+    events['radius'] = pd.Series(distances, index=runs.index).groupby(runs['label'], sort=False).max()
+    events = events[events['points'] >= min_points].sort_values('onset', kind='stable').reset_index(drop=True)
+
+    # Noise flags a scattering of the points of an area, a ground motion
+    # event most of them.
+    tree = cKDTree(to_unit_vectors(*locations))
+    around = tree.query_ball_point(to_unit_vectors(events['latitude'], events['longitude']),
+                                   metres_to_chord(np.maximum(events['radius'].to_numpy(), EVENT_RADIUS_METRES)),
+                                   return_length=True)
+    events['share'] = (events['points'] / np.maximum(around, 1)).clip(upper=1).round(2)
+    events['event'] = ['E%d' % (i + 1) for i in range(len(events))]
+    events[['latitude', 'longitude']] = events[['latitude', 'longitude']].round(6)
+    events['radius'] = events['radius'].round(1)
+    events['peak_deviation'] = events['peak_deviation'].round(2)
+    return events[EVENT_COLUMNS]
+
+
+@lru_cache(maxsize=EVENT_CACHE_SIZE)
+def track_events(tracks, level=EVENT_LEVEL):
+    # Events over the anomalous runs of all `tracks` together, so an event
+    # seen from several looks is one event.
+    if not tracks:
+        return empty_events()
+    runs = pd.concat([anomaly_runs(track, level) for track in tracks], ignore_index=True)
+    points = pd.concat([track.point_data[['latitude', 'longitude']] for track in tracks]).dropna()
+    return summarize_events(runs, cluster_runs(runs), (points['latitude'], points['longitude']))
+
+
+def empty_events():
+    return pd.DataFrame({column: [] for column in EVENT_COLUMNS})
+
+
+def events_for(store, orbits, level=EVENT_LEVEL):
+    # Events of the loaded tracks of `orbits`.
+    names = set(dataset.tracks_for_orbits(orbits))
+    return track_events(tuple(track for name, track in sorted(store.tracks.items()) if name in names), level)
+
+
+datastore.on_swap(track_events.cache_clear)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cluster anomalous points into events and write the event table.')
+    parser.add_argument('output_csv')
+    parser.add_argument('--orbit', action='append', help='orbit to include, repeatable (default: all)')
+    parser.add_argument('--level', default=EVENT_LEVEL, choices=['95', '99'])
+    args = parser.parse_args()
+
+    datastore.load()
+    orbits = args.orbit or list(dataset.ORBITS)
+    events = events_for(datastore.ensure_orbits(orbits), orbits, args.level)
+    events.to_csv(args.output_csv, index=False)
+    print('%d events written to %s' % (len(events), args.output_csv))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from point_index import key_codes
+
+# A point counts as a confirmed anomaly once it has at least this many
+# consecutive anomalous steps.
+ANOMALY_MIN_STREAK = int(os.environ.get('ANOMALY_MIN_STREAK', 4))
+
+
+def streak_summary(anomaly_data, min_streak=ANOMALY_MIN_STREAK):
+    # Run-length encodes is_anomaly per pid. Rows of one pid must be
+    # contiguous and in step order, as in a PointIndex frame.
+    pids = key_codes(anomaly_data['pid'])
+    flags = anomaly_data['is_anomaly'].eq(True).to_numpy()
+    n = len(flags)
+
+    if n == 0:
+        return pd.DataFrame({
+            'pid': np.zeros(0, dtype=object),
+            'longest_streak': np.zeros(0, dtype=np.int64),
+            'streak_count': np.zeros(0, dtype=np.int64),
+            'last_anomaly_index': np.zeros(0, dtype=np.int64),
+            'confirmed_anomaly': np.zeros(0, dtype=bool),
+        })
+
+    new_pid = np.empty(n, dtype=bool)
+    new_pid[0] = True
+    new_pid[1:] = pids[1:] != pids[:-1]
+    pid_starts = np.flatnonzero(new_pid)
+
+    new_run = new_pid.copy()
+    new_run[1:] |= flags[1:] != flags[:-1]
+    run_starts = np.flatnonzero(new_run)
+    run_lengths = np.diff(np.append(run_starts, n))
+    run_flags = flags[run_starts]
+
+    # Index of the first run of every pid, for reduceat over runs.
+    run_pid = np.cumsum(new_pid)[run_starts] - 1
+    first_run = np.searchsorted(run_pid, np.arange(len(pid_starts)))
+
+    anomalous_lengths = np.where(run_flags, run_lengths, 0)
+    longest_streak = np.maximum.reduceat(anomalous_lengths, first_run)
+    streak_count = np.add.reduceat(run_flags.astype(np.int64), first_run)
+
+    anomalous_rows = np.where(flags, np.arange(n), -1)
+    last_anomaly_row = np.maximum.reduceat(anomalous_rows, pid_starts)
+    last_anomaly_index = np.where(last_anomaly_row >= 0, last_anomaly_row - pid_starts, -1)
+
+    return pd.DataFrame({
+        'pid': anomaly_data['pid'].iloc[pid_starts].to_numpy(dtype=object),
+        'longest_streak': longest_streak,
+        'streak_count': streak_count,
+        'last_anomaly_index': last_anomaly_index,
+        'confirmed_anomaly': longest_streak >= min_streak,
+    })
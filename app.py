@@ -2,224 +2,235 @@ import pandas as pd
 import dash
 from dash import dcc
 from dash import html
-from dash.dependencies import Input, Output, State
+from dash import no_update
+from dash.dependencies import ClientsideFunction, Input, Output, State
 import plotly.express as px
-from scipy.stats import t
 import numpy as np
 import os
-from geopy.distance import geodesic
-
-def load_displacement_data(file_path, file_label):
-    df = pd.read_csv(file_path)
-    df = df.melt(id_vars=['Date'], 
-                 var_name='pid', 
-                 value_name='displacement')
-    df['timestamp'] = pd.to_datetime(df['Date'])
-    df.drop(columns=['Date'], inplace=True)
-    df['file'] = file_label
-    return df
-
-def load_anomaly_data(file_path, file_label):
-    df = pd.read_csv(file_path)
-    df['file'] = file_label
-    return df
-
-geo_data_1 = pd.read_csv('mos_1.csv')
-geo_data_2 = pd.read_csv('mos_2.csv')
-geo_data_3 = pd.read_csv('msz_1.csv')
-geo_data_4 = pd.read_csv('msz_2.csv')
-geo_data = pd.concat([geo_data_1, geo_data_2, geo_data_3, geo_data_4], ignore_index=True)
-
-displacement_data_1 = load_displacement_data('mz2_10.csv', 'Descending 175')
-displacement_data_2 = load_displacement_data('mz4_3.csv', 'Ascending 124')
-displacement_data_3 = load_displacement_data('msz4_3.csv', 'Descending 175')
-displacement_data_4 = load_displacement_data('msz2_3.csv', 'Ascending 124')
-
-all_data_1 = pd.merge(displacement_data_1, geo_data, on='pid', how='left')
-all_data_2 = pd.merge(displacement_data_2, geo_data, on='pid', how='left')
-all_data_3 = pd.merge(displacement_data_3, geo_data, on='pid', how='left')
-all_data_4 = pd.merge(displacement_data_4, geo_data, on='pid', how='left')
-
-all_data = pd.concat([all_data_1, all_data_2, all_data_3, all_data_4], ignore_index=True)
-
-
-prediction_data_1 = pd.read_csv('predictions_values.csv')
-prediction_data_1 = prediction_data_1.melt(var_name='pid', 
-                                           value_name='predicted_displacement')
-prediction_data_1['label'] = 'Prediction Set 1'
-prediction_data_1['step'] = prediction_data_1.groupby('pid').cumcount()
-
-prediction_data_2 = pd.read_csv('predictions_values2.csv') 
-prediction_data_2 = prediction_data_2.melt(var_name='pid', 
-                                           value_name='predicted_displacement')
-prediction_data_2['label'] = 'Prediction Set 2'
-prediction_data_2['step'] = prediction_data_2.groupby('pid').cumcount()
-
-prediction_data_3 = pd.read_csv('predictions_values3.csv') 
-prediction_data_3 = prediction_data_3.melt(var_name='pid', 
-                                           value_name='predicted_displacement')
-prediction_data_3['label'] = 'Prediction Set 3'
-prediction_data_3['step'] = prediction_data_3.groupby('pid').cumcount()
-
-prediction_data_4 = pd.read_csv('predictions_values4.csv') 
-prediction_data_4 = prediction_data_4.melt(var_name='pid', 
-                                           value_name='predicted_displacement')
-prediction_data_4['label'] = 'Prediction Set 4'
-prediction_data_4['step'] = prediction_data_4.groupby('pid').cumcount()
-
-all_prediction_data = pd.concat([prediction_data_1, prediction_data_2, prediction_data_3, prediction_data_4], ignore_index=True)
-
-anomaly_data_1_95 = load_anomaly_data('anomaly_output_95.csv', 'Anomaly Set 1 (95%)')
-anomaly_data_2_95 = load_anomaly_data('anomaly_output2_95.csv', 'Anomaly Set 2 (95%)')
-anomaly_data_3_95 = load_anomaly_data('anomaly_output3_95.csv', 'Anomaly Set 3 (95%)')
-anomaly_data_4_95 = load_anomaly_data('anomaly_output4_95.csv', 'Anomaly Set 4 (95%)')
-
-all_anomaly_data_95 = pd.concat([anomaly_data_1_95, anomaly_data_2_95, 
-                                 anomaly_data_3_95, anomaly_data_4_95], ignore_index=True)
-
-anomaly_data_1_99 = load_anomaly_data('anomaly_output_99.csv', 'Anomaly Set 1 (99%)')
-anomaly_data_2_99 = load_anomaly_data('anomaly_output2_99 .csv', 'Anomaly Set 2 (99%)')
-anomaly_data_3_99 = load_anomaly_data('anomaly_output3_99.csv', 'Anomaly Set 3 (99%)')
-anomaly_data_4_99 = load_anomaly_data('anomaly_output4_99.csv', 'Anomaly Set 4 (99%)')
-
-all_anomaly_data_99 = pd.concat([anomaly_data_1_99, anomaly_data_2_99, 
-                                 anomaly_data_3_99, anomaly_data_4_99], ignore_index=True)
-
-all_data.sort_values(by=['pid', 'timestamp'], inplace=True)
-all_data['displacement_diff'] = all_data.groupby('pid')['displacement'].diff()
-all_data['time_diff'] = all_data.groupby('pid')['timestamp'].diff().dt.days
-all_data['displacement_speed'] = (all_data['displacement_diff'] / all_data['time_diff']) * 365
-
-mean_velocity_data = all_data.groupby('pid')['displacement_speed'].mean().reset_index()
-mean_velocity_data.rename(columns={'displacement_speed': 'mean_velocity'}, inplace=True)
-all_data = pd.merge(all_data, mean_velocity_data, on='pid', how='left')
+from functools import lru_cache
+from downsample import downsample_indices, point_budget, window_from_relayout
+from map_lod import (MAP_DEFAULT_ZOOM, MAP_POINT_BUDGET, aggregate_cells, snap_bounds,
+                     viewport_around, viewport_from_relayout)
+import datastore
+import anomaly_events
+import dataset
+import decomposition
+import export
+import ingest
+import metrics
+import trends
+
+datastore.load()
+
+MAP_FIGURE_CACHE_SIZE = int(os.environ.get('MAP_FIGURE_CACHE_SIZE', 32))
+NEIGHBOURHOOD_LIST_SIZE = int(os.environ.get('NEIGHBOURHOOD_LIST_SIZE', 50))
 
 px.set_mapbox_access_token('pk.eyJ1IjoibWFycGllayIsImEiOiJjbTBxbXBsMGQwYjgyMmxzN3RpdmlhZDVrIn0.YWJh1RM6HKfN_pbH-jtJ6A')
 
 app = dash.Dash(__name__)
+# Before any callback is defined, so all of them are timed.
+metrics.instrument(app)
+metrics.register_routes(app.server)
+ingest.register_routes(app.server)
+export.register_routes(app.server)
 
-app.layout = html.Div([
-    html.H3("Select Map and Data Visualization Options"),
+DEFAULT_ORBIT = next(iter(dataset.ORBITS))
 
-    html.Div([
-        html.Div([
-            html.Label("Map Style"),
-            dcc.Dropdown(
-                id='map-style-dropdown',
-                options=[
-                    {'label': 'Satellite', 'value': 'satellite'},
-                    {'label': 'Outdoors', 'value': 'outdoors'},
-                    {'label': 'Light', 'value': 'light'},
-                    {'label': 'Dark', 'value': 'dark'},
-                    {'label': 'Streets', 'value': 'streets'}
-                ],
-                value='satellite', 
-                clearable=False,
-                style={'width': '100%'}
-            )
-        ], style={'display': 'inline-block', 'width': '24%', 'padding': '10px'}), 
-        
-        html.Div([
-            html.Label("Visualization Option"),
-            dcc.Dropdown(
-                id='color-mode-dropdown',
-                options=[
-                    {'label': 'Orbit Type', 'value': 'orbit'},
-                    {'label': 'Displacement Mean Velocity [mm/year]', 'value': 'speed'},
-                    {'label': 'Anomaly Type', 'value': 'anomaly_type'}
-                ],
-                value='orbit',
-                clearable=False,
-                style={'width': '100%'}
-            )
-        ], style={'display': 'inline-block', 'width': '24%', 'padding': '10px'}),
+def serve_layout():
+    # Built per page load so the date range includes ingested acquisitions.
+    # It spans every registered track, loaded or not.
+    first_date, last_date = datastore.registry_date_range()
 
-        html.Div([
-            html.Label("Filter by Orbit Type"),
-            dcc.Dropdown(
-                id='orbit-filter-dropdown',
-                options=[
-                    {'label': 'Ascending', 'value': 'Ascending 124'},
-                    {'label': 'Descending', 'value': 'Descending 175'}
-                ],
-                value='Ascending 124',
-                multi=True,
-                clearable=False,
-                style={'width': '100%'}
-            )
-        ], style={'display': 'inline-block', 'width': '24%', 'padding': '10px'}),
+    return html.Div([
+        html.H3("Select Map and Data Visualization Options"),
 
         html.Div([
-            html.Label("Enable Distance Calculation"),
-            dcc.Dropdown(
-                id='distance-calc-dropdown',
-                options=[
-                    {'label': 'Yes', 'value': 'yes'},
-                    {'label': 'No', 'value': 'no'}
-                ],
-                value='no',
-                clearable=False,
-                style={'width': '100%'}
-            )
-        ], style={'display': 'inline-block', 'width': '24%', 'padding': '10px'})
-    ], style={'width': '100%', 'display': 'flex', 'justify-content': 'space-between'}),
-    
-    html.Div(id='distance-output', style={'font-size': '16px', 'padding': '10px', 'color': 'black'}),
-
-    dcc.Graph(id='map', style={'height': '80vh', 'width': '95vw'}, config={'scrollZoom': True}),
-
-    dcc.Store(id='selected-points', data={'point_1': None, 'point_2': None}),
-
-    html.Div(id='displacement-container', children=[
-        html.Div([
-            html.Label("Select Date Range", style={'font-size': '16px'}),
-            dcc.DatePickerRange(
-                id='date-range-picker',
-                start_date=all_data['timestamp'].min(),
-                end_date=all_data['timestamp'].max(),
-                display_format='YYYY-MM-DD',
-                style={'height': '5px', 
-                'width': '300px', 
-                'font-family': 'Arial', 
-                'font-size': '4px', 
-                'display': 'inline-block',
-                'padding': '5px' }
-            )
-        ], style={'display': 'inline-block', 'padding': '10px'}),
+            html.Div([
+                html.Label("Map Style"),
+                dcc.Dropdown(
+                    id='map-style-dropdown',
+                    options=[
+                        {'label': 'Satellite', 'value': 'satellite'},
+                        {'label': 'Outdoors', 'value': 'outdoors'},
+                        {'label': 'Light', 'value': 'light'},
+                        {'label': 'Dark', 'value': 'dark'},
+                        {'label': 'Streets', 'value': 'streets'}
+                    ],
+                    value='satellite', 
+                    clearable=False,
+                    style={'width': '100%'}
+                )
+            ], style={'display': 'inline-block', 'width': '24%', 'padding': '10px'}), 
+        
+            html.Div([
+                html.Label("Visualization Option"),
+                dcc.Dropdown(
+                    id='color-mode-dropdown',
+                    options=[
+                        {'label': 'Orbit Type', 'value': 'orbit'},
+                        {'label': 'Displacement Velocity [mm/year]', 'value': 'speed'},
+                        {'label': 'Anomaly Type', 'value': 'anomaly_type'},
+                        {'label': 'Vertical Velocity [mm/year]', 'value': 'vertical'},
+                        {'label': 'East-West Velocity [mm/year]', 'value': 'east_west'}
+                    ],
+                    value='orbit',
+                    clearable=False,
+                    style={'width': '100%'}
+                )
+            ], style={'display': 'inline-block', 'width': '24%', 'padding': '10px'}),
+
+            html.Div([
+                html.Label("Filter by Orbit Type"),
+                dcc.Dropdown(
+                    id='orbit-filter-dropdown',
+                    options=[{'label': label, 'value': orbit} for orbit, label in dataset.ORBITS.items()],
+                    value=DEFAULT_ORBIT,
+                    multi=True,
+                    clearable=False,
+                    style={'width': '100%'}
+                )
+            ], style={'display': 'inline-block', 'width': '24%', 'padding': '10px'}),
+
+            html.Div([
+                html.Label("Enable Distance Calculation"),
+                dcc.Dropdown(
+                    id='distance-calc-dropdown',
+                    options=[
+                        {'label': 'Yes', 'value': 'yes'},
+                        {'label': 'No', 'value': 'no'},
+                        {'label': 'Neighbourhood', 'value': 'neighbourhood'}
+                    ],
+                    value='no',
+                    clearable=False,
+                    style={'width': '100%'}
+                )
+            ], style={'display': 'inline-block', 'width': '24%', 'padding': '10px'})
+        ], style={'width': '100%', 'display': 'flex', 'justify-content': 'space-between'}),
 
         html.Div([
-            html.Label("Set Y-Axis Range (mm)"),
+            html.Label("Neighbourhood Radius (m)", style={'margin-right': '10px'}),
             dcc.Input(
-                id='y-axis-min',
+                id='neighbourhood-radius',
                 type='number',
-                placeholder='Min',
-                style={'width': '20%', 'margin-right': '10px'}
+                value=200,
+                min=1,
+                style={'width': '100px'}
             ),
-            dcc.Input(
-                id='y-axis-max',
-                type='number',
-                placeholder='Max',
-                style={'width': '20%'}
-            ),
-        ], style={'display': 'inline-block', 'padding': '10px'}),
-
-        dcc.Graph(id='displacement-graph', style={'height': '50vh', 'width': '95vw'})
-    ], style={'display': 'none'})
-])
-@app.callback(
-    Output('map', 'figure'),
-    [Input('map-style-dropdown', 'value'),
-     Input('color-mode-dropdown', 'value'),
-     Input('orbit-filter-dropdown', 'value')]
-)
-def update_map(map_style, color_mode, orbit_filter):
-    data = all_data.drop_duplicates(subset=['pid'])
+            dcc.Checklist(
+                id='event-layer',
+                options=[{'label': 'Show anomaly events', 'value': 'events'}],
+                value=[],
+                style={'display': 'inline-block', 'margin-left': '30px'}
+            )
+        ], style={'padding': '10px'}),
+    
+        html.Div(id='distance-output', style={'font-size': '16px', 'padding': '10px', 'color': 'black'}),
+
+        dcc.Graph(id='map', style={'height': '80vh', 'width': '95vw'}, config={'scrollZoom': True}),
+
+        dcc.Store(id='selected-points', data={'point_1': None, 'point_2': None}),
+
+        dcc.Store(id='neighbourhood-request', data=None),
+
+        dcc.Store(id='map-viewport', data=None),
+
+        dcc.Store(id='displacement-graph-width', data=None),
+
+        html.Div(id='displacement-container', children=[
+            html.Div([
+                html.Label("Select Date Range", style={'font-size': '16px'}),
+                dcc.DatePickerRange(
+                    id='date-range-picker',
+                    start_date=first_date,
+                    end_date=last_date,
+                    display_format='YYYY-MM-DD',
+                    style={'height': '5px', 
+                    'width': '300px', 
+                    'font-family': 'Arial', 
+                    'font-size': '4px', 
+                    'display': 'inline-block',
+                    'padding': '5px' }
+                )
+            ], style={'display': 'inline-block', 'padding': '10px'}),
+
+            html.Div([
+                html.Label("Set Y-Axis Range (mm)"),
+                dcc.Input(
+                    id='y-axis-min',
+                    type='number',
+                    placeholder='Min',
+                    style={'width': '20%', 'margin-right': '10px'}
+                ),
+                dcc.Input(
+                    id='y-axis-max',
+                    type='number',
+                    placeholder='Max',
+                    style={'width': '20%'}
+                ),
+            ], style={'display': 'inline-block', 'padding': '10px'}),
+
+            dcc.Graph(id='displacement-graph', style={'height': '50vh', 'width': '95vw'})
+        ], style={'display': 'none'})
+    ])
+
+app.layout = serve_layout
+
+def map_view(store, orbit_filter, viewport):
+    # None while the selected orbits fit the point budget, so the whole
+    # selection is one cache entry; otherwise the zoom level and snapped
+    # bounds that the figure is built for.
+    if store.orbit_point_counts.reindex(list(orbit_filter), fill_value=0).sum() <= MAP_POINT_BUDGET:
+        return None
+
+    if viewport is None:
+        points = store.spatial_points[store.spatial_points['file'].isin(orbit_filter)]
+        zoom = MAP_DEFAULT_ZOOM
+        bounds = viewport_around(points['latitude'].mean(), points['longitude'].mean(), zoom)
+    else:
+        zoom = viewport['zoom']
+        bounds = viewport['bounds']
+
+    zoom = int(round(zoom))
+    return zoom, snap_bounds(bounds, zoom)
+
+def date_window(start_date, end_date):
+    # Whole days, so picker values that differ only in time of day share
+    # one cached fit.
+    return (pd.Timestamp(start_date).normalize() if start_date else None,
+            pd.Timestamp(end_date).normalize() if end_date else None)
+
+def with_velocity(store, points, window):
+    # Robust least-squares velocity over the picked dates, for the speed mode.
+    fit = trends.point_trends(store, points, *window)
+    return points.assign(velocity=fit['velocity'].round(1),
+                         velocity_se=fit['velocity_se'].round(2),
+                         r2=fit['r2'].round(2))
+
+def velocity_mode(color_mode):
+    # Modes coloured by a velocity fitted over the picked dates.
+    return color_mode == 'speed' or color_mode in decomposition.COMPONENTS
+
+@lru_cache(maxsize=MAP_FIGURE_CACHE_SIZE)
+def map_figure(store, color_mode, orbit_filter, view=None, window=(None, None)):
+    if color_mode in decomposition.COMPONENTS:
+        # Grid cells rather than points; a cell is drawn at its centre.
+        filtered_data = decomposition.cell_velocities(decomposition.for_store(store), *window)
+        if view is not None:
+            zoom, (south, west, north, east) = view
+            filtered_data = filtered_data[filtered_data['latitude'].between(south, north)
+                                          & filtered_data['longitude'].between(west, east)]
+    elif view is None:
+        filtered_data = store.spatial_points[store.spatial_points['file'].isin(orbit_filter)]
+    else:
+        zoom, bounds = view
+        filtered_data = store.spatial_points.iloc[store.spatial_index.in_bbox(*bounds)]
+        filtered_data = filtered_data[filtered_data['file'].isin(orbit_filter)]
 
-    if isinstance(orbit_filter, str):
-        orbit_filter = [orbit_filter]
+    if color_mode == 'speed':
+        filtered_data = with_velocity(store, filtered_data, window)
 
-    filtered_data = data[data['file'].isin(orbit_filter)]
-    filtered_data.loc[:, 'mean_velocity'] = filtered_data['mean_velocity'].round(1)
+    if view is not None and len(filtered_data) > MAP_POINT_BUDGET:
+        return cell_figure(color_mode, filtered_data, zoom)
 
     if color_mode == 'orbit':
         fig = px.scatter_mapbox(filtered_data,
@@ -238,7 +249,7 @@ def update_map(map_style, color_mode, orbit_filter):
                                     'mean_velocity': 'Mean Velocity'
                                 },
                                 color='file',
-                                zoom=14)
+                                zoom=MAP_DEFAULT_ZOOM)
 
         fig.update_layout(legend_title_text='Orbit Type')
 
@@ -251,40 +262,27 @@ def update_map(map_style, color_mode, orbit_filter):
                                     'latitude': True,
                                     'longitude': True,
                                     'height': True,
-                                    'mean_velocity': True
+                                    'velocity': True,
+                                    'velocity_se': True,
+                                    'r2': True
                                 },
-                                color='mean_velocity',
+                                color='velocity',
                                 color_continuous_scale='Jet', 
                                 range_color=(-5, 5), 
                                 labels={
                                     'latitude': 'Latitude',
                                     'longitude': 'Longitude',
                                     'height': 'Height',
-                                    'mean_velocity': 'Mean Velocity'
+                                    'velocity': 'Velocity',
+                                    'velocity_se': 'Velocity Std. Error',
+                                    'r2': 'R²'
                                 },
-                                zoom=14)
+                                zoom=MAP_DEFAULT_ZOOM)
 
-        fig.update_layout(legend_title_text='Mean Velocity [mm/year]')
+        fig.update_layout(legend_title_text='Velocity [mm/year]')
 
     elif color_mode == 'anomaly_type':
-
-        merged_data = filtered_data.merge(all_anomaly_data_99[['pid', 'is_anomaly']], on='pid', how='left')
-
-        merged_data['is_anomaly'] = merged_data['is_anomaly'].fillna(False)
-        merged_data['is_anomaly'] = merged_data['is_anomaly'].infer_objects().astype(bool)
-
-        merged_data['anomaly_group'] = (
-            (merged_data['is_anomaly'] != merged_data['is_anomaly'].shift()) 
-            | (merged_data['pid'] != merged_data['pid'].shift())
-        ).cumsum()
-
-        merged_data['anomaly_streak_count'] = merged_data.groupby(['pid', 'anomaly_group'])['is_anomaly'].transform('sum')
-
-        merged_data['true_anomaly'] = merged_data.apply(
-            lambda row: True if row['anomaly_streak_count'] > 3 and row['is_anomaly'] else False, axis=1
-        )
-
-        fig = px.scatter_mapbox(merged_data,
+        fig = px.scatter_mapbox(filtered_data,
                                 lat='latitude', lon='longitude',
                                 hover_name='pid',
                                 hover_data={
@@ -299,106 +297,323 @@ def update_map(map_style, color_mode, orbit_filter):
                                     'height': 'Height',
                                     'mean_velocity': 'Mean Velocity'
                                 },
-                                color=merged_data['true_anomaly'].map({True: 'Anomaly', False: 'No Anomaly'}),
+                                color=filtered_data['true_anomaly'].map({True: 'Anomaly', False: 'No Anomaly'}),
                                 color_discrete_map={'Anomaly': 'red', 'No Anomaly': 'green'},
-                                zoom=14)
+                                zoom=MAP_DEFAULT_ZOOM)
+
+        fig.update_layout(legend_title_text='Anomaly Type')
+
+    elif color_mode in decomposition.COMPONENTS:
+        fig = px.scatter_mapbox(filtered_data,
+                                lat='latitude', lon='longitude',
+                                hover_name='cell',
+                                hover_data={
+                                    'latitude': True,
+                                    'longitude': True,
+                                    'points': True,
+                                    'vertical': True,
+                                    'vertical_se': True,
+                                    'east_west': True,
+                                    'east_west_se': True
+                                },
+                                color=color_mode,
+                                color_continuous_scale='Jet',
+                                range_color=(-5, 5),
+                                labels={
+                                    'latitude': 'Latitude',
+                                    'longitude': 'Longitude',
+                                    'points': 'Points',
+                                    'vertical': 'Vertical Velocity',
+                                    'vertical_se': 'Vertical Std. Error',
+                                    'east_west': 'East-West Velocity',
+                                    'east_west_se': 'East-West Std. Error'
+                                },
+                                zoom=MAP_DEFAULT_ZOOM)
+
+        fig.update_layout(legend_title_text='%s Velocity [mm/year]' % decomposition.COMPONENTS[color_mode])
 
-        fig.update_layout(
-            legend_title_text='Anomaly Type',
-            mapbox_style=map_style,
-            autosize=True,
-            margin=dict(l=0, r=0, t=0, b=0)
-        )
-        
     fig.update_layout(
-        mapbox_style=map_style,
         autosize=True,
         margin=dict(l=0, r=0, t=0, b=0))
-        
-    return fig
+
+    return fig.to_dict()
+
+datastore.on_swap(map_figure.cache_clear)
+
+def cell_figure(color_mode, points, zoom):
+    # Zoomed out past the point budget: one marker per occupied grid cell,
+    # sized by the number of points in it. Cells carry no hover_name, so
+    # clicking them does not select a point.
+    if color_mode in decomposition.COMPONENTS:
+        velocity = color_mode
+    elif color_mode == 'speed':
+        velocity = 'velocity'
+    else:
+        velocity = 'mean_velocity'
+    cells = aggregate_cells(points, zoom, by='file' if color_mode == 'orbit' else None, velocity=velocity)
+
+    hover_data = {
+        'latitude': False,
+        'longitude': False,
+        'count': True,
+        'mean_velocity': True,
+        # Decomposed cells carry no anomaly flags.
+        'anomaly_share': color_mode not in decomposition.COMPONENTS
+    }
+    labels = {
+        'count': 'Points',
+        'mean_velocity': 'Mean Velocity',
+        'anomaly_share': 'Anomaly Share'
+    }
+
+    if color_mode == 'orbit':
+        fig = px.scatter_mapbox(cells, lat='latitude', lon='longitude',
+                                size='count', color='file',
+                                hover_data=hover_data, labels=labels)
+        fig.update_layout(legend_title_text='Orbit Type')
+
+    elif velocity_mode(color_mode):
+        fig = px.scatter_mapbox(cells, lat='latitude', lon='longitude',
+                                size='count', color='mean_velocity',
+                                color_continuous_scale='Jet',
+                                range_color=(-5, 5),
+                                hover_data=hover_data, labels=labels)
+        if color_mode in decomposition.COMPONENTS:
+            fig.update_layout(legend_title_text='Mean %s Velocity [mm/year]' % decomposition.COMPONENTS[color_mode])
+        else:
+            fig.update_layout(legend_title_text='Mean Velocity [mm/year]')
+
+    elif color_mode == 'anomaly_type':
+        fig = px.scatter_mapbox(cells, lat='latitude', lon='longitude',
+                                size='count', color='anomaly_share',
+                                color_continuous_scale=['green', 'red'],
+                                range_color=(0, 1),
+                                hover_data=hover_data, labels=labels)
+        fig.update_layout(legend_title_text='Anomaly Share')
+
+    fig.update_layout(
+        autosize=True,
+        mapbox=dict(center=dict(lat=points['latitude'].mean(), lon=points['longitude'].mean()), zoom=zoom),
+        margin=dict(l=0, r=0, t=0, b=0))
+
+    return fig.to_dict()
+
+def selected_orbits(orbit_filter):
+    if isinstance(orbit_filter, str):
+        orbit_filter = [orbit_filter]
+    return tuple(sorted(orbit_filter))
+
+@app.callback(
+    Output('map-viewport', 'data'),
+    [Input('map', 'relayoutData')]
+)
+def update_map_viewport(relayout_data):
+    viewport = viewport_from_relayout(relayout_data)
+    if viewport is None:
+        return no_update
+    return viewport
 
 @app.callback(
+    Output('map', 'figure'),
+    [Input('color-mode-dropdown', 'value'),
+     Input('orbit-filter-dropdown', 'value'),
+     Input('map-viewport', 'data'),
+     Input('date-range-picker', 'start_date'),
+     Input('date-range-picker', 'end_date'),
+     Input('event-layer', 'value')],
+    [State('map-style-dropdown', 'value')]
+)
+def update_map(color_mode, orbit_filter, viewport, start_date, end_date, event_layer, map_style):
+    orbit_filter = selected_orbits(orbit_filter)
+    # The decomposition combines every look, whatever the orbit filter.
+    orbits = selected_orbits(decomposition.ORBITS) if color_mode in decomposition.COMPONENTS else orbit_filter
+    # Tracks of a newly selected orbit are read here, the first time.
+    store = datastore.ensure_orbits(orbits)
+
+    # Only the velocity modes depend on the dates; the others keep one entry.
+    window = date_window(start_date, end_date) if velocity_mode(color_mode) else (None, None)
+    # Cached figures are shared between requests, so only copy the parts
+    # that get changed here.
+    fig = map_figure(store, color_mode, orbits, map_view(store, orbits, viewport), window)
+    data = fig['data']
+    if event_layer and 'events' in event_layer:
+        data = data + [event_trace(store, orbits, *date_window(start_date, end_date))]
+    metrics.add_rows(sum(len(trace.get('lat', ())) for trace in data))
+    layout = dict(fig['layout'])
+    layout['mapbox'] = dict(layout.get('mapbox', {}), style=map_style)
+    # Keeps the user's pan and zoom across viewport-driven redraws; a new
+    # orbit selection re-centres the map.
+    layout['uirevision'] = '|'.join(orbit_filter)
+
+    return {'data': data, 'layout': layout}
+
+def event_trace(store, orbits, start_date, end_date):
+    # Anomaly events active during the picked dates, drawn over the points
+    # and sized by how many points they cover. The markers carry no
+    # hovertext, so clicking one selects nothing.
+    events = anomaly_events.events_for(store, orbits)
+    if start_date is not None:
+        events = events[events['end'] >= start_date]
+    if end_date is not None:
+        events = events[events['onset'] <= end_date]
+
+    text = [f"{row.event}: {row.points} points ({row.share:.0%}) within {row.radius:.0f} m<br>"
+            f"Onset {row.onset:%Y-%m-%d}, last {row.end:%Y-%m-%d}<br>"
+            f"Peak deviation {row.peak_deviation:.1f} mm ({row.tracks})"
+            for row in events.itertuples()]
+    return {
+        'type': 'scattermapbox',
+        'name': 'Anomaly events',
+        'lat': events['latitude'].tolist(),
+        'lon': events['longitude'].tolist(),
+        'mode': 'markers',
+        'marker': {'size': np.clip(8 + 2 * np.sqrt(events['points'].to_numpy()), 10, 40).tolist(),
+                   'color': 'red', 'opacity': 0.4},
+        'text': text,
+        'hoverinfo': 'text',
+        'showlegend': True
+    }
+
+# UI-only interactions run in the browser (assets/clientside.js): they
+# change nothing the server has, so they need no round trip.
+app.clientside_callback(
+    ClientsideFunction(namespace='clientside', function_name='mapStyle'),
+    Output('map', 'figure', allow_duplicate=True),
+    [Input('map-style-dropdown', 'value')],
+    [State('map', 'figure')],
+    prevent_initial_call=True
+)
+
+app.clientside_callback(
+    ClientsideFunction(namespace='clientside', function_name='selectPoint'),
     Output('selected-points', 'data'),
     [Input('map', 'clickData')],
     [State('selected-points', 'data')]
 )
-def update_selected_points(clickData, selected_points):
-    if clickData is None:
-        return selected_points
-    
-    point_id = clickData['points'][0]['hovertext']
-    lat = clickData['points'][0]['lat']
-    lon = clickData['points'][0]['lon']
-    
-    if selected_points['point_1'] is None:
-        selected_points['point_1'] = {'pid': point_id, 'lat': lat, 'lon': lon}
-    elif selected_points['point_2'] is None:
-        selected_points['point_2'] = {'pid': point_id, 'lat': lat, 'lon': lon}
-    else:
-        selected_points = {'point_1': None, 'point_2': None}
 
-    return selected_points
+# The two-point distance is worked out in the browser; only the
+# neighbourhood list, which needs the points table, goes to the server.
+app.clientside_callback(
+    ClientsideFunction(namespace='clientside', function_name='distance'),
+    [Output('distance-output', 'children'), Output('neighbourhood-request', 'data')],
+    [Input('selected-points', 'data'),
+     Input('distance-calc-dropdown', 'value'),
+     Input('neighbourhood-radius', 'value')]
+)
 
 @app.callback(
-    Output('distance-output', 'children'),
-    [Input('selected-points', 'data'),
-     Input('distance-calc-dropdown', 'value')]
+    Output('distance-output', 'children', allow_duplicate=True),
+    [Input('neighbourhood-request', 'data')],
+    [State('distance-calc-dropdown', 'value'),
+     State('orbit-filter-dropdown', 'value')],
+    prevent_initial_call=True
+)
+def update_neighbourhood(request, distance_calc_enabled, orbit_filter):
+    # The mode may have changed while the request was on its way.
+    if request is None or distance_calc_enabled != 'neighbourhood':
+        return no_update
+    return display_neighbourhood(request, request['radius'], orbit_filter)
+
+def display_neighbourhood(point, radius, orbit_filter):
+    # Another worker may have drawn the map, so make sure the shown tracks
+    # are loaded here too. Other tracks this worker has loaded are left
+    # out, as on the map.
+    orbit_filter = selected_orbits(orbit_filter)
+    store = datastore.ensure_orbits(orbit_filter)
+    indices, distances = store.spatial_index.within(point['lat'], point['lon'], radius)
+    neighbours = store.spatial_points.iloc[indices].assign(distance=distances)
+    neighbours = neighbours[(neighbours['pid'] != point['pid']) & neighbours['file'].isin(orbit_filter)]
+    metrics.add_rows(len(neighbours))
+
+    if neighbours.empty:
+        return f"No other points within {radius} m of {point['pid']}."
+
+    items = [html.Li(f"Points: {len(neighbours)}, Mean Velocity: {neighbours['mean_velocity'].mean():.1f} mm/year")]
+    items += [
+        html.Li(f"{row.pid} ({row.file}): {row.distance:.0f} m, Mean Velocity: {row.mean_velocity} mm/year")
+        for row in neighbours.head(NEIGHBOURHOOD_LIST_SIZE).itertuples()
+    ]
+
+    return html.Div([
+        html.H4(f"Neighbourhood of {point['pid']} within {radius} m"),
+        html.Ul(items, style={'list-style-type': 'none', 'padding': '0', 'margin': '0'})
+    ], style={'padding': '10px', 'border': '1px solid #ddd', 'border-radius': '5px'})
+
+app.clientside_callback(
+    ClientsideFunction(namespace='clientside', function_name='graphWidth'),
+    Output('displacement-graph-width', 'data'),
+    [Input('map', 'clickData')]
 )
-def display_distance(selected_points, distance_calc_enabled):
-    if distance_calc_enabled == 'no':
-        return ""
 
-    point_1 = selected_points['point_1']
-    point_2 = selected_points['point_2']
-    
-    if point_1 is not None and point_2 is not None:
-        coords_1 = (point_1['lat'], point_1['lon'])
-        coords_2 = (point_2['lat'], point_2['lon'])
+app.clientside_callback(
+    ClientsideFunction(namespace='clientside', function_name='yAxisRange'),
+    Output('displacement-graph', 'figure', allow_duplicate=True),
+    [Input('y-axis-min', 'value'),
+     Input('y-axis-max', 'value')],
+    [State('displacement-graph', 'figure')],
+    prevent_initial_call=True
+)
 
-        distance_km = geodesic(coords_1, coords_2).kilometers
-        
-        return html.Div([
-            html.H4("Selected Points and Distance"),
-            html.Ul([
-                html.Li(f"Point 1: {point_1['pid']} (Lat: {point_1['lat']}, Lon: {point_1['lon']})"),
-                html.Li(f"Point 2: {point_2['pid']} (Lat: {point_2['lat']}, Lon: {point_2['lon']})"),
-                html.Li(f"Distance: {distance_km:.2f} km")
-            ], style={'list-style-type': 'none', 'padding': '0', 'margin': '0'})
-        ], style={'padding': '10px', 'border': '1px solid #ddd', 'border-radius': '5px'})
-    else:
-        return "Select two points on the map to calculate the distance."
+def dated_anomalies(anomaly_index, point_id):
+    # The point's anomaly rows that have a date, indexed by it.
+    rows = anomaly_index.lookup(point_id)
+    return rows[rows['timestamp'].notna()].set_index('timestamp')
 
 @app.callback(
     [Output('displacement-graph', 'figure'), Output('displacement-container', 'style')],
     [Input('map', 'clickData'),
      Input('date-range-picker', 'start_date'),
      Input('date-range-picker', 'end_date'),
-     Input('y-axis-min', 'value'),
-     Input('y-axis-max', 'value')]
+     Input('displacement-graph-width', 'data'),
+     Input('displacement-graph', 'relayoutData')],
+    # The y-axis inputs only restyle the drawn figure in the browser; a
+    # redraw picks up their values from here.
+    [State('y-axis-min', 'value'),
+     State('y-axis-max', 'value'),
+     State('orbit-filter-dropdown', 'value')]
 )
-def display_displacement(clickData, start_date, end_date, y_min, y_max):
-    if clickData is None:
+def display_displacement(clickData, start_date, end_date, graph_width, relayout_data, y_min, y_max, orbit_filter):
+    if clickData is None or 'hovertext' not in clickData['points'][0]:
         return {}, {'display': 'none'}
 
+    # A zoom into the graph redraws the zoomed window at full resolution; a
+    # new point or date range starts from the whole range again.
+    triggered = dash.callback_context.triggered_id
+    window = None
+    if triggered not in ('map', 'date-range-picker'):
+        window = window_from_relayout(relayout_data)
+    if triggered == 'displacement-graph' and window is None and not relayout_data.get('xaxis.autorange'):
+        return no_update, no_update
+
     point_id = clickData['points'][0]['hovertext']
     start_date = pd.to_datetime(start_date)
     end_date = pd.to_datetime(end_date)
+    if decomposition.parse_cell(point_id) is not None:
+        store = datastore.ensure_orbits(decomposition.ORBITS)
+        return display_cell_displacement(decomposition.for_store(store), point_id, start_date, end_date,
+                                         y_min, y_max, window)
 
-    full_data = all_data[(all_data['pid'] == point_id)].copy()
-    filtered_data = full_data[(full_data['timestamp'] >= start_date) & (full_data['timestamp'] <= end_date)]
+    track = datastore.ensure_orbits(selected_orbits(orbit_filter)).track_of(point_id)
+    if track is None:
+        return {}, {'display': 'none'}
 
-    last_n_data = full_data.tail(60)
-    
-    filtered_anomalies_95 = all_anomaly_data_95[(all_anomaly_data_95['pid'] == point_id)]
-    filtered_anomalies_99 = all_anomaly_data_99[(all_anomaly_data_99['pid'] == point_id)]
+    full_data = track.all_data_index.lookup(point_id)
+    filtered_data = track.all_data_index.between(point_id, start_date, end_date)
 
-    if not filtered_anomalies_95.empty:
-        if len(filtered_anomalies_95) > len(last_n_data):
-            filtered_anomalies_95 = filtered_anomalies_95.tail(len(last_n_data))
+    # Anomaly rows carry the date they were computed for; undated ones are
+    # not shown. Dates ingested since have no prediction yet.
+    filtered_anomalies_95 = dated_anomalies(track.anomaly_index_95, point_id)
+    filtered_anomalies_99 = dated_anomalies(track.anomaly_index_99, point_id)
+    metrics.add_rows(len(full_data) + len(filtered_anomalies_95) + len(filtered_anomalies_99))
 
-        filtered_anomalies_95['timestamp'] = last_n_data['timestamp'].values[:len(filtered_anomalies_95)]
-        filtered_anomalies_95.set_index('timestamp', inplace=True)
+    first_dated = min([frame.index[0] for frame in (filtered_anomalies_95, filtered_anomalies_99) if not frame.empty],
+                      default=None)
+    if first_dated is not None:
+        last_n_data = full_data[full_data['timestamp'] >= first_dated].copy()
+    else:
+        last_n_data = full_data.tail(dataset.ANOMALY_TAIL_ROWS).copy()
 
+    if not filtered_anomalies_95.empty:
         last_n_data.set_index('timestamp', inplace=True)
 
         last_n_data = last_n_data.join(
@@ -407,26 +622,37 @@ def display_displacement(clickData, start_date, end_date, y_min, y_max):
         )
 
     if not filtered_anomalies_99.empty:
-        if len(filtered_anomalies_99) > len(last_n_data):
-            filtered_anomalies_99 = filtered_anomalies_99.tail(len(last_n_data))
-
-        filtered_anomalies_99['timestamp'] = last_n_data.index.values[:len(filtered_anomalies_99)]
-        filtered_anomalies_99.set_index('timestamp', inplace=True)
+        if 'timestamp' in last_n_data.columns:
+            last_n_data.set_index('timestamp', inplace=True)
 
         last_n_data = last_n_data.join(
             filtered_anomalies_99[['upper_bound', 'lower_bound', 'is_anomaly']], 
             how='left', rsuffix='_99'
         )
 
+    anomaly_times = []
+    for column in ('is_anomaly', 'is_anomaly_99'):
+        if column in last_n_data.columns:
+            anomaly_times.extend(last_n_data.index[last_n_data[column] == 1])
+
+    if window is not None:
+        # One observation either side, so the line runs to the edges.
+        times = filtered_data['timestamp'].to_numpy()
+        lo = max(np.searchsorted(times, np.datetime64(window[0])) - 1, 0)
+        hi = np.searchsorted(times, np.datetime64(window[1]), side='right') + 1
+        filtered_data = filtered_data.iloc[lo:hi]
+
+    rows = downsample_indices(filtered_data['timestamp'], filtered_data['displacement'],
+                              point_budget(graph_width),
+                              keep=np.flatnonzero(filtered_data['timestamp'].isin(anomaly_times)))
+    filtered_data = filtered_data.iloc[rows]
+
     fig = px.line(filtered_data, x='timestamp', y='displacement', 
                   title=f"Displacement LOS for point {point_id}",
                   markers=True, 
                   labels={'displacement': 'Displacement[mm]'})
-
-    fig.add_scatter(x=filtered_data['timestamp'], y=filtered_data['displacement'], 
-                    mode='lines+markers', 
-                    name='InSAR measured displacement', 
-                    line=dict(color='blue'))
+    fig.update_traces(name='InSAR measured displacement', showlegend=True,
+                      line=dict(color='blue'), hovertemplate=None)
 
     if not last_n_data.empty and not last_n_data[(last_n_data.index >= start_date) & (last_n_data.index <= end_date)].empty:
         fig.add_scatter(x=last_n_data.index, y=last_n_data['predicted_value'], 
@@ -481,6 +707,9 @@ def display_displacement(clickData, start_date, end_date, y_min, y_max):
     if y_min is not None and y_max is not None:
         fig.update_yaxes(range=[y_min, y_max])
 
+    if window is not None:
+        fig.update_xaxes(range=list(window))
+
     fig.update_layout(
         xaxis_title='Date', 
         yaxis_title='Displacement LOS[mm]', 
@@ -490,6 +719,42 @@ def display_displacement(clickData, start_date, end_date, y_min, y_max):
 
     return fig, {'display': 'block'}
 
+def display_cell_displacement(cells, cell, start_date, end_date, y_min, y_max, window):
+    # Both decomposed components of a clicked grid cell, on the common axis.
+    series = cells.series(cell)
+    if series is None:
+        return {}, {'display': 'none'}
+    series = series[(series['timestamp'] >= start_date) & (series['timestamp'] <= end_date)]
+    metrics.add_rows(len(series))
+
+    fig = px.line(series, x='timestamp', y='vertical',
+                  title=f"Vertical and east-west displacement for {cell}",
+                  markers=True)
+    fig.update_traces(name='Vertical (up)', showlegend=True, line=dict(color='blue'))
+    fig.add_scatter(x=series['timestamp'], y=series['east_west'],
+                    mode='lines+markers',
+                    name='East-West (east)',
+                    line=dict(color='green'))
+
+    if y_min is not None and y_max is not None:
+        fig.update_yaxes(range=[y_min, y_max])
+
+    if window is not None:
+        fig.update_xaxes(range=list(window))
+
+    fig.update_layout(
+        xaxis_title='Date',
+        yaxis_title='Displacement [mm]',
+        legend_title="Legend",
+        legend=dict(yanchor="top", y=1, xanchor="left", x=1.05)
+    )
+
+    return fig, {'display': 'block'}
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        # Only in the reloader's child process, which serves the requests.
+        datastore.start_refresher()
+        ingest.start_watcher()
     app.run(host="0.0.0.0", port=port, debug=True)
@@ -0,0 +1,153 @@
+// Callbacks that only rearrange what the browser already has. They run
+// without a round trip, so they stay instant while the server is busy.
+(function() {
+    var noUpdate = function() { return window.dash_clientside.no_update; };
+
+    // WGS84 ellipsoid.
+    var A = 6378137.0;
+    var F = 1 / 298.257223563;
+    var B = A * (1 - F);
+
+    function radians(degrees) {
+        return degrees * Math.PI / 180;
+    }
+
+    // Inverse Vincenty in metres. Nearly antipodal pairs, where it does not
+    // converge, fall back to the great-circle distance.
+    function vincenty(lat1, lon1, lat2, lon2) {
+        var u1 = Math.atan((1 - F) * Math.tan(radians(lat1)));
+        var u2 = Math.atan((1 - F) * Math.tan(radians(lat2)));
+        var sinU1 = Math.sin(u1), cosU1 = Math.cos(u1);
+        var sinU2 = Math.sin(u2), cosU2 = Math.cos(u2);
+        var l = radians(lon2 - lon1);
+        var lambda = l;
+        var sinSigma, cosSigma, sigma, cos2Alpha, cos2SigmaM;
+        for (var i = 0; i < 200; i++) {
+            var sinLambda = Math.sin(lambda), cosLambda = Math.cos(lambda);
+            sinSigma = Math.hypot(cosU2 * sinLambda, cosU1 * sinU2 - sinU1 * cosU2 * cosLambda);
+            if (sinSigma === 0) {
+                return 0;
+            }
+            cosSigma = sinU1 * sinU2 + cosU1 * cosU2 * cosLambda;
+            sigma = Math.atan2(sinSigma, cosSigma);
+            var sinAlpha = cosU1 * cosU2 * sinLambda / sinSigma;
+            cos2Alpha = 1 - sinAlpha * sinAlpha;
+            cos2SigmaM = cos2Alpha === 0 ? 0 : cosSigma - 2 * sinU1 * sinU2 / cos2Alpha;
+            var c = F / 16 * cos2Alpha * (4 + F * (4 - 3 * cos2Alpha));
+            var previous = lambda;
+            lambda = l + (1 - c) * F * sinAlpha * (
+                sigma + c * sinSigma * (cos2SigmaM + c * cosSigma * (-1 + 2 * cos2SigmaM * cos2SigmaM)));
+            if (Math.abs(lambda - previous) < 1e-12) {
+                var uSq = cos2Alpha * (A * A - B * B) / (B * B);
+                var a = 1 + uSq / 16384 * (4096 + uSq * (-768 + uSq * (320 - 175 * uSq)));
+                var b = uSq / 1024 * (256 + uSq * (-128 + uSq * (74 - 47 * uSq)));
+                var deltaSigma = b * sinSigma * (cos2SigmaM + b / 4 * (
+                    cosSigma * (-1 + 2 * cos2SigmaM * cos2SigmaM)
+                    - b / 6 * cos2SigmaM * (-3 + 4 * sinSigma * sinSigma) * (-3 + 4 * cos2SigmaM * cos2SigmaM)));
+                return B * a * (sigma - deltaSigma);
+            }
+        }
+        var h = Math.pow(Math.sin(radians(lat2 - lat1) / 2), 2)
+            + Math.cos(radians(lat1)) * Math.cos(radians(lat2)) * Math.pow(Math.sin(radians(lon2 - lon1) / 2), 2);
+        return 2 * 6371008.8 * Math.asin(Math.sqrt(Math.min(h, 1)));
+    }
+
+    function component(type, props) {
+        return {namespace: 'dash_html_components', type: type, props: props};
+    }
+
+    function pointText(label, point) {
+        return label + ': ' + point.pid + ' (Lat: ' + point.lat + ', Lon: ' + point.lon + ')';
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        clientside: {
+            // The first click picks point 1, the second point 2 and the
+            // third clears both.
+            selectPoint: function(clickData, selected) {
+                if (!clickData || !('hovertext' in clickData.points[0])) {
+                    return noUpdate();
+                }
+                var clicked = clickData.points[0];
+                var point = {pid: clicked.hovertext, lat: clicked.lat, lon: clicked.lon};
+                if (selected.point_1 === null) {
+                    return {point_1: point, point_2: null};
+                }
+                if (selected.point_2 === null) {
+                    return {point_1: selected.point_1, point_2: point};
+                }
+                return {point_1: null, point_2: null};
+            },
+
+            // Distance between the selected points, worked out here; the
+            // neighbourhood list needs the points table, so that mode hands
+            // its point and radius to the server through neighbourhood-request.
+            distance: function(selected, mode, radius) {
+                if (mode === 'no') {
+                    return ['', noUpdate()];
+                }
+
+                if (mode === 'neighbourhood') {
+                    var point = selected.point_2 || selected.point_1;
+                    if (point === null || !radius) {
+                        return ['Select a point on the map to list its neighbourhood.', noUpdate()];
+                    }
+                    return [noUpdate(), {pid: point.pid, lat: point.lat, lon: point.lon, radius: radius}];
+                }
+
+                var point1 = selected.point_1, point2 = selected.point_2;
+                if (point1 === null || point2 === null) {
+                    return ['Select two points on the map to calculate the distance.', noUpdate()];
+                }
+                var km = vincenty(point1.lat, point1.lon, point2.lat, point2.lon) / 1000;
+                return [component('Div', {
+                    children: [
+                        component('H4', {children: 'Selected Points and Distance'}),
+                        component('Ul', {
+                            children: [
+                                component('Li', {children: pointText('Point 1', point1)}),
+                                component('Li', {children: pointText('Point 2', point2)}),
+                                component('Li', {children: 'Distance: ' + km.toFixed(2) + ' km'})
+                            ],
+                            style: {'list-style-type': 'none', 'padding': '0', 'margin': '0'}
+                        })
+                    ],
+                    style: {'padding': '10px', 'border': '1px solid #ddd', 'border-radius': '5px'}
+                }), noUpdate()];
+            },
+
+            // Sets the y-axis of the figure already drawn; both bounds or
+            // neither, as display_displacement does.
+            yAxisRange: function(yMin, yMax, figure) {
+                if (!figure || !figure.layout) {
+                    return noUpdate();
+                }
+                var yaxis = Object.assign({}, figure.layout.yaxis);
+                if (yMin !== null && yMin !== undefined && yMax !== null && yMax !== undefined) {
+                    yaxis.range = [yMin, yMax];
+                    yaxis.autorange = false;
+                } else {
+                    delete yaxis.range;
+                    yaxis.autorange = true;
+                }
+                return Object.assign({}, figure, {layout: Object.assign({}, figure.layout, {yaxis: yaxis})});
+            },
+
+            mapStyle: function(style, figure) {
+                if (!figure || !figure.layout) {
+                    return noUpdate();
+                }
+                var mapbox = Object.assign({}, figure.layout.mapbox, {style: style});
+                return Object.assign({}, figure, {layout: Object.assign({}, figure.layout, {mapbox: mapbox})});
+            },
+
+            // Width in pixels the displacement graph is drawn at. The graph
+            // is hidden until a point is clicked, so fall back to its 95vw
+            // share of the window.
+            graphWidth: function(clickData) {
+                var graph = document.getElementById('displacement-graph');
+                return (graph && graph.clientWidth) || Math.round(window.innerWidth * 0.95);
+            }
+        }
+    });
+})();
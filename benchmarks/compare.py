@@ -0,0 +1,67 @@
+import argparse
+import json
+import sys
+
+# Compares two harness.py result files size by size and exits with 1 when
+# any measurement got worse by more than the threshold, so it can gate CI.
+THRESHOLD = 0.10
+
+
+def measurements(result, stat='median_ms'):
+    values = {
+        'cold start [s]': result['cold']['startup_seconds'],
+        'warm start [s]': result['warm']['startup_seconds'],
+        'peak RSS [MB]': result['warm']['peak_rss_bytes'] / 2 ** 20,
+        'cold peak RSS [MB]': result['cold']['peak_rss_bytes'] / 2 ** 20,
+    }
+    for name, timing in result['warm'].get('callbacks', {}).items():
+        values['%s %s' % (name, stat)] = timing[stat]
+        values['%s response [kB]' % name] = timing['response_bytes'] / 1000
+    return values
+
+
+def size_key(result):
+    return '%(points)dx%(dates)d-t%(tracks)d-s%(seed)d' % result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files.')
+    parser.add_argument('base')
+    parser.add_argument('head')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='relative increase counted as a regression (default %.2f)' % THRESHOLD)
+    parser.add_argument('--stat', default='median_ms', choices=['min_ms', 'median_ms', 'p95_ms', 'mean_ms'],
+                        help='callback latency to compare; min_ms is the least noisy on a busy machine')
+    args = parser.parse_args()
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.head) as f:
+        head = json.load(f)
+
+    base_results = {size_key(result): result for result in base['results']}
+    regressions = 0
+    print('%s -> %s' % (base['commit'], head['commit']))
+    for result in head['results']:
+        key = size_key(result)
+        if key not in base_results:
+            print('\n%s: not in %s' % (key, args.base))
+            continue
+        print('\n%s' % key)
+        before = measurements(base_results[key], args.stat)
+        for name, value in measurements(result, args.stat).items():
+            if name not in before:
+                print('  %-44s %12s %12.3f' % (name, '-', value))
+                continue
+            change = (value - before[name]) / before[name] if before[name] else 0.0
+            flag = ''
+            if change > args.threshold:
+                flag = '  REGRESSION'
+                regressions += 1
+            print('  %-44s %12.3f %12.3f %+8.1f%%%s' % (name, before[name], value, change * 100, flag))
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
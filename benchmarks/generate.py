@@ -0,0 +1,142 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from anomaly_detection import HORIZON, LEVELS, WINDOW, predict_chunk
+from synthetic import BLOCK_POINTS, GEOMETRY, ORBITS, synthetic_dates, synthetic_displacement, synthetic_points
+
+# Writes a dataset in the layout of the bundled one: per track a geo table,
+# a wide Date x pid displacement CSV, wide predictions and the two anomaly
+# outputs, plus a tracks.json registry to point DATASET_TRACKS at. Every
+# file is written a date or a block of points at a time, so sizes up to
+# millions of points fit in memory.
+
+
+def csv_line(values):
+    # Shortest round-trip text of every float32, joined in Arrow rather than
+    # one Python string per value.
+    text = pa.array(values.astype(np.float32), from_pandas=True).cast(pa.string()).fill_null('')
+    joined = pc.binary_join(pa.ListArray.from_arrays(pa.array([0, len(text)], pa.int32()), text), ',')
+    return joined[0].as_py()
+
+
+def write_displacement(path, points, dates, seed):
+    n_blocks = -(-len(points) // BLOCK_POINTS)
+    with open(path, 'w') as f:
+        f.write('Date,' + ','.join(points['pid']) + '\n')
+        for row, date in enumerate(dates):
+            values = np.concatenate([synthetic_displacement(points, dates, [row], block, seed)[0]
+                                     for block in range(n_blocks)])
+            f.write(date.strftime('%Y-%m-%d') + ',' + csv_line(values.round(2)) + '\n')
+
+
+def write_anomalies(paths, predictions_path, points, dates, seed):
+    # Runs the app's own detector (anomaly_detection.predict_chunk) over the
+    # tail of every block of points.
+    horizon = min(HORIZON, len(dates) - WINDOW)
+    if horizon <= 0:
+        raise ValueError('Need more than %d dates for anomaly outputs' % WINDOW)
+    rows = np.arange(len(dates) - WINDOW - horizon, len(dates))
+    x = (dates[rows] - dates[rows][0]).days.to_numpy() / 365.0
+    predictions = np.empty((horizon, len(points)), dtype=np.float32)
+
+    files, writers = {}, {}
+    try:
+        for block in range(-(-len(points) // BLOCK_POINTS)):
+            values = synthetic_displacement(points, dates, rows, block, seed).round(2)
+            actual, predicted, bounds = predict_chunk(values, x, WINDOW, LEVELS)
+            part = slice(block * BLOCK_POINTS, block * BLOCK_POINTS + values.shape[1])
+            predictions[:, part] = predicted
+            pids = np.repeat(points['pid'].to_numpy()[part], horizon)
+            for level in LEVELS:
+                lower, upper, is_anomaly = bounds[level]
+                table = pa.table({
+                    'pid': pids,
+                    'lower_bound': lower.T.ravel().astype(np.float32),
+                    'upper_bound': upper.T.ravel().astype(np.float32),
+                    'actual_value': actual.T.ravel(),
+                    'predicted_value': predicted.T.ravel().astype(np.float32),
+                    'is_anomaly': is_anomaly.T.ravel(),
+                })
+                if level not in writers:
+                    files[level] = open(paths[level], 'wb')
+                    files[level].write((','.join(table.column_names) + '\n').encode())
+                    writers[level] = pa_csv.CSVWriter(files[level], table.schema, write_options=pa_csv.WriteOptions(
+                        include_header=False, quoting_style='none'))
+                writers[level].write_table(table)
+    finally:
+        for level, writer in writers.items():
+            writer.close()
+            files[level].close()
+
+    with open(predictions_path, 'w') as f:
+        f.write(','.join(points['pid']) + '\n')
+        for values in predictions:
+            f.write(csv_line(values) + '\n')
+
+
+def generate(directory, n_points, n_dates, n_tracks=2, seed=0):
+    os.makedirs(directory, exist_ok=True)
+    dates = synthetic_dates(n_dates)
+    registry = {'orbits': {orbit: orbit.split()[0] for orbit in ORBITS}, 'geometry': GEOMETRY, 'tracks': []}
+
+    # Points are split between the tracks, which alternate between orbits
+    # over the same area, as the bundled tracks do.
+    for index, count in enumerate(np.diff(np.linspace(0, n_points, n_tracks + 1).astype(int))):
+        name = 'track%d' % index
+        orbit = ORBITS[index % len(ORBITS)]
+        points = synthetic_points(count, seed=seed + index, prefix='T%d' % index)
+        files = {
+            'geo': name + '_geo.csv',
+            'displacement': name + '.csv',
+            'predictions': name + '_predictions.csv',
+            '95': name + '_anomaly_95.csv',
+            '99': name + '_anomaly_99.csv',
+        }
+        points[['pid', 'latitude', 'longitude', 'height']].to_csv(os.path.join(directory, files['geo']), index=False)
+        write_displacement(os.path.join(directory, files['displacement']), points, dates, seed + index)
+        write_anomalies({level: os.path.join(directory, files['%d' % round(level * 100)]) for level in LEVELS},
+                        os.path.join(directory, files['predictions']), points, dates, seed + index)
+
+        registry['tracks'].append({
+            'name': name,
+            'orbit': orbit,
+            'geo': files['geo'],
+            'displacement': files['displacement'],
+            'predictions': {'path': files['predictions'], 'label': 'Prediction Set %d' % (index + 1)},
+            'anomalies': {level: {'path': files[level], 'label': 'Anomaly Set %d (%s%%)' % (index + 1, level)}
+                          for level in ('95', '99')},
+        })
+
+    # Written last, so a directory with a registry is complete.
+    with open(os.path.join(directory, 'tracks.json'), 'w') as f:
+        json.dump(registry, f, indent=2)
+    return os.path.join(directory, 'tracks.json')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a synthetic InSAR dataset and its track registry.')
+    parser.add_argument('directory')
+    parser.add_argument('--points', type=int, default=10000)
+    parser.add_argument('--dates', type=int, default=100)
+    parser.add_argument('--tracks', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    path = generate(args.directory, args.points, args.dates, args.tracks, args.seed)
+    print('Wrote %s in %.1f s' % (path, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
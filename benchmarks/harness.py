@@ -0,0 +1,235 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+# Runs the app against generated datasets and writes one JSON file of
+# results per commit. Each size is measured in two fresh interpreters:
+# a cold start that builds the track caches from the CSVs, and a warm start
+# that maps them, after which the callbacks are called directly. Compare
+# two result files with compare.py.
+SIZES = ['10000x100']
+REPEAT = 20
+GRAPH_WIDTH = 1600
+NEIGHBOURHOOD_RADIUS = 200
+
+
+def summary(seconds):
+    ms = np.array(seconds) * 1000
+    return {
+        'calls': len(ms),
+        'min_ms': round(float(ms.min()), 3),
+        'median_ms': round(float(np.median(ms)), 3),
+        'p95_ms': round(float(np.percentile(ms, 95)), 3),
+        'mean_ms': round(float(ms.mean()), 3),
+    }
+
+
+def measure(call, repeat, reset=None):
+    # Latency of call(i) over `repeat` calls, then the size and
+    # serialization time of the last result as Dash would send it.
+    from plotly.utils import PlotlyJSONEncoder
+    seconds = []
+    for i in range(repeat):
+        if reset is not None:
+            reset()
+        start = time.perf_counter()
+        result = call(i)
+        seconds.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    payload = json.dumps(result, cls=PlotlyJSONEncoder)
+    return dict(summary(seconds), serialize_ms=round((time.perf_counter() - start) * 1000, 3),
+                response_bytes=len(payload))
+
+
+def triggered_by(prop_id):
+    # What dash.callback_context reports inside a callback fired by prop_id.
+    from dash._callback_context import context_value
+    from dash._utils import AttributeDict
+    context_value.set(AttributeDict(triggered_inputs=[{'prop_id': prop_id, 'value': None}]))
+
+
+def callback_latencies(repeat, seed):
+    import anomaly_events
+    import app
+    import datastore
+    import dataset
+    import decomposition
+    import trends
+
+    store = datastore.current()
+    orbits = list(dataset.ORBITS)
+    first, last = store.date_range()
+    start_date, end_date = str(first.date()), str(last.date())
+    # Two years from the middle of the series, for the windowed velocity.
+    middle = first + (last - first) / 2
+    window = (str(middle.date()), str((middle + np.timedelta64(730, 'D')).date()))
+
+    rng = np.random.default_rng(seed)
+    points = store.spatial_points.iloc[rng.integers(0, len(store.spatial_points), repeat)]
+    picked = [{'pid': row.pid, 'lat': row.latitude, 'lon': row.longitude} for row in points.itertuples()]
+
+    def click(i):
+        point = picked[i]
+        return {'points': [{'hovertext': point['pid'], 'lat': point['lat'], 'lon': point['lon']}]}
+
+    def viewport(i):
+        point = picked[i]
+        return {'zoom': 14, 'bounds': list(app.viewport_around(point['lat'], point['lon'], 14))}
+
+    def cold_map():
+        app.map_figure.cache_clear()
+        trends.track_trends.cache_clear()
+        decomposition.decompose.cache_clear()
+        decomposition.cell_velocities.cache_clear()
+
+    results = {}
+    for mode in ('orbit', 'speed', 'anomaly_type', 'vertical'):
+        results['update_map/%s' % mode] = measure(
+            lambda i: app.update_map(mode, orbits, None, window[0], window[1], [], 'open-street-map'),
+            repeat, reset=cold_map)
+    results['update_map/orbit_zoomed'] = measure(
+        lambda i: app.update_map('orbit', orbits, viewport(i), start_date, end_date, [], 'open-street-map'),
+        repeat, reset=cold_map)
+    results['update_map/cached'] = measure(
+        lambda i: app.update_map('orbit', orbits, None, start_date, end_date, [], 'open-street-map'), repeat)
+    results['update_map/events'] = measure(
+        lambda i: app.update_map('orbit', orbits, None, start_date, end_date, ['events'], 'open-street-map'),
+        repeat, reset=anomaly_events.track_events.cache_clear)
+
+    triggered_by('map.clickData')
+    results['display_displacement'] = measure(
+        lambda i: app.display_displacement(click(i), start_date, end_date, GRAPH_WIDTH, None, None, None, orbits),
+        repeat)
+    triggered_by('displacement-graph.relayoutData')
+    zoom = {'xaxis.range[0]': window[0], 'xaxis.range[1]': window[1]}
+    results['display_displacement/zoomed'] = measure(
+        lambda i: app.display_displacement(click(i), start_date, end_date, GRAPH_WIDTH, zoom, None, None, orbits),
+        repeat)
+
+    # The two-point distance is worked out in the browser.
+    results['update_neighbourhood'] = measure(
+        lambda i: app.update_neighbourhood(dict(picked[i], radius=NEIGHBOURHOOD_RADIUS), 'neighbourhood', orbits),
+        repeat)
+    return results
+
+
+def child(callbacks, repeat, seed):
+    # Runs in a fresh interpreter with DATASET_TRACKS and DATASET_CACHE_DIR
+    # set, so importing the app is part of what is measured.
+    start = time.perf_counter()
+    import app  # noqa: F401
+    import datastore
+    import dataset
+    import metrics
+    store = datastore.ensure_orbits(list(dataset.ORBITS))
+    startup = time.perf_counter() - start
+
+    phases = {}
+    for name in dataset.TRACKS:
+        for phase, seconds in metrics.phase_timings(name).items():
+            phases[phase] = round(phases.get(phase, 0) + seconds, 4)
+
+    result = {
+        'startup_seconds': round(startup, 4),
+        'phases': phases,
+        'points': int(len(store.point_data)),
+        'rows': int(sum(len(track.all_data) for track in store.tracks.values())),
+        'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        # Cold builds of several tracks run in pool processes.
+        'build_peak_rss_bytes': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+    }
+    if callbacks:
+        result['callbacks'] = callback_latencies(repeat, seed)
+        result['peak_rss_after_callbacks_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    print(json.dumps(result))
+
+
+def run_child(tracks, cache_dir, callbacks, repeat, seed):
+    env = dict(os.environ, DATASET_TRACKS=tracks, DATASET_CACHE_DIR=cache_dir)
+    for name in ('METRICS_DIR', 'CALLBACK_PROFILER', 'DATASET_ATTACH'):
+        env.pop(name, None)
+    command = [sys.executable, os.path.abspath(__file__), '--child', '--repeat', str(repeat), '--seed', str(seed)]
+    if callbacks:
+        command.append('--callbacks')
+    output = subprocess.run(command, env=env, cwd=ROOT, check=True, stdout=subprocess.PIPE, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def dataset_for(data_dir, n_points, n_dates, n_tracks, seed):
+    from generate import generate
+    directory = os.path.join(data_dir, '%dx%d-t%d-s%d' % (n_points, n_dates, n_tracks, seed))
+    tracks = os.path.join(directory, 'tracks.json')
+    if not os.path.exists(tracks):
+        print('Generating %s' % directory, file=sys.stderr)
+        generate(directory, n_points, n_dates, n_tracks, seed)
+    return tracks
+
+
+def git(*args):
+    try:
+        return subprocess.run(['git'] + list(args), cwd=ROOT, check=True, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure startup, memory and callback latency on synthetic data.')
+    parser.add_argument('--size', action='append', help='POINTSxDATES, repeatable (default %s)' % SIZES[0])
+    parser.add_argument('--tracks', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default=os.path.join(BENCHMARKS, 'data'))
+    parser.add_argument('--output', help='default: benchmarks/results/<commit>.json')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--callbacks', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.callbacks, args.repeat, args.seed)
+        return
+
+    commit = git('rev-parse', '--short', 'HEAD') or 'unknown'
+    report = {
+        'commit': commit,
+        'dirty': bool(git('status', '--porcelain', '--untracked-files=no')),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'repeat': args.repeat,
+        'results': [],
+    }
+    for size in args.size or SIZES:
+        n_points, n_dates = (int(value) for value in size.lower().split('x'))
+        tracks = dataset_for(args.data_dir, n_points, n_dates, args.tracks, args.seed)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cold = run_child(tracks, cache_dir, False, args.repeat, args.seed)
+            warm = run_child(tracks, cache_dir, True, args.repeat, args.seed)
+        report['results'].append({'points': n_points, 'dates': n_dates, 'tracks': args.tracks,
+                                  'seed': args.seed, 'cold': cold, 'warm': warm})
+        print('%s: cold start %.2f s, warm start %.2f s, peak RSS %.0f MB' % (
+            size, cold['startup_seconds'], warm['startup_seconds'], warm['peak_rss_bytes'] / 2 ** 20),
+            file=sys.stderr)
+
+    output = args.output or os.path.join(BENCHMARKS, 'results', '%s.json' % commit)
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import dataset
+from harness import BENCHMARKS, dataset_for
+
+# Column order of all_data before it was split into all_data and points.
+LEGACY_COLUMNS = ['pid', 'displacement', 'timestamp', 'file', 'latitude', 'longitude', 'height',
+                  'displacement_diff', 'time_diff', 'displacement_speed', 'mean_velocity']
+
+
+def legacy_layout(all_data, points):
+    # The old melted table: point attributes repeated on every row, strings
+    # as Python objects and every measurement float64.
+    rows = points.iloc[all_data['pid'].cat.codes.to_numpy()].reset_index(drop=True)
+    legacy = pd.DataFrame({
+        'pid': rows['pid'].to_numpy(dtype=object),
+        'displacement': all_data['displacement'].to_numpy(dtype=np.float64),
+        'timestamp': all_data['timestamp'].to_numpy(),
+        'file': rows['file'].to_numpy(dtype=object),
+    })
+    for column in ['latitude', 'longitude', 'height']:
+        legacy[column] = rows[column].to_numpy(dtype=np.float64)
+    for column in ['displacement_diff', 'time_diff', 'displacement_speed']:
+        legacy[column] = all_data[column].to_numpy(dtype=np.float64)
+    legacy['mean_velocity'] = rows['mean_velocity'].to_numpy(dtype=np.float64)
+    return legacy[LEGACY_COLUMNS]
+
+
+def frame_bytes(df):
+    # Object columns count one pointer per row plus each distinct string
+    # once, as the melted frames share their string objects.
+    total = 0
+    for column in df.columns:
+        values = df[column]
+        if values.dtype == object:
+            total += values.memory_usage(index=False, deep=False)
+            total += sum(sys.getsizeof(value) for value in pd.unique(values.to_numpy()))
+        else:
+            total += values.memory_usage(index=False, deep=True)
+    return total
+
+
+def report(name, track_tables):
+    rows = sum(len(tables['all_data']) for tables in track_tables)
+    points = sum(len(tables['points']) for tables in track_tables)
+    legacy = sum(frame_bytes(legacy_layout(tables['all_data'], tables['points'])) for tables in track_tables)
+    compact = sum(frame_bytes(tables['all_data']) + frame_bytes(tables['points']) for tables in track_tables)
+    print('%-28s %12d %10d %12.1f %12.1f %8.1f %8.1f %7.1fx' % (
+        name, points, rows, legacy / 2 ** 20, compact / 2 ** 20,
+        legacy / rows, compact / rows, legacy / compact))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory of the displacement table, old and compact layout.')
+    parser.add_argument('--points', type=int, default=200000, help='synthetic points')
+    parser.add_argument('--dates', type=int, default=100, help='synthetic dates per point')
+    parser.add_argument('--tracks', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default=os.path.join(BENCHMARKS, 'data'))
+    args = parser.parse_args()
+    # The synthetic tracks are written by generate.py, shared with the
+    # harness, and built by the same code as the bundled ones.
+    tracks = dataset_for(os.path.abspath(args.data_dir), args.points, args.dates, args.tracks, args.seed)
+
+    print('%-28s %12s %10s %12s %12s %8s %8s %8s' % (
+        'dataset', 'points', 'rows', 'legacy [MB]', 'compact [MB]', 'legacy', 'compact', 'ratio'))
+    print('%-28s %12s %10s %12s %12s %8s %8s' % ('', '', '', '', '', 'B/row', 'B/row'))
+
+    os.chdir(ROOT)
+    report('bundled', [dataset.build_track_tables(track) for track in dataset.TRACKS.values()])
+    report('synthetic %dx%d' % (args.points, args.dates),
+           [dataset.build_track_tables(track) for track in dataset.read_registry(tracks)['tracks']])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+import os
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from point_index import PointIndex
+
+N_DATES = 100
+POINT_COUNTS = [1000, 10000, 100000]
+REPEAT = 50
+
+
+def long_table(n_points, n_dates=N_DATES, seed=0):
+    rng = np.random.default_rng(seed)
+    pids = np.array(['p%07d' % i for i in range(n_points)], dtype=object)
+    dates = pd.date_range('2015-01-01', periods=n_dates, freq='12D')
+    return pd.DataFrame({
+        'pid': np.repeat(pids, n_dates),
+        'timestamp': np.tile(dates.values, n_points),
+        'displacement': rng.normal(size=n_points * n_dates).cumsum(),
+    })
+
+
+def main():
+    print('%10s %12s %12s %12s' % ('points', 'rows', 'scan [ms]', 'index [ms]'))
+    for n_points in POINT_COUNTS:
+        df = long_table(n_points)
+        index = PointIndex(df, time_column='timestamp')
+        rng = np.random.default_rng(1)
+        queries = df['pid'].to_numpy()[rng.integers(0, len(df), REPEAT)]
+        start, end = pd.Timestamp('2016-01-01'), pd.Timestamp('2017-01-01')
+
+        def scan():
+            for pid in queries:
+                point = df[df['pid'] == pid]
+                point[(point['timestamp'] >= start) & (point['timestamp'] <= end)]
+
+        def indexed():
+            for pid in queries:
+                index.between(pid, start, end)
+
+        scan_ms = min(timeit.repeat(scan, number=1, repeat=3)) / REPEAT * 1000
+        index_ms = min(timeit.repeat(indexed, number=1, repeat=3)) / REPEAT * 1000
+        print('%10d %12d %12.3f %12.3f' % (n_points, len(df), scan_ms, index_ms))
+
+
+if __name__ == '__main__':
+    main()
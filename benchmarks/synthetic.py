@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+
+# Sentinel-1 repeat cycle.
+DATE_STEP_DAYS = 12
+CENTRE = (51.11, 17.03)
+ORBITS = ['Ascending 124', 'Descending 175']
+# Viewing geometry of ORBITS, as in tracks.json.
+GEOMETRY = {'Ascending 124': {'incidence': 39.0, 'heading': 349.0},
+            'Descending 175': {'incidence': 39.0, 'heading': 191.0}}
+
+
+# Noise is drawn per block of this many points and per date, each from its
+# own seed, so any block of a series can be regenerated on its own and a
+# wide file written date by date matches one written point by point.
+BLOCK_POINTS = 65536
+
+
+def synthetic_dates(n_dates):
+    return pd.date_range('2015-01-01', periods=n_dates, freq='%dD' % DATE_STEP_DAYS)
+
+
+def synthetic_points(n_points, seed=0, prefix='S', events_per_point=1 / 20000):
+    # Per-point attributes and deformation parameters. Points cluster in
+    # sites the way persistent scatterers cluster on buildings; a few
+    # patches start subsiding partway through the series, strongest at the
+    # patch centre.
+    rng = np.random.default_rng([seed, n_points])
+    n_sites = max(1, n_points // 40)
+    site = rng.integers(0, n_sites, n_points)
+    site_lat = CENTRE[0] + rng.uniform(-0.08, 0.08, n_sites)
+    site_lon = CENTRE[1] + rng.uniform(-0.12, 0.12, n_sites)
+    latitude = site_lat[site] + rng.normal(0, 0.0003, n_points)
+    longitude = site_lon[site] + rng.normal(0, 0.0004, n_points)
+
+    metres_per_degree = 111320.0
+    event_onset = np.full(n_points, np.inf)
+    event_rate = np.zeros(n_points)
+    n_events = max(1, int(round(n_points * events_per_point)))
+    for centre in rng.integers(0, n_points, n_events):
+        radius = rng.uniform(100, 400)
+        distance = metres_per_degree * np.hypot(latitude - latitude[centre],
+                                                (longitude - longitude[centre]) * np.cos(np.radians(CENTRE[0])))
+        inside = distance < radius
+        event_onset[inside] = rng.uniform(0.5, 0.9)
+        event_rate[inside] = rng.uniform(-40, -10) * (1 - distance[inside] / radius)
+
+    return pd.DataFrame({
+        'pid': np.array(['%s%09d' % (prefix, i) for i in range(n_points)], dtype=object),
+        'latitude': latitude.round(6),
+        'longitude': longitude.round(6),
+        'height': rng.uniform(100, 160, n_points).round(1),
+        # mm/year, with a slow regional gradient across the area.
+        'velocity': rng.normal(0, 2, n_points) - 20 * (latitude - CENTRE[0]),
+        'amplitude': rng.uniform(0, 4, n_points),
+        'phase': rng.uniform(0, 2 * np.pi, n_points),
+        'noise': rng.uniform(0.8, 2.5, n_points),
+        # Fraction of the series after which the point's patch subsides.
+        'event_onset': event_onset,
+        'event_rate': event_rate,
+    })
+
+
+def synthetic_displacement(points, dates, rows, block, seed=0):
+    # Displacement [mm] of the points in `block` (a BLOCK_POINTS slice of
+    # `points`) at dates[rows], shape (len(rows), points in the block):
+    # trend + seasonal term + event + noise, zero-based at the first date.
+    part = points.iloc[block * BLOCK_POINTS:(block + 1) * BLOCK_POINTS]
+    years = ((dates - dates[0]).days.to_numpy() / 365.0)
+    t = years[rows][:, None]
+    phase = part['phase'].to_numpy()
+    onset = part['event_onset'].to_numpy() * years[-1]
+    values = (part['velocity'].to_numpy() * t
+              + part['amplitude'].to_numpy() * (np.sin(2 * np.pi * t + phase) - np.sin(phase))
+              + part['event_rate'].to_numpy() * np.clip(t - onset, 0, None))
+    noise = np.stack([np.random.default_rng([seed, row, block]).standard_normal(len(part)) for row in rows])
+    return values + noise * part['noise'].to_numpy()
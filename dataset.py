@@ -0,0 +1,426 @@
+import fcntl
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+import metrics
+from anomaly_detection import HORIZON, LEVELS, WINDOW, detect_anomalies
+from point_index import PointIndex, segment_rows
+
+CACHE_DIR = os.environ.get('DATASET_CACHE_DIR', '.dataset_cache')
+# Name of the file in a track's cache directory holding the key of the
+# snapshot to serve.
+CURRENT_FILE = 'CURRENT'
+# File in a snapshot holding the first and last date of its track.
+DATES_FILE = 'dates.json'
+# Bumped whenever the cached tables change shape, so old caches are rebuilt.
+CACHE_LAYOUT = 4
+
+# 'files' reads the anomaly sets listed in the track registry, 'detect'
+# computes them from the displacement files with anomaly_detection.
+ANOMALY_SOURCE = os.environ.get('ANOMALY_SOURCE', 'files')
+# Anomaly sets without a timestamp column are dated by pairing a point's last
+# this many anomaly rows with its last this many observations.
+ANOMALY_TAIL_ROWS = 60
+
+# Track registry: one entry per acquisition track with its orbit and source
+# files. Relative paths are taken from the registry's directory.
+TRACKS_FILE = os.environ.get('DATASET_TRACKS', 'tracks.json')
+# Processes used to build the caches of several tracks at once.
+DATASET_LOAD_WORKERS = int(os.environ.get('DATASET_LOAD_WORKERS', min(os.cpu_count() or 1, 4)))
+
+
+def read_registry(path=TRACKS_FILE):
+    with open(path) as f:
+        registry = json.load(f)
+    base = os.path.dirname(path)
+    for track in registry['tracks']:
+        for field in ('geo', 'displacement'):
+            track[field] = os.path.join(base, track[field])
+        for source in [track['predictions']] + list(track['anomalies'].values()):
+            source['path'] = os.path.join(base, source['path'])
+        if track['orbit'] not in registry['orbits']:
+            raise ValueError('Track %s has unknown orbit %r' % (track['name'], track['orbit']))
+    # Optional viewing geometry per orbit: incidence angle and heading of the
+    # satellite, in degrees. Only orbits listed here take part in the
+    # vertical / east-west decomposition.
+    registry.setdefault('geometry', {})
+    for orbit in registry['geometry']:
+        if orbit not in registry['orbits']:
+            raise ValueError('Geometry given for unknown orbit %r' % orbit)
+    return registry
+
+
+REGISTRY = read_registry()
+# Orbit value -> label shown in the orbit filter, in display order.
+ORBITS = REGISTRY['orbits']
+TRACKS = {track['name']: track for track in REGISTRY['tracks']}
+GEOMETRY = REGISTRY['geometry']
+
+
+def tracks_for_orbits(orbits):
+    return [name for name, track in TRACKS.items() if track['orbit'] in orbits]
+
+
+TABLES = ['geo_data', 'points', 'all_data', 'all_anomaly_data_95', 'all_anomaly_data_99']
+
+# all_data keeps one row per observation and only what changes per date;
+# everything constant for a point lives once in the points table.
+OBSERVATION_COLUMNS = ['pid', 'timestamp', 'displacement', 'displacement_diff',
+                       'time_diff', 'displacement_speed']
+POINT_COLUMNS = ['pid', 'latitude', 'longitude', 'height', 'file', 'mean_velocity']
+# Measurements are millimetres with a few decimals; float32 keeps ~7
+# significant digits at half the size.
+MEASUREMENT_DTYPE = np.float32
+
+
+def read_displacement_matrix(file_path):
+    # Dates are parsed once per row of the wide file, before the melt
+    # multiplies them by the number of points.
+    return pd.read_csv(file_path, parse_dates=['Date']).set_index('Date')
+
+
+def load_displacement_data(matrix, file_label):
+    df = matrix.reset_index().melt(id_vars=['Date'],
+                                   var_name='pid',
+                                   value_name='displacement')
+    df.rename(columns={'Date': 'timestamp'}, inplace=True)
+    df = df[['pid', 'displacement', 'timestamp']]
+    df['file'] = file_label
+    return df
+
+
+def load_anomaly_data(file_path, file_label):
+    df = pd.read_csv(file_path)
+    df['file'] = file_label
+    return df
+
+
+def detected_anomaly_data(matrix, orbit):
+    detected = detect_anomalies(matrix, matrix.index)
+    return [detected[level].assign(file='%s (%d%%)' % (orbit, round(level * 100))) for level in LEVELS]
+
+
+def source_files(track):
+    files = [track['geo'], track['displacement']]
+    if ANOMALY_SOURCE != 'detect':
+        files += [track['anomalies'][level]['path'] for level in ('95', '99')]
+    return files
+
+
+def source_hash(track):
+    digest = hashlib.sha256()
+    digest.update(('layout:%d' % CACHE_LAYOUT).encode())
+    if ANOMALY_SOURCE == 'detect':
+        digest.update(('detect:%d:%d' % (WINDOW, HORIZON)).encode())
+    for path in source_files(track):
+        digest.update(os.path.basename(path).encode())
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+def build_track_tables(track):
+    name = track['name']
+    with metrics.phase('csv_read', name):
+        geo_data = pd.read_csv(track['geo'])
+        matrix = read_displacement_matrix(track['displacement'])
+
+    with metrics.phase('melt', name):
+        observations = load_displacement_data(matrix, track['orbit'])
+    with metrics.phase('merge', name):
+        all_data = pd.merge(observations, geo_data, on='pid', how='left')
+
+    with metrics.phase('anomalies', name):
+        if ANOMALY_SOURCE == 'detect':
+            all_anomaly_data_95, all_anomaly_data_99 = detected_anomaly_data(matrix, track['orbit'])
+        else:
+            all_anomaly_data_95, all_anomaly_data_99 = [
+                load_anomaly_data(track['anomalies'][level]['path'], track['anomalies'][level]['label'])
+                for level in ('95', '99')]
+
+    with metrics.phase('sort', name):
+        all_data.sort_values(by=['pid', 'timestamp'], inplace=True)
+
+    with metrics.phase('velocity', name):
+        all_data['displacement_diff'] = all_data.groupby('pid')['displacement'].diff()
+        all_data['time_diff'] = all_data.groupby('pid')['timestamp'].diff().dt.days
+        all_data['displacement_speed'] = (all_data['displacement_diff'] / all_data['time_diff']) * 365
+
+        mean_velocity_data = all_data.groupby('pid')['displacement_speed'].mean().reset_index()
+        mean_velocity_data.rename(columns={'displacement_speed': 'mean_velocity'}, inplace=True)
+        points = pd.merge(all_data.drop_duplicates(subset=['pid']), mean_velocity_data, on='pid', how='left')
+
+    with metrics.phase('compact', name):
+        all_data = compact_observations(all_data)
+        return {
+            'geo_data': geo_data,
+            'points': compact_points(points),
+            'all_data': all_data,
+            'all_anomaly_data_95': date_anomalies(all_anomaly_data_95, all_data),
+            'all_anomaly_data_99': date_anomalies(all_anomaly_data_99, all_data),
+        }
+
+
+def date_anomalies(anomaly_data, all_data):
+    # Returns the anomaly set grouped by pid with the date of every row. Sets
+    # written without dates are paired with the observations by position,
+    # from the first of a point's last ANOMALY_TAIL_ROWS observations on;
+    # rows before those stay undated (NaT). Dating them once here keeps the
+    # pairing right when later acquisitions are appended.
+    anomalies = PointIndex(anomaly_data)
+    columns = ['pid', 'timestamp'] + [column for column in anomaly_data.columns if column not in ('pid', 'timestamp')]
+    if 'timestamp' in anomaly_data.columns:
+        return anomalies.frame.assign(timestamp=pd.to_datetime(anomalies.frame['timestamp']))[columns]
+
+    observations = PointIndex(all_data, time_column='timestamp')
+    timestamps = np.full(len(anomalies.frame), np.datetime64('NaT'), dtype='datetime64[ns]')
+    position = np.searchsorted(observations.keys, anomalies.keys)
+    found = position < len(observations.keys)
+    found[found] = observations.keys[position[found]] == anomalies.keys[found]
+    position = position[found]
+
+    tail_rows = np.minimum(observations.stops[position] - observations.starts[position], ANOMALY_TAIL_ROWS)
+    anomaly_stops = anomalies.stops[found]
+    paired = np.minimum(anomaly_stops - anomalies.starts[found], tail_rows)
+    timestamps[segment_rows(anomaly_stops - paired, paired)] = \
+        observations.times[segment_rows(observations.stops[position] - tail_rows, paired)]
+    return anomalies.frame.assign(timestamp=timestamps)[columns]
+
+
+def compact_observations(all_data):
+    # pid as a categorical over the sorted pids, so its codes are also row
+    # numbers into the points table.
+    all_data = all_data[OBSERVATION_COLUMNS].reset_index(drop=True)
+    all_data['pid'] = pd.Categorical(all_data['pid'])
+    for column in OBSERVATION_COLUMNS[2:]:
+        all_data[column] = all_data[column].astype(MEASUREMENT_DTYPE)
+    return all_data
+
+
+def compact_points(points):
+    # Coordinates and mean_velocity stay float64: there is one row per point,
+    # and mean_velocity is rounded for display.
+    points = points[POINT_COLUMNS].sort_values(by='pid', kind='stable').reset_index(drop=True)
+    points['pid'] = pd.Categorical(points['pid'])
+    points['file'] = pd.Categorical(points['file'])
+    return points
+
+
+def to_arrow(df):
+    arrays = {}
+    for name in df.columns:
+        values = df[name]
+        if values.dtype == object or isinstance(values.dtype, pd.CategoricalDtype):
+            # Strings are dictionary-encoded, so readers get a categorical over
+            # the mapped index buffer instead of one Python object per row.
+            categorical = pd.Categorical(values)
+            arrays[name] = pa.DictionaryArray.from_arrays(
+                pa.array(categorical.codes, mask=categorical.codes < 0),
+                pa.array(categorical.categories.to_numpy(dtype=object)))
+        else:
+            arrays[name] = pa.array(values.to_numpy())
+    return pa.table(arrays)
+
+
+def from_arrow(table):
+    # Fixed-width columns without nulls come back as views of the table's
+    # buffers; for a memory-mapped table nothing is copied.
+    columns = {}
+    for name in table.column_names:
+        chunks = table.column(name).chunks
+        array = chunks[0] if len(chunks) == 1 else table.column(name).combine_chunks()
+        if pa.types.is_dictionary(array.type):
+            indices = array.indices.fill_null(-1) if array.indices.null_count else array.indices
+            columns[name] = pd.Categorical.from_codes(indices.to_numpy(zero_copy_only=False),
+                                                      categories=pd.Index(array.dictionary.to_pylist()),
+                                                      validate=False)
+        else:
+            columns[name] = array.to_numpy(zero_copy_only=False)
+    return pd.DataFrame(columns, copy=False)
+
+
+def track_dir(name):
+    return os.path.join(CACHE_DIR, name)
+
+
+def cache_path(name, key):
+    return os.path.join(track_dir(name), key)
+
+
+@contextmanager
+def track_lock(name):
+    # Serialises cache builds and ingestion for one track across threads
+    # and processes. Not reentrant: take it once per call chain.
+    os.makedirs(track_dir(name), exist_ok=True)
+    with open(os.path.join(track_dir(name), 'lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def write_cache(tables, path):
+    tmp_path = path + '.tmp-%d' % os.getpid()
+    os.makedirs(tmp_path, exist_ok=True)
+    for name in TABLES:
+        df = tables[name]
+        # One record batch per file keeps every column a single contiguous
+        # buffer that can be mapped without concatenation.
+        feather.write_feather(to_arrow(df), os.path.join(tmp_path, name + '.feather'),
+                              compression='uncompressed', chunksize=max(len(df), 1))
+    timestamps = tables['all_data']['timestamp']
+    with open(os.path.join(tmp_path, DATES_FILE), 'w') as f:
+        json.dump({'first': pd.Timestamp(timestamps.min()).isoformat(),
+                   'last': pd.Timestamp(timestamps.max()).isoformat()}, f)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another process finished the same build first.
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def read_cache(path):
+    tables = {}
+    for name in TABLES:
+        with pa.memory_map(os.path.join(path, name + '.feather')) as source:
+            tables[name] = from_arrow(pa.ipc.open_file(source).read_all())
+    return tables
+
+
+def track_dates(name):
+    # First and last date of a track without loading it: from its current
+    # snapshot, or from the Date column of its displacement file while it
+    # has none.
+    key = current_key(name)
+    if key is not None:
+        try:
+            with open(os.path.join(cache_path(name, key), DATES_FILE)) as f:
+                dates = json.load(f)
+            return pd.Timestamp(dates['first']), pd.Timestamp(dates['last'])
+        except FileNotFoundError:
+            pass
+    path = TRACKS[name]['displacement']
+    stat = os.stat(path)
+    return source_dates(path, stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache(maxsize=None)
+def source_dates(path, mtime_ns, size):
+    # Once per version of the file.
+    dates = pd.read_csv(path, usecols=['Date'], parse_dates=['Date'])['Date']
+    return dates.min(), dates.max()
+
+
+def current_key(name):
+    try:
+        with open(os.path.join(track_dir(name), CURRENT_FILE)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def set_current_key(name, key):
+    tmp_file = os.path.join(track_dir(name), '%s.tmp-%d' % (CURRENT_FILE, os.getpid()))
+    with open(tmp_file, 'w') as f:
+        f.write(key)
+    os.replace(tmp_file, os.path.join(track_dir(name), CURRENT_FILE))
+
+
+def prune_cache(name, keep):
+    for entry in os.listdir(track_dir(name)):
+        entry_path = os.path.join(track_dir(name), entry)
+        # Processes still mapping a pruned snapshot keep reading it until
+        # they swap; the files are only released once unmapped.
+        if entry != keep and '.tmp-' not in entry and os.path.isdir(entry_path):
+            shutil.rmtree(entry_path, ignore_errors=True)
+
+
+def publish(name, tables, key):
+    os.makedirs(track_dir(name), exist_ok=True)
+    if not os.path.isdir(cache_path(name, key)):
+        with metrics.phase('cache_write', name):
+            write_cache(tables, cache_path(name, key))
+    set_current_key(name, key)
+    prune_cache(name, keep=key)
+
+
+def validate_cache(name):
+    # Points CURRENT at the cache for the track's present sources, or drops
+    # it when that cache is not built yet, so attached readers never serve
+    # a snapshot of older sources.
+    key = source_hash(TRACKS[name])
+    if os.path.isdir(cache_path(name, key)):
+        set_current_key(name, key)
+    elif current_key(name) is not None:
+        os.remove(os.path.join(track_dir(name), CURRENT_FILE))
+
+
+def prepare_cache(name, rebuild=False):
+    track = TRACKS[name]
+    with track_lock(name):
+        with metrics.phase('hash', name):
+            key = source_hash(track)
+
+        if rebuild:
+            shutil.rmtree(cache_path(name, key), ignore_errors=True)
+
+        if not os.path.isdir(cache_path(name, key)):
+            publish(name, build_track_tables(track), key)
+        elif current_key(name) != key:
+            set_current_key(name, key)
+
+    return key
+
+
+def prepare_cache_timed(name):
+    # prepare_cache in a pool process, handing back the phase timings it
+    # recorded there along with the key.
+    before = metrics.phase_timings(name)
+    key = prepare_cache(name)
+    timings = metrics.phase_timings(name)
+    return key, {phase: seconds - before.get(phase, 0) for phase, seconds in timings.items()}
+
+
+def prepare_tracks(names, attach=False, max_workers=DATASET_LOAD_WORKERS):
+    # Returns {name: cache key}. With attach, a published snapshot is used
+    # as is; otherwise the sources are hashed to check it. Tracks without a
+    # cache are built in parallel worker processes.
+    keys = {}
+    cold = []
+    for name in names:
+        key = current_key(name) if attach else None
+        if key is not None and os.path.isdir(cache_path(name, key)):
+            keys[name] = key
+        else:
+            cold.append(name)
+
+    if len(cold) > 1 and max_workers > 1:
+        # Not forked: a gunicorn worker may hold locks in other threads (the
+        # load lock, the metrics lock) that a forked child would never see
+        # released.
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(cold)),
+                                 mp_context=multiprocessing.get_context('forkserver')) as pool:
+            for name, (key, timings) in zip(cold, pool.map(prepare_cache_timed, cold)):
+                keys[name] = key
+                for phase, seconds in timings.items():
+                    metrics.record_phase(phase, name, seconds)
+    else:
+        keys.update((name, prepare_cache(name)) for name in cold)
+    return keys
+
+
+if __name__ == '__main__':
+    rebuild = '--rebuild' in sys.argv
+    for name in TRACKS:
+        print(cache_path(name, prepare_cache(name, rebuild=rebuild)))
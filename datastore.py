@@ -0,0 +1,238 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+import dataset
+import metrics
+from anomaly_streaks import streak_summary
+from point_index import PointIndex
+from spatial import SpatialIndex
+
+# How often a worker checks whether another process published a newer cache.
+DATASET_REFRESH_SECONDS = float(os.environ.get('DATASET_REFRESH_SECONDS', 5))
+
+
+class TrackStore:
+    # Immutable snapshot of one track's prepared tables and everything
+    # derived from them.
+
+    def __init__(self, name, tables, velocity_stats=None, previous=None, key=None):
+        self.name = name
+        self.tables = tables
+        # Cache key the tables were read from, if any.
+        self.key = key
+        self.geo_data = tables['geo_data']
+
+        self.all_data_index = PointIndex(tables['all_data'], time_column='timestamp')
+        self.all_data = self.all_data_index.frame
+
+        if previous is not None and previous.tables['all_anomaly_data_99'] is tables['all_anomaly_data_99']:
+            # Only the displacement table changed; reuse everything built
+            # from the anomaly tables.
+            for attribute in ('anomaly_index_95', 'anomaly_index_99', 'anomaly_streaks_95', 'anomaly_streaks_99'):
+                setattr(self, attribute, getattr(previous, attribute))
+        else:
+            self.anomaly_index_95 = PointIndex(tables['all_anomaly_data_95'])
+            self.anomaly_index_99 = PointIndex(tables['all_anomaly_data_99'])
+            self.anomaly_streaks_95 = streak_summary(self.anomaly_index_95.frame)
+            self.anomaly_streaks_99 = streak_summary(self.anomaly_index_99.frame)
+
+        self.all_anomaly_data_95 = self.anomaly_index_95.frame
+        self.all_anomaly_data_99 = self.anomaly_index_99.frame
+
+        self.velocity_stats = velocity_stats if velocity_stats is not None else self.build_velocity_stats()
+        self.point_data = self.build_point_data()
+
+    def build_velocity_stats(self):
+        # Running sums behind mean_velocity, so appended dates can update it
+        # without revisiting older observations. The sum is taken back from
+        # the float64 mean rather than re-added from float32 speeds.
+        starts, stops = self.all_data_index.starts, self.all_data_index.stops
+        valid = ~np.isnan(self.all_data['displacement_speed'].to_numpy())
+        speed_count = np.add.reduceat(valid.astype(np.int64), starts) if len(starts) else np.zeros(0, dtype=np.int64)
+        mean_velocity = self.tables['points']['mean_velocity'].to_numpy()
+        return pd.DataFrame({
+            'speed_sum': np.where(speed_count > 0, mean_velocity * speed_count, 0.0),
+            'speed_count': speed_count,
+            'last_displacement': self.all_data['displacement'].to_numpy(dtype=np.float64)[stops - 1],
+            'last_timestamp': self.all_data['timestamp'].to_numpy()[stops - 1],
+        }, index=pd.Index(self.all_data_index.keys, name='pid'))
+
+    def build_point_data(self):
+        # The points table is sorted by pid like the index keys. One row per
+        # point, so plain strings are cheap here and keep plotly's legend
+        # order the same as for an object column.
+        point_data = self.tables['points'].copy()
+        point_data['pid'] = point_data['pid'].to_numpy(dtype=object)
+        point_data['file'] = point_data['file'].to_numpy(dtype=object)
+        point_data['mean_velocity'] = point_data['mean_velocity'].round(1)
+
+        for suffix, streaks in (('_95', self.anomaly_streaks_95), ('_99', self.anomaly_streaks_99)):
+            summary = streaks.set_index('pid')
+            point_data['longest_streak' + suffix] = point_data['pid'].map(summary['longest_streak']).fillna(0).astype(int)
+            confirmed = summary.index[summary['confirmed_anomaly'].to_numpy(dtype=bool)]
+            point_data['confirmed_anomaly' + suffix] = point_data['pid'].isin(confirmed)
+
+        point_data['true_anomaly'] = point_data['confirmed_anomaly_99']
+        return point_data
+
+    def date_range(self):
+        return self.all_data['timestamp'].min(), self.all_data['timestamp'].max()
+
+
+class DataStore:
+    # Immutable snapshot of the loaded tracks. Callbacks read one snapshot
+    # per call; loading a track or ingesting data builds a new snapshot and
+    # swaps it in with set_current().
+
+    def __init__(self, tracks, previous=None):
+        self.tracks = tracks
+
+        # Points of all loaded tracks, sorted by pid; `pids` routes a pid to
+        # its track.
+        frames = [track.point_data.assign(track=name) for name, track in tracks.items()]
+        if frames:
+            point_data = pd.concat(frames, ignore_index=True)
+        else:
+            point_data = pd.DataFrame(columns=dataset.POINT_COLUMNS + ['true_anomaly', 'track'])
+        self.point_data = point_data.sort_values(by='pid', kind='stable').reset_index(drop=True)
+        self.pids = self.point_data['pid'].to_numpy()
+
+        self.spatial_points = self.point_data.dropna(subset=['latitude', 'longitude']).reset_index(drop=True)
+        if previous is not None and self.spatial_points['pid'].equals(previous.spatial_points['pid']):
+            self.spatial_index = previous.spatial_index
+        else:
+            self.spatial_index = SpatialIndex(self.spatial_points['latitude'], self.spatial_points['longitude'])
+        self.orbit_point_counts = self.spatial_points['file'].value_counts()
+
+    def track_of(self, pid):
+        i = np.searchsorted(self.pids, pid)
+        if i < len(self.pids) and self.pids[i] == pid:
+            return self.tracks[self.point_data['track'].iat[i]]
+        return None
+
+    def with_tracks(self, tracks):
+        return DataStore(dict(self.tracks, **tracks), previous=self)
+
+    def date_range(self):
+        ranges = [track.date_range() for track in self.tracks.values()]
+        if not ranges:
+            return None, None
+        return min(first for first, _ in ranges), max(last for _, last in ranges)
+
+
+_current = None
+_swap_listeners = []
+
+
+def current():
+    return _current
+
+
+def set_current(store):
+    global _current
+    _current = store
+    for listener in _swap_listeners:
+        listener()
+
+
+def on_swap(listener):
+    _swap_listeners.append(listener)
+    return listener
+
+
+_load_lock = threading.Lock()
+
+
+def read_track(name, key):
+    with metrics.phase('cache_read', name):
+        tables = dataset.read_cache(dataset.cache_path(name, key))
+    with metrics.phase('index', name):
+        return TrackStore(name, tables, key=key)
+
+
+def load():
+    # Starts with no tracks; they are read when first asked for.
+    store = DataStore({})
+    set_current(store)
+    return store
+
+
+def ensure_tracks(names):
+    # Returns a snapshot that includes the named tracks, reading (and, when
+    # needed, building) the missing ones together.
+    store = current()
+    if all(name in store.tracks for name in names):
+        return store
+    with _load_lock:
+        store = current()
+        missing = [name for name in names if name not in store.tracks]
+        if missing:
+            # Under gunicorn the master validates the caches and sets
+            # DATASET_ATTACH, so workers map published snapshots without
+            # hashing the sources again.
+            keys = dataset.prepare_tracks(missing, attach=bool(os.environ.get('DATASET_ATTACH')))
+            store = store.with_tracks({name: read_track(name, keys[name]) for name in missing})
+            set_current(store)
+        return store
+
+
+def registry_date_range():
+    # First and last date over every registered track. Loaded tracks give
+    # their own; the others are not loaded for it.
+    store = current()
+    ranges = [store.tracks[name].date_range() if name in store.tracks else dataset.track_dates(name)
+              for name in dataset.TRACKS]
+    return min(first for first, _ in ranges), max(last for _, last in ranges)
+
+
+def ensure_orbits(orbits):
+    return ensure_tracks(dataset.tracks_for_orbits(orbits))
+
+
+def swap_tracks(tracks):
+    with _load_lock:
+        store = current().with_tracks(tracks)
+        set_current(store)
+        return store
+
+
+def refresh():
+    # Swaps in snapshots other processes published for loaded tracks, if
+    # they are newer than the ones this process serves.
+    with _load_lock:
+        store = current()
+        updated = {}
+        for name, track in store.tracks.items():
+            key = dataset.current_key(name)
+            if key is None or key == track.key:
+                continue
+            try:
+                updated[name] = read_track(name, key)
+            except FileNotFoundError:
+                # Pruned by a later publish; the next refresh picks that one up.
+                continue
+        if updated:
+            store = store.with_tracks(updated)
+            set_current(store)
+        return store
+
+
+def watch_cache(interval=DATASET_REFRESH_SECONDS):
+    while True:
+        time.sleep(interval)
+        try:
+            refresh()
+        except Exception as error:
+            print('Could not refresh dataset: %s' % error)
+
+
+def start_refresher(interval=DATASET_REFRESH_SECONDS):
+    if interval <= 0:
+        return None
+    thread = threading.Thread(target=watch_cache, args=(interval,), name='dataset-refresher', daemon=True)
+    thread.start()
+    return thread
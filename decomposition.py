@@ -0,0 +1,256 @@
+import math
+import os
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+import dataset
+import datastore
+import trends
+from spatial import EARTH_RADIUS
+
+# Edge of a cell of the grid the looks are resampled onto, in metres.
+DECOMPOSITION_CELL_METRES = float(os.environ.get('DECOMPOSITION_CELL_METRES', 25))
+# Spacing of the common time axis; Sentinel-1 revisits every 6 days.
+DECOMPOSITION_STEP_DAYS = int(os.environ.get('DECOMPOSITION_STEP_DAYS', 6))
+DECOMPOSITION_CACHE_SIZE = int(os.environ.get('DECOMPOSITION_CACHE_SIZE', 4))
+# Cells whose looks point in nearly the same (east, up) direction cannot be
+# split into two components; this bounds the determinant of their normal
+# matrix.
+MIN_DETERMINANT = 1e-3
+
+# Orbits with a viewing geometry in the track registry.
+ORBITS = list(dataset.GEOMETRY)
+# Colour mode -> label of the decomposed component.
+COMPONENTS = {'vertical': 'Vertical', 'east_west': 'East-West'}
+# hover_name of a cell on the map, followed by its row and column.
+CELL_PREFIX = 'cell '
+
+
+def line_of_sight(incidence, heading):
+    # East and up components of the unit vector from the ground to a
+    # right-looking satellite, for its incidence angle and heading in degrees
+    # clockwise from north; LOS displacement is positive towards the
+    # satellite. The north component is small for near-polar orbits and, as
+    # usual for two looks, left out.
+    incidence, heading = math.radians(incidence), math.radians(heading)
+    return -math.sin(incidence) * math.cos(heading), math.cos(incidence)
+
+
+def grid_step(cell_metres):
+    return math.degrees(cell_metres / EARTH_RADIUS)
+
+
+def grid_cells(lat, lon, cell_metres=DECOMPOSITION_CELL_METRES):
+    # Row and column of every point. Columns are narrowed to the same width
+    # in metres at each row's latitude, so a cell only depends on its own
+    # coordinates and keeps its id whatever else is loaded.
+    step = grid_step(cell_metres)
+    rows = np.floor(np.asarray(lat, dtype=np.float64) / step).astype(np.int64)
+    cols = np.floor(np.asarray(lon, dtype=np.float64) / column_width(rows, step)).astype(np.int64)
+    return rows, cols
+
+
+def column_width(rows, step):
+    return step / np.cos(np.radians((rows + 0.5) * step))
+
+
+def cell_id(row, col):
+    return '%s%d/%d' % (CELL_PREFIX, row, col)
+
+
+def parse_cell(text):
+    # (row, col) of a cell id, or None for a pid.
+    if not isinstance(text, str) or not text.startswith(CELL_PREFIX):
+        return None
+    row, col = text[len(CELL_PREFIX):].split('/')
+    return int(row), int(col)
+
+
+def resample(values, dates, times):
+    # Every row of `values`, sampled at `dates`, linearly interpolated at
+    # `times`; NaN outside the dates.
+    right = np.clip(np.searchsorted(dates, times, side='right'), 1, len(dates) - 1)
+    left = right - 1
+    weight = (times - dates[left]) / (dates[right] - dates[left])
+    resampled = values[:, left] * (1 - weight) + values[:, right] * weight
+    resampled[:, (times < dates[0]) | (times > dates[-1])] = np.nan
+    return resampled
+
+
+def point_cells(track, cell_metres):
+    # Row and column of the grid cell of every point of the track's
+    # displacement index, and whether the point has coordinates at all.
+    points = track.point_data.set_index('pid').reindex(track.all_data_index.keys)
+    located = points['latitude'].notna().to_numpy() & points['longitude'].notna().to_numpy()
+    rows, cols = grid_cells(points['latitude'].fillna(0), points['longitude'].fillna(0), cell_metres)
+    return rows, cols, located
+
+
+def cell_series(track, cells, n_cells):
+    # Mean displacement of the track's points in each grid cell, per
+    # acquisition date. `cells` holds the cell of every point of the index,
+    # -1 for points left out. Returns the cells present, the number of
+    # points in each, the dates and a (cells x dates) matrix.
+    index = track.all_data_index
+    group = np.repeat(np.arange(len(index), dtype=np.int64), index.stops - index.starts)
+    displacement = track.all_data['displacement'].to_numpy(dtype=np.float64)
+    valid = ~np.isnan(displacement) & (cells[group] >= 0)
+    # Hashing the dates is much cheaper than sorting every row.
+    date_rows, dates = pd.factorize(index.times[valid], sort=True)
+    dates = np.asarray(dates, dtype='datetime64[ns]')
+
+    used, local = np.unique(cells[group[valid]], return_inverse=True)
+    flat = local * len(dates) + date_rows
+    size = len(used) * len(dates)
+    sums = np.bincount(flat, weights=displacement[valid], minlength=size)
+    counts = np.bincount(flat, minlength=size)
+    with np.errstate(invalid='ignore'):
+        means = (sums / counts).reshape(len(used), len(dates))
+    return used, np.bincount(cells[cells >= 0], minlength=n_cells)[used], dates, means
+
+
+class Decomposition:
+    # Vertical and east-west displacement of every grid cell seen from at
+    # least two looks, on a time axis shared by all of them. Each track is
+    # averaged into the cells and interpolated onto the axis, the tracks of
+    # one orbit are averaged, and the LOS equations of all cells are solved
+    # together.
+
+    def __init__(self, tracks, cell_metres=DECOMPOSITION_CELL_METRES, step_days=DECOMPOSITION_STEP_DAYS):
+        self.cell_metres = cell_metres
+        looks = {}
+        for track in tracks:
+            looks.setdefault(dataset.TRACKS[track.name]['orbit'], []).append(track)
+        orbits = sorted(looks)
+
+        # The axis covers the dates every orbit has acquisitions for.
+        first = max((min(track.date_range()[0] for track in looks[orbit]) for orbit in orbits), default=None)
+        last = min((max(track.date_range()[1] for track in looks[orbit]) for orbit in orbits), default=None)
+        if len(orbits) < 2 or first > last:
+            self.times = np.zeros(0, dtype='datetime64[ns]')
+        else:
+            self.times = pd.date_range(first, last, freq='%dD' % step_days).to_numpy()
+
+        # Every occupied cell, in row and column order, and the looks each
+        # one has points from.
+        located = {track.name: point_cells(track, cell_metres) for track in tracks}
+        cells = pd.MultiIndex.from_arrays([
+            np.concatenate([[]] + [rows[ok] for rows, _, ok in located.values()]).astype(np.int64),
+            np.concatenate([[]] + [cols[ok] for _, cols, ok in located.values()]).astype(np.int64),
+        ]).unique().sort_values()
+        track_cells = {}
+        points = np.zeros((len(orbits), len(cells)), dtype=np.int64)
+        for k, orbit in enumerate(orbits):
+            for track in looks[orbit]:
+                rows, cols, ok = located[track.name]
+                indices = np.full(len(ok), -1, dtype=np.int64)
+                indices[ok] = cells.get_indexer(pd.MultiIndex.from_arrays([rows[ok], cols[ok]]))
+                track_cells[track.name] = indices
+                points[k] += np.bincount(indices[ok], minlength=len(cells))
+
+        # Per cell, the (east, up) direction of each look it has points from.
+        # Only cells whose looks differ enough can be split, so the time
+        # series are only built for those.
+        directions = np.array([line_of_sight(**dataset.GEOMETRY[orbit]) for orbit in orbits]).reshape(-1, 2)
+        design = (points > 0).T[:, :, None] * directions[None, :, :]
+        normal = np.einsum('cki,ckj->cij', design, design)
+        solvable = np.flatnonzero(np.linalg.det(normal) > MIN_DETERMINANT)
+        design, normal, points = design[solvable], normal[solvable], points[:, solvable]
+        # The extra last slot maps the -1 of points without a cell to -1.
+        remap = np.full(len(cells) + 1, -1, dtype=np.int64)
+        remap[solvable] = np.arange(len(solvable))
+
+        # Displacement along each orbit's line of sight, referred to the first
+        # date of the axis, averaged over its tracks weighted by point count.
+        n_cells, n_times = len(solvable), len(self.times)
+        los = np.zeros((len(orbits), n_cells, n_times))
+        weights = np.zeros((len(orbits), n_cells, n_times))
+        for k, orbit in enumerate(orbits):
+            for track in looks[orbit]:
+                used, counts, dates, means = cell_series(track, remap[track_cells[track.name]], n_cells)
+                if len(dates) < 2 or n_times == 0:
+                    continue
+                series = resample(means, dates, self.times)
+                series -= series[:, :1]
+                finite = ~np.isnan(series)
+                los[k, used] += np.where(finite, series, 0) * counts[:, None]
+                weights[k, used] += finite * counts[:, None]
+        with np.errstate(invalid='ignore'):
+            los /= weights
+
+        # Least squares over the looks of each cell, exact for two; a missing
+        # date of a look leaves that date of the cell undetermined.
+        observed = np.where((points > 0)[:, :, None], los, 0)
+        rhs = np.einsum('cki,kct->cit', design, observed)
+        components = np.einsum('cij,cjt->cit', np.linalg.inv(normal), rhs).astype(np.float32)
+        self.east = components[:, 0]
+        self.vertical = components[:, 1]
+
+        rows = cells.get_level_values(0).to_numpy()[solvable]
+        cols = cells.get_level_values(1).to_numpy()[solvable]
+        step = grid_step(cell_metres)
+        self.cells = pd.DataFrame({
+            'cell': [cell_id(row, col) for row, col in zip(rows, cols)],
+            'latitude': (rows + 0.5) * step,
+            'longitude': (cols + 0.5) * column_width(rows, step),
+            'points': points.sum(axis=0),
+        })
+        self.positions = pd.MultiIndex.from_arrays([rows, cols])
+
+    def __len__(self):
+        return len(self.cells)
+
+    def position(self, cell):
+        # Row of a cell id in self.cells, or None.
+        key = parse_cell(cell)
+        if key is None or key not in self.positions:
+            return None
+        return self.positions.get_loc(key)
+
+    def series(self, cell):
+        # Displacement of one cell on the common axis, or None.
+        i = self.position(cell)
+        if i is None:
+            return None
+        return pd.DataFrame({'timestamp': self.times, 'vertical': self.vertical[i], 'east_west': self.east[i]})
+
+
+@lru_cache(maxsize=DECOMPOSITION_CACHE_SIZE)
+def decompose(tracks):
+    return Decomposition(tracks)
+
+
+def for_store(store):
+    # Decomposition of the loaded tracks of every orbit with a geometry.
+    return decompose(tuple(track for name, track in sorted(store.tracks.items())
+                           if dataset.TRACKS[name]['orbit'] in dataset.GEOMETRY))
+
+
+@lru_cache(maxsize=trends.TREND_CACHE_SIZE)
+def cell_velocities(decomposition, start=None, end=None):
+    # The cells with the robust velocity [mm/year] of both components over
+    # start..end, fitted like the point velocities.
+    in_window = np.ones(len(decomposition.times), dtype=bool)
+    if start is not None:
+        in_window &= decomposition.times >= np.datetime64(start)
+    if end is not None:
+        in_window &= decomposition.times <= np.datetime64(end)
+    times = decomposition.times[in_window]
+    t = (times - times.min()) / np.timedelta64(1, 'D') / 365 if len(times) else np.zeros(0)
+
+    columns = {}
+    for component, series in (('vertical', decomposition.vertical), ('east_west', decomposition.east)):
+        values = series[:, in_window]
+        finite = ~np.isnan(values)
+        # Row-major, so the rows come out sorted by cell as fit_trends needs.
+        group, column = np.nonzero(finite)
+        fit = trends.fit_trends(group, t[column], values[finite].astype(np.float64), len(decomposition))
+        columns[component] = fit['velocity'].round(1).to_numpy()
+        columns[component + '_se'] = fit['velocity_se'].round(2).to_numpy()
+    return decomposition.cells.assign(**columns)
+
+
+datastore.on_swap(decompose.cache_clear)
+datastore.on_swap(cell_velocities.cache_clear)
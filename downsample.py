@@ -0,0 +1,73 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+# Observations drawn per horizontal pixel of the displacement graph.
+GRAPH_POINTS_PER_PIXEL = float(os.environ.get('GRAPH_POINTS_PER_PIXEL', 1))
+# Series shorter than this are never downsampled.
+GRAPH_MIN_POINTS = int(os.environ.get('GRAPH_MIN_POINTS', 500))
+# Assumed graph width in pixels before the browser has reported one.
+GRAPH_DEFAULT_WIDTH = 1600
+
+
+def point_budget(graph_width):
+    return max(int((graph_width or GRAPH_DEFAULT_WIDTH) * GRAPH_POINTS_PER_PIXEL), GRAPH_MIN_POINTS)
+
+
+def lttb_indices(x, y, threshold):
+    # Largest-Triangle-Three-Buckets: keeps the first and last point and,
+    # from each of threshold - 2 equal buckets in between, the point that
+    # forms the largest triangle with the point kept from the previous
+    # bucket and the mean of the next one.
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, threshold - 1).astype(np.int64)
+    edges = np.append(edges, n)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = n - 1
+
+    a = 0
+    for i in range(threshold - 2):
+        start, stop = edges[i], edges[i + 1]
+        next_stop = edges[i + 2]
+        mean_x = x[stop:next_stop].mean()
+        mean_y = y[stop:next_stop].mean()
+        area = np.abs((x[a] - mean_x) * (y[start:stop] - y[a])
+                      - (x[a] - x[start:stop]) * (mean_y - y[a]))
+        a = start + int(np.argmax(area)) if stop > start else a
+        selected[i + 1] = a
+    return np.unique(selected)
+
+
+def downsample_indices(x, y, threshold, keep=()):
+    # Row positions to draw: an LTTB selection over the rows with a value,
+    # plus every position in `keep` (e.g. anomalies) whatever LTTB chose.
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        x = x.astype('datetime64[ns]').astype(np.int64)
+    x = x.astype(np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    valid = np.flatnonzero(np.isfinite(y))
+    if len(valid) <= threshold:
+        return np.arange(len(y))
+    selected = valid[lttb_indices(x[valid], y[valid], threshold)]
+    return np.union1d(selected, np.asarray(keep, dtype=np.int64))
+
+
+def window_from_relayout(relayout_data):
+    # Returns (start, end) of the x range the user zoomed the graph to, or
+    # None after a reset or for relayout events that leave x alone.
+    if not relayout_data or relayout_data.get('xaxis.autorange'):
+        return None
+    if 'xaxis.range[0]' in relayout_data:
+        start, end = relayout_data['xaxis.range[0]'], relayout_data['xaxis.range[1]']
+    elif 'xaxis.range' in relayout_data:
+        start, end = relayout_data['xaxis.range']
+    else:
+        return None
+    return pd.to_datetime(start), pd.to_datetime(end)
@@ -0,0 +1,234 @@
+import io
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from flask import Response, jsonify, request, stream_with_context
+
+import datastore
+import dataset
+from point_index import segment_rows
+
+# Points per streamed chunk; memory use follows this, not the export size.
+EXPORT_CHUNK_POINTS = int(os.environ.get('EXPORT_CHUNK_POINTS', 1000))
+
+EXPORT_COLUMNS = ['pid', 'orbit', 'timestamp', 'displacement', 'velocity',
+                  'predicted_displacement', 'lower_bound_95', 'upper_bound_95', 'is_anomaly_95',
+                  'lower_bound_99', 'upper_bound_99', 'is_anomaly_99']
+
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+
+class ExportError(ValueError):
+    pass
+
+
+def anomaly_columns(anomaly_index, pids, times, counts, suffix):
+    # Puts each point's dated anomaly rows next to its observation of the
+    # same date, as the displacement graph does. `times` are the dates of
+    # the observations of `pids`, `counts` per pid.
+    n = counts.sum()
+    columns = {'lower_bound' + suffix: np.full(n, np.nan), 'upper_bound' + suffix: np.full(n, np.nan),
+               'is_anomaly' + suffix: pd.array(np.zeros(n, dtype=bool), dtype='boolean')}
+    columns['is_anomaly' + suffix][:] = pd.NA
+    if suffix == '_95':
+        columns['predicted_displacement'] = np.full(n, np.nan)
+
+    keys = anomaly_index.keys
+    if len(keys) == 0:
+        return columns
+    position = np.searchsorted(keys, pids)
+    found = (position < len(keys)) & (keys[np.minimum(position, len(keys) - 1)] == pids)
+    position = position[found]
+    anomaly_counts = anomaly_index.stops[position] - anomaly_index.starts[position]
+    source = segment_rows(anomaly_index.starts[position], anomaly_counts)
+    frame = anomaly_index.frame
+    anomaly_times = frame['timestamp'].to_numpy()[source]
+    dated = ~np.isnat(anomaly_times)
+
+    observed = pd.MultiIndex.from_arrays([np.repeat(np.arange(len(pids)), counts), times])
+    target = observed.get_indexer(pd.MultiIndex.from_arrays([
+        np.repeat(np.flatnonzero(found), anomaly_counts)[dated], anomaly_times[dated]]))
+    source = source[dated][target >= 0]
+    target = target[target >= 0]
+
+    columns['lower_bound' + suffix][target] = frame['lower_bound'].to_numpy()[source]
+    columns['upper_bound' + suffix][target] = frame['upper_bound'].to_numpy()[source]
+    columns['is_anomaly' + suffix][target] = frame['is_anomaly'].to_numpy(dtype=bool)[source]
+    if suffix == '_95':
+        columns['predicted_displacement'][target] = frame['predicted_value'].to_numpy()[source]
+    return columns
+
+
+def chunk_frame(track, pids, start, end):
+    # Observations of `pids` (all in `track`, sorted) between start and end.
+    index = track.all_data_index
+    position = np.searchsorted(index.keys, pids)
+    starts, stops = index.starts[position], index.stops[position]
+    counts = stops - starts
+    rows = segment_rows(starts, counts)
+
+    data = track.all_data
+    columns = {
+        'pid': np.repeat(index.keys[position], counts),
+        'orbit': np.repeat(dataset.TRACKS[track.name]['orbit'], len(rows)),
+        'timestamp': index.times[rows],
+        'displacement': data['displacement'].to_numpy()[rows],
+        'velocity': data['displacement_speed'].to_numpy()[rows],
+    }
+    columns.update(anomaly_columns(track.anomaly_index_95, pids, columns['timestamp'], counts, '_95'))
+    columns.update(anomaly_columns(track.anomaly_index_99, pids, columns['timestamp'], counts, '_99'))
+
+    frame = pd.DataFrame(columns)[EXPORT_COLUMNS]
+    in_range = np.ones(len(frame), dtype=bool)
+    if start is not None:
+        in_range &= columns['timestamp'] >= np.datetime64(start)
+    if end is not None:
+        in_range &= columns['timestamp'] <= np.datetime64(end)
+    return frame[in_range]
+
+
+def selected_points(store, pids=None, bbox=None):
+    # point_data rows matching every given selector.
+    points = store.point_data
+    mask = np.ones(len(points), dtype=bool)
+    if pids is not None:
+        mask &= points['pid'].isin(pids).to_numpy()
+    if bbox is not None:
+        spatial_mask = np.zeros(len(store.spatial_points), dtype=bool)
+        spatial_mask[store.spatial_index.in_bbox(*bbox)] = True
+        mask &= points['pid'].isin(store.spatial_points['pid'][spatial_mask]).to_numpy()
+    return points[mask]
+
+
+def export_frames(store, points, start, end, chunk_points=EXPORT_CHUNK_POINTS):
+    # One frame per chunk of points, track by track in registry order.
+    for name in dataset.TRACKS:
+        track_pids = points.loc[points['track'] == name, 'pid'].to_numpy()
+        for i in range(0, len(track_pids), chunk_points):
+            frame = chunk_frame(store.tracks[name], track_pids[i:i + chunk_points], start, end)
+            if len(frame):
+                yield frame
+
+
+class ChunkSink(io.RawIOBase):
+    # Write-only file that hands back what was written since the last drain,
+    # so arrow writers can be streamed chunk by chunk.
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+EXPORT_SCHEMA = pa.schema([
+    ('pid', pa.string()), ('orbit', pa.string()), ('timestamp', pa.timestamp('ns')),
+    ('displacement', pa.float32()), ('velocity', pa.float32()),
+    ('predicted_displacement', pa.float64()),
+    ('lower_bound_95', pa.float64()), ('upper_bound_95', pa.float64()), ('is_anomaly_95', pa.bool_()),
+    ('lower_bound_99', pa.float64()), ('upper_bound_99', pa.float64()), ('is_anomaly_99', pa.bool_()),
+])
+
+
+def stream_export(frames, file_format):
+    sink = ChunkSink()
+    schema = EXPORT_SCHEMA
+    if file_format == 'parquet':
+        writer = pq.ParquetWriter(sink, schema)
+    elif file_format == 'arrow':
+        writer = pa.ipc.new_stream(sink, schema)
+    else:
+        # Dates only, as in the source files.
+        schema = schema.set(schema.get_field_index('timestamp'), pa.field('timestamp', pa.date32()))
+        writer = pa_csv.CSVWriter(sink, schema)
+    for frame in frames:
+        table = pa.Table.from_pandas(frame, schema=EXPORT_SCHEMA, preserve_index=False)
+        writer.write_table(table.cast(schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def split_values(values):
+    # Accepts a JSON list, repeated query parameters or comma-separated values.
+    if values is None:
+        return None
+    if isinstance(values, str):
+        values = [values]
+    return [part.strip() for value in values for part in str(value).split(',') if part.strip()]
+
+
+def export_request():
+    params = request.get_json(silent=True) or {}
+    for key in ('pids', 'pid', 'orbit', 'bbox', 'start', 'end', 'format'):
+        if key not in params and key in request.args:
+            params[key] = request.args.getlist(key) if key in ('pids', 'pid', 'orbit') else request.args[key]
+
+    pids = split_values(params.get('pids', params.get('pid')))
+    orbits = split_values(params.get('orbit'))
+    if orbits is not None and not set(orbits) <= set(dataset.ORBITS):
+        raise ExportError('Unknown orbit: %s' % ', '.join(sorted(set(orbits) - set(dataset.ORBITS))))
+
+    bbox = split_values(params.get('bbox'))
+    if bbox is not None:
+        try:
+            bbox = [float(value) for value in bbox]
+        except ValueError:
+            bbox = None
+        if bbox is None or len(bbox) != 4:
+            raise ExportError('bbox must be south,west,north,east')
+
+    try:
+        start = pd.to_datetime(params['start']) if params.get('start') else None
+        end = pd.to_datetime(params['end']) if params.get('end') else None
+    except (ValueError, TypeError) as error:
+        raise ExportError(str(error))
+
+    file_format = params.get('format', 'csv')
+    if file_format not in FORMATS:
+        raise ExportError('format must be one of %s' % ', '.join(FORMATS))
+    return pids, orbits, bbox, start, end, file_format
+
+
+def register_routes(server):
+    @server.route('/export/timeseries', methods=['GET', 'POST'])
+    def export_timeseries():
+        # Streams displacement, velocity and anomaly series for the points
+        # selected by `pids`, `bbox` and `orbit` (all optional, combined),
+        # limited to `start`..`end`, as csv, arrow (IPC stream) or parquet.
+        try:
+            pids, orbits, bbox, start, end, file_format = export_request()
+        except ExportError as error:
+            return jsonify({'error': str(error)}), 400
+
+        names = dataset.tracks_for_orbits(orbits if orbits is not None else list(dataset.ORBITS))
+        store = datastore.ensure_tracks(names)
+        points = selected_points(store, pids, bbox)
+        points = points[points['track'].isin(names)]
+        frames = export_frames(store, points, start, end)
+
+        mimetype, extension = FORMATS[file_format]
+        return Response(stream_with_context(stream_export(frames, file_format)), mimetype=mimetype, headers={
+            'Content-Disposition': 'attachment; filename=timeseries.%s' % extension})
@@ -0,0 +1,35 @@
+import glob
+import multiprocessing
+import os
+
+bind = '0.0.0.0:%s' % os.environ.get('PORT', 5000)
+
+# Workers share the mapped dataset, so they cost little memory; threads cover
+# callbacks that wait on I/O. Override with WEB_CONCURRENCY / GUNICORN_THREADS.
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count(), 4)))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+timeout = 120
+
+# Each worker imports the app itself and maps the cache; preloading would
+# instead share pandas objects copy-on-write, which refcounting soon copies.
+preload_app = False
+
+
+def on_starting(server):
+    # Workers write their metrics here so /metrics can report all of them;
+    # counters start again from zero with the server. Set before importing
+    # the app's modules, which the forked workers inherit.
+    metrics_dir = os.environ.setdefault('METRICS_DIR', '.metrics')
+    for path in glob.glob(os.path.join(metrics_dir, '*.json')):
+        os.remove(path)
+
+    # Check every track's cache against its sources once, before any worker
+    # starts, and tell the workers to attach to the published snapshots
+    # instead of hashing the sources again. Tracks are still built and read
+    # only when first selected.
+    # Imported here: gunicorn reads this file before the app is importable.
+    import dataset
+    for name in dataset.TRACKS:
+        dataset.validate_cache(name)
+    os.environ['DATASET_ATTACH'] = '1'
@@ -0,0 +1,331 @@
+import hmac
+import io
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from flask import abort, jsonify, request
+
+import datastore
+import dataset
+from dataset import TRACKS, compact_points, load_displacement_data
+
+# Wide 'Date x pid' CSVs dropped here are ingested into the running app.
+# A file is matched to its track by the name of the track's displacement
+# file in the registry: new rows for mz2_10.csv go in
+# INGEST_DIR/mz2_10.csv (any suffix after the stem is allowed, e.g.
+# mz2_10_2024-05-01.csv). Only *.csv names are picked up, so copy files in
+# under another name and rename them once complete.
+INGEST_DIR = os.environ.get('INGEST_DIR')
+INGEST_POLL_SECONDS = float(os.environ.get('INGEST_POLL_SECONDS', 30))
+# POST /ingest/<source csv> is only served when this is set, and must be
+# sent in the X-Ingest-Token header.
+INGEST_TOKEN = os.environ.get('INGEST_TOKEN')
+
+_ingest_lock = threading.Lock()
+
+
+class IngestError(ValueError):
+    pass
+
+
+def track_for(file_name):
+    stem = os.path.splitext(os.path.basename(file_name))[0]
+    matches = []
+    for name, track in TRACKS.items():
+        source_stem = os.path.splitext(os.path.basename(track['displacement']))[0]
+        if stem == source_stem or stem.startswith(source_stem + '_'):
+            matches.append((len(source_stem), name))
+    if not matches:
+        return None
+    # Longest stem wins, so msz2_3_x.csv is not taken for a shorter source.
+    return max(matches)[1]
+
+
+def new_observations(store, matrix, file_label):
+    # Long rows for the dates in `matrix` that are later than what each pid
+    # already has, sorted by pid and timestamp.
+    df = load_displacement_data(matrix, file_label)
+    df.sort_values(by=['pid', 'timestamp'], inplace=True, kind='stable')
+
+    last_timestamp = df['pid'].map(store.velocity_stats['last_timestamp'])
+    df = df[last_timestamp.isna() | (df['timestamp'] > last_timestamp)]
+    return df.drop_duplicates(subset=['pid', 'timestamp'], keep='last').reset_index(drop=True)
+
+
+def append_observations(store, new_rows):
+    # Returns a new TrackStore with `new_rows` appended. Speeds continue from
+    # each pid's last stored observation and mean_velocity comes from the
+    # running sums, so only the new rows are differenced.
+    if new_rows.empty:
+        return store
+
+    stats = store.velocity_stats
+    pids = new_rows['pid'].to_numpy()
+    first = np.ones(len(pids), dtype=bool)
+    first[1:] = pids[1:] != pids[:-1]
+    group_starts = np.flatnonzero(first)
+    group_pids = pids[group_starts]
+
+    displacement = new_rows['displacement'].to_numpy(dtype=np.float64)
+    timestamp = new_rows['timestamp'].to_numpy()
+
+    previous_displacement = np.empty_like(displacement)
+    previous_displacement[1:] = displacement[:-1]
+    previous_timestamp = np.empty_like(timestamp)
+    previous_timestamp[1:] = timestamp[:-1]
+    previous_displacement[group_starts] = stats['last_displacement'].reindex(group_pids).to_numpy(dtype=np.float64)
+    previous_timestamp[group_starts] = stats['last_timestamp'].reindex(group_pids).to_numpy()
+
+    displacement_diff = displacement - previous_displacement
+    time_diff = (timestamp - previous_timestamp) / np.timedelta64(1, 'D')
+    displacement_speed = (displacement_diff / time_diff) * 365
+
+    valid = ~np.isnan(displacement_speed)
+    group_stats = pd.DataFrame({
+        'speed_sum': np.add.reduceat(np.where(valid, displacement_speed, 0.0), group_starts),
+        'speed_count': np.add.reduceat(valid.astype(np.int64), group_starts),
+        'last_displacement': displacement[np.append(group_starts[1:], len(pids)) - 1],
+        'last_timestamp': timestamp[np.append(group_starts[1:], len(pids)) - 1],
+    }, index=pd.Index(group_pids, name='pid'))
+
+    velocity_stats = stats.reindex(stats.index.union(group_pids))
+    velocity_stats[['speed_sum', 'speed_count']] = velocity_stats[['speed_sum', 'speed_count']].fillna(0)
+    velocity_stats.loc[group_pids, 'speed_sum'] += group_stats['speed_sum']
+    velocity_stats.loc[group_pids, 'speed_count'] += group_stats['speed_count']
+    velocity_stats.loc[group_pids, 'last_displacement'] = group_stats['last_displacement']
+    velocity_stats.loc[group_pids, 'last_timestamp'] = group_stats['last_timestamp']
+    mean_velocity = velocity_stats['speed_sum'] / velocity_stats['speed_count'].where(velocity_stats['speed_count'] > 0)
+
+    new_rows = new_rows.assign(
+        displacement_diff=displacement_diff,
+        time_diff=time_diff,
+        displacement_speed=displacement_speed,
+    )
+    points = update_points(store, new_rows, mean_velocity)
+    all_data = insert_sorted(store.all_data_index, new_rows)
+
+    tables = dict(store.tables, points=points, all_data=all_data)
+    return datastore.TrackStore(store.name, tables, velocity_stats=velocity_stats, previous=store)
+
+
+def update_points(store, new_rows, mean_velocity):
+    # Adds pids seen for the first time, with their coordinates from
+    # geo_data, and refreshes every mean_velocity.
+    points = store.tables['points'].astype({'pid': object, 'file': object})
+    added = new_rows.drop_duplicates(subset=['pid'])
+    added = added.loc[~added['pid'].isin(points['pid']), ['pid', 'file']]
+    if not added.empty:
+        added = pd.merge(added, store.geo_data.astype({'pid': object}), on='pid', how='left')
+        points = pd.concat([points, added], ignore_index=True)
+    points['mean_velocity'] = mean_velocity.reindex(points['pid']).to_numpy()
+    return compact_points(points)
+
+
+def insert_sorted(index, new_rows):
+    # Merges pid/timestamp-sorted new rows, all later than the stored rows of
+    # their pid, into the pid-sorted frame of `index` in one linear pass.
+    old = index.frame
+    keys = index.keys
+    new_pids = new_rows['pid'].to_numpy()
+
+    position = np.searchsorted(keys, new_pids)
+    known = (position < len(keys)) & (keys[np.minimum(position, len(keys) - 1)] == new_pids)
+    insert_at = np.where(known, index.stops[np.minimum(position, len(keys) - 1)],
+                         np.append(index.starts, len(old))[position])
+
+    total = len(old) + len(new_rows)
+    new_positions = insert_at + np.arange(len(new_rows))
+    is_new = np.zeros(total, dtype=bool)
+    is_new[new_positions] = True
+
+    columns = {}
+    for column in old.columns:
+        if isinstance(old[column].dtype, pd.CategoricalDtype):
+            columns[column] = merge_categorical(old[column].array, new_rows[column], is_new)
+            continue
+        values = old[column].to_numpy()
+        added = new_rows[column].to_numpy().astype(values.dtype, copy=False)
+        merged = np.empty(total, dtype=values.dtype)
+        merged[~is_new] = values
+        merged[is_new] = added
+        columns[column] = merged
+    return pd.DataFrame(columns)
+
+
+def merge_categorical(old, added, is_new):
+    # Merges on codes so the stored rows are never turned into strings.
+    # Categories stay sorted, which keeps the codes in pid order.
+    categories = old.categories.union(pd.Index(added.dropna().unique()))
+    recode = np.append(categories.get_indexer(old.categories), -1)
+    codes = np.empty(len(is_new), dtype=np.int32 if len(categories) > 2 ** 15 - 1 else np.int16)
+    codes[~is_new] = recode[old.codes]
+    codes[is_new] = categories.get_indexer(added.to_numpy())
+    return pd.Categorical.from_codes(codes, categories=categories, validate=False)
+
+
+def append_to_source(path, matrix, dates):
+    # Keeps the source CSV in step with memory, so a restart or a rebuild
+    # sees the same data. `dates` are those the file already has. New dates
+    # are appended; points the file has no column for yet need one, so then
+    # the file is rewritten with their values on every date.
+    header = pd.read_csv(path, nrows=0).columns
+    added = matrix.columns.difference(header)
+    later = matrix[~matrix.index.isin(dates)]
+    if added.empty:
+        rows = later.reset_index().reindex(columns=header)
+        rows['Date'] = pd.to_datetime(rows['Date']).dt.strftime('%Y-%m-%d')
+        rows.to_csv(path, mode='a', header=False, index=False)
+        return
+
+    source = read_matrix(path).join(matrix[added])
+    tmp_path = '%s.tmp-%d' % (path, os.getpid())
+    pd.concat([source, later.reindex(columns=source.columns)]).to_csv(tmp_path, date_format='%Y-%m-%d')
+    os.replace(tmp_path, path)
+
+
+def date_anomaly_sources(track, store):
+    # Anomaly files without dates are paired with the displacement file by
+    # position, which appending dates would shift. Before the first append,
+    # write the dates the rows were paired with into them, so a rebuild
+    # pairs them as the running app does.
+    for level in ('95', '99'):
+        path = track['anomalies'][level]['path']
+        header = pd.read_csv(path, nrows=0).columns
+        if 'timestamp' in header:
+            continue
+        rows = store.tables['all_anomaly_data_' + level]
+        tmp_path = '%s.tmp-%d' % (path, os.getpid())
+        rows[list(header) + ['timestamp']].to_csv(tmp_path, index=False, date_format='%Y-%m-%d')
+        os.replace(tmp_path, path)
+
+
+def detect_again(store, track):
+    # In detect mode the cache key stands for a detector run over the
+    # current displacement file, so the anomaly sets are detected again
+    # over the updated file, as a rebuild would.
+    matrix = dataset.read_displacement_matrix(track['displacement'])
+    detected = dataset.detected_anomaly_data(matrix, track['orbit'])
+    tables = dict(store.tables, **{
+        'all_anomaly_data_' + level: dataset.date_anomalies(anomaly_data, store.tables['all_data'])
+        for level, anomaly_data in zip(('95', '99'), detected)})
+    return datastore.TrackStore(store.name, tables, velocity_stats=store.velocity_stats, previous=store)
+
+
+def ingest_matrix(matrix, name):
+    track = TRACKS[name]
+    datastore.ensure_tracks([name])
+    with _ingest_lock, dataset.track_lock(name):
+        # Another worker may have ingested since this one last refreshed.
+        store = datastore.refresh().tracks[name]
+        dates = pd.DatetimeIndex(pd.unique(store.all_data_index.times)).sort_values()
+        matrix = matrix[~matrix.index.duplicated(keep='last')]
+        stored = pd.Index(store.all_data_index.keys)
+        backfilled = matrix.index[(matrix.index <= dates[-1])
+                                  & matrix.reindex(columns=stored).notna().any(axis=1).to_numpy()]
+        if len(backfilled):
+            raise IngestError('%s has data up to %s; cannot backfill stored points on %s'
+                              % (name, dates[-1].date(), ', '.join(str(date.date()) for date in backfilled)))
+
+        # Every point of a track has a row for every date of its source:
+        # stored points the matrix leaves out get empty rows on the new
+        # dates, and points seen for the first time also get the dates
+        # before them, empty where the matrix has no value.
+        later = matrix.index[matrix.index > dates[-1]].sort_values()
+        matrix = matrix.reindex(index=pd.DatetimeIndex(dates.append(later), name='Date'),
+                                columns=stored.append(matrix.columns.difference(stored)))
+        new_rows = new_observations(store, matrix, track['orbit'])
+        result = {'track': name, 'source': track['displacement'], 'rows': len(new_rows), 'dates': 0}
+        if new_rows.empty:
+            return result
+
+        if dataset.ANOMALY_SOURCE != 'detect':
+            date_anomaly_sources(track, store)
+        store = append_observations(store, new_rows)
+        append_to_source(track['displacement'], matrix, dates)
+        if dataset.ANOMALY_SOURCE == 'detect':
+            store = detect_again(store, track)
+
+        # Publish under the new source hash so the other workers swap to it
+        # and a restart maps it instead of rebuilding.
+        store.key = dataset.source_hash(track)
+        dataset.publish(name, store.tables, store.key)
+        datastore.swap_tracks({name: store})
+    return dict(result, dates=len(later))
+
+
+def read_matrix(path_or_buffer):
+    return pd.read_csv(path_or_buffer, parse_dates=['Date']).set_index('Date')
+
+
+def ingest_file(file_path):
+    name = track_for(file_path)
+    if name is None:
+        raise ValueError('No track matches %s' % file_path)
+    return ingest_matrix(read_matrix(file_path), name)
+
+
+def watch(directory=INGEST_DIR, interval=INGEST_POLL_SECONDS):
+    processed = os.path.join(directory, 'processed')
+    failed = os.path.join(directory, 'failed')
+    processing = os.path.join(directory, 'processing')
+    os.makedirs(processing, exist_ok=True)
+    while True:
+        for entry in sorted(os.listdir(directory)):
+            if not entry.endswith('.csv') or not os.path.isfile(os.path.join(directory, entry)):
+                continue
+            # Every worker runs a watcher; whoever renames the file first owns it.
+            file_path = os.path.join(processing, entry)
+            try:
+                os.rename(os.path.join(directory, entry), file_path)
+            except FileNotFoundError:
+                continue
+            try:
+                result = ingest_file(file_path)
+                target = processed
+                print('Ingested %(rows)d rows over %(dates)d dates into %(source)s' % result)
+            except Exception as error:
+                target = failed
+                print('Could not ingest %s: %s' % (file_path, error))
+            os.makedirs(target, exist_ok=True)
+            shutil.move(file_path, os.path.join(target, '%d-%s' % (time.time(), entry)))
+        time.sleep(interval)
+
+
+def start_watcher(directory=INGEST_DIR):
+    if not directory:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    thread = threading.Thread(target=watch, args=(directory,), name='ingest-watcher', daemon=True)
+    thread.start()
+    return thread
+
+
+def register_routes(server):
+    # The route rewrites source files, so it only exists when a token is set.
+    if not INGEST_TOKEN:
+        return
+
+    @server.route('/ingest/<source_name>', methods=['POST'])
+    def ingest_upload(source_name):
+        token = request.headers.get('X-Ingest-Token', '')
+        if not hmac.compare_digest(token.encode(), INGEST_TOKEN.encode()):
+            abort(403)
+        name = track_for(source_name)
+        if name is None:
+            abort(404)
+        # Only look for a form upload in multipart requests; touching
+        # request.files on any other form type consumes the raw body.
+        upload = request.files.get('file') if request.mimetype == 'multipart/form-data' else None
+        body = upload.read() if upload is not None else request.get_data()
+        try:
+            matrix = read_matrix(io.BytesIO(body))
+        except (ValueError, pd.errors.ParserError) as error:
+            return jsonify({'error': str(error)}), 400
+        try:
+            return jsonify(ingest_matrix(matrix, name))
+        except IngestError as error:
+            return jsonify({'error': str(error)}), 400
@@ -0,0 +1,91 @@
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+# Most markers sent to the browser in one map response.
+MAP_POINT_BUDGET = int(os.environ.get('MAP_POINT_BUDGET', 20000))
+# Edge length of an aggregated cell on screen, in pixels.
+MAP_CELL_PIXELS = int(os.environ.get('MAP_CELL_PIXELS', 24))
+MAP_DEFAULT_ZOOM = 14
+# Assumed map size in pixels before the browser has reported a viewport.
+MAP_VIEW_WIDTH = 1600
+MAP_VIEW_HEIGHT = 800
+
+# Mapbox GL tiles are 512 px wide, so at zoom z one pixel spans
+# 360 / (512 * 2**z) degrees of longitude.
+TILE_PIXELS = 512
+
+
+def degrees_per_pixel(zoom):
+    return 360.0 / (TILE_PIXELS * 2 ** zoom)
+
+
+def viewport_from_relayout(relayout_data):
+    # Returns {'zoom', 'bounds': [south, west, north, east]} for relayout events
+    # that moved the map, or None for unrelated ones such as autosize.
+    if not relayout_data or 'mapbox.zoom' not in relayout_data:
+        return None
+
+    zoom = relayout_data['mapbox.zoom']
+    coordinates = (relayout_data.get('mapbox._derived') or {}).get('coordinates')
+    if coordinates:
+        lons = [c[0] for c in coordinates]
+        lats = [c[1] for c in coordinates]
+        bounds = [min(lats), min(lons), max(lats), max(lons)]
+    else:
+        center = relayout_data.get('mapbox.center')
+        if not center:
+            return None
+        bounds = viewport_around(center['lat'], center['lon'], zoom)
+    return {'zoom': zoom, 'bounds': bounds}
+
+
+def viewport_around(lat, lon, zoom, width=MAP_VIEW_WIDTH, height=MAP_VIEW_HEIGHT):
+    dlon = degrees_per_pixel(zoom)
+    dlat = dlon * math.cos(math.radians(lat))
+    return [lat - dlat * height / 2, lon - dlon * width / 2,
+            lat + dlat * height / 2, lon + dlon * width / 2]
+
+
+def snap_bounds(bounds, zoom):
+    # Widens bounds outwards to whole tiles so nearby viewports share a cache
+    # entry and small pans stay inside the points already sent.
+    tile = degrees_per_pixel(zoom) * TILE_PIXELS
+    south, west, north, east = bounds
+    return (math.floor(south / tile) * tile, math.floor(west / tile) * tile,
+            math.ceil(north / tile) * tile, math.ceil(east / tile) * tile)
+
+
+def aggregate_cells(points, zoom, by=None, velocity='mean_velocity'):
+    # One row per occupied grid cell: point count, centroid, mean of the
+    # `velocity` column and the share of confirmed anomalies (NaN for
+    # points without anomaly flags).
+    dlon = degrees_per_pixel(zoom) * MAP_CELL_PIXELS
+    dlat = dlon * math.cos(math.radians(points['latitude'].mean()))
+
+    frame = pd.DataFrame({
+        'row': np.floor(points['latitude'].to_numpy() / dlat).astype(np.int64),
+        'col': np.floor(points['longitude'].to_numpy() / dlon).astype(np.int64),
+        'latitude': points['latitude'].to_numpy(),
+        'longitude': points['longitude'].to_numpy(),
+        'mean_velocity': points[velocity].to_numpy(),
+        'anomaly': (points['true_anomaly'].to_numpy(dtype=np.float64) if 'true_anomaly' in points
+                    else np.full(len(points), np.nan)),
+    })
+    keys = ['row', 'col']
+    if by is not None:
+        frame[by] = points[by].to_numpy()
+        keys.append(by)
+
+    cells = frame.groupby(keys, sort=False).agg(
+        latitude=('latitude', 'mean'),
+        longitude=('longitude', 'mean'),
+        count=('latitude', 'size'),
+        mean_velocity=('mean_velocity', 'mean'),
+        anomaly_share=('anomaly', 'mean'),
+    ).reset_index().drop(columns=['row', 'col'])
+    cells['mean_velocity'] = cells['mean_velocity'].round(1)
+    cells['anomaly_share'] = cells['anomaly_share'].round(2)
+    return cells
@@ -0,0 +1,321 @@
+import atexit
+import cProfile
+import glob
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from dash.exceptions import PreventUpdate
+from flask import Response, g, request
+
+# Every gunicorn worker keeps its own counters. With METRICS_DIR set, each
+# process also writes them to METRICS_DIR/<pid>.json every
+# METRICS_FLUSH_SECONDS from a background thread, and /metrics adds up the
+# files of all processes, so whichever worker answers the scrape reports the
+# whole server.
+METRICS_DIR = os.environ.get('METRICS_DIR')
+METRICS_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', '5'))
+# 'cprofile' or 'pyinstrument' profiles every callback request and writes one
+# file per call to CALLBACK_PROFILE_DIR.
+CALLBACK_PROFILER = os.environ.get('CALLBACK_PROFILER')
+CALLBACK_PROFILE_DIR = os.environ.get('CALLBACK_PROFILE_DIR', 'profiles')
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BYTES_BUCKETS = (1e3, 1e4, 1e5, 1e6, 5e6, 1e7, 5e7)
+
+# name: (type, help)
+METRICS = {
+    'dash_callback_seconds': ('histogram', 'Server time of a callback request, including JSON serialization.'),
+    'dash_callback_compute_seconds': ('histogram', 'Time spent in the callback function itself.'),
+    'dash_callback_response_bytes': ('histogram', 'Size of the serialized callback response.'),
+    'dash_callback_rows_total': ('counter', 'Table rows touched by callbacks.'),
+    'dash_callback_calls_total': ('counter', 'Callback requests by outcome.'),
+    'http_request_seconds': ('histogram', 'Server time of HTTP requests by route.'),
+    'dataset_phase_seconds_total': ('counter', 'Time spent preparing and loading tracks, by phase.'),
+    'process_resident_memory_bytes': ('gauge', 'Resident memory of each worker process.'),
+    'process_max_resident_memory_bytes': ('gauge', 'Peak resident memory of each worker process.'),
+}
+
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_values = {}
+_local = threading.local()
+_flusher_pid = None
+
+
+def labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def increment(name, labels, amount=1):
+    key = (name, labels_key(labels))
+    with _lock:
+        _values[key] = _values.get(key, 0) + amount
+
+
+def observe(name, labels, value, buckets=SECONDS_BUCKETS):
+    # Every bucket of a series is written, with 0 where the value is above
+    # the bound, so each series always exposes the full set of bounds.
+    keys = [((name + '_bucket', labels_key(dict(labels, le=repr(float(bound))))), int(value <= bound))
+            for bound in buckets]
+    keys.append(((name + '_bucket', labels_key(dict(labels, le='+Inf'))), 1))
+    keys.append(((name + '_sum', labels_key(labels)), value))
+    keys.append(((name + '_count', labels_key(labels)), 1))
+    with _lock:
+        for key, amount in keys:
+            _values[key] = _values.get(key, 0) + amount
+
+
+def resident_memory():
+    # Current RSS from /proc where there is one; peak RSS otherwise.
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def process_values():
+    worker = {'worker': str(os.getpid())}
+    with _lock:
+        values = dict(_values)
+    values[('process_resident_memory_bytes', labels_key(worker))] = resident_memory()
+    values[('process_max_resident_memory_bytes', labels_key(worker))] = (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+    return values
+
+
+def flush():
+    if METRICS_DIR is None:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, '%d.json' % os.getpid())
+    entries = [[name, list(labels), value] for (name, labels), value in process_values().items()]
+    with _flush_lock:
+        with open(path + '.tmp', 'w') as f:
+            json.dump(entries, f)
+        os.replace(path + '.tmp', path)
+
+
+def start_flusher():
+    # One daemon thread per process, started on first use so that every
+    # forked worker runs its own rather than inheriting a dead one.
+    global _flusher_pid
+    if METRICS_DIR is None or _flusher_pid == os.getpid():
+        return
+    with _flush_lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+
+    def run():
+        while True:
+            time.sleep(METRICS_FLUSH_SECONDS)
+            flush()
+
+    threading.Thread(target=run, name='metrics-flush', daemon=True).start()
+    atexit.register(flush)
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collected_values():
+    # Counters add up over every process that ever wrote a file, so they
+    # survive worker restarts; gauges only come from running processes.
+    if METRICS_DIR is None:
+        return process_values()
+    flush()
+    totals = {}
+    for path in glob.glob(os.path.join(METRICS_DIR, '*.json')):
+        pid = int(os.path.basename(path).split('.')[0])
+        try:
+            with open(path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            continue
+        running = is_running(pid)
+        for name, labels, value in entries:
+            if METRICS[base_name(name)][0] == 'gauge' and not running:
+                continue
+            key = (name, tuple(tuple(label) for label in labels))
+            totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+def base_name(name):
+    for suffix in ('_bucket', '_sum', '_count'):
+        if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+            return name[:-len(suffix)]
+    return name
+
+
+def render(values):
+    # Prometheus text exposition format.
+    by_metric = {}
+    for (name, labels), value in values.items():
+        by_metric.setdefault(base_name(name), []).append((name, labels, value))
+    lines = []
+    for metric in sorted(by_metric):
+        kind, help_text = METRICS[metric]
+        lines.append('# HELP %s %s' % (metric, help_text))
+        lines.append('# TYPE %s %s' % (metric, kind))
+        # Buckets sorted by bound within each series, as Prometheus expects.
+        samples = sorted(by_metric[metric], key=lambda sample: (
+            sample[0], [label for label in sample[1] if label[0] != 'le'],
+            float(dict(sample[1]).get('le', 0))))
+        for name, labels, value in samples:
+            label_text = ','.join('%s="%s"' % (key, str(text).replace('\\', '\\\\').replace('"', '\\"'))
+                                  for key, text in labels)
+            lines.append('%s{%s} %s' % (name, label_text, repr(float(value))) if labels
+                         else '%s %s' % (name, repr(float(value))))
+    return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def phase(name, track):
+    # Times one step of preparing or loading a track.
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(name, track, time.perf_counter() - start)
+
+
+def record_phase(name, track, seconds):
+    increment('dataset_phase_seconds_total', {'phase': name, 'track': track}, seconds)
+
+
+def phase_timings(track):
+    # {phase: seconds} recorded in this process for `track`, to hand back
+    # from a build in a worker process.
+    with _lock:
+        return {dict(labels)['phase']: value for (name, labels), value in _values.items()
+                if name == 'dataset_phase_seconds_total' and dict(labels)['track'] == track}
+
+
+def add_rows(count):
+    # Called from callbacks with the number of table rows they read.
+    if getattr(_local, 'rows', None) is not None:
+        _local.rows += int(count)
+
+
+def timed_function(name, func):
+    @wraps(func)
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            observe('dash_callback_compute_seconds', {'callback': name}, time.perf_counter() - start)
+    return timed
+
+
+@contextmanager
+def profiled(name):
+    if CALLBACK_PROFILER is None:
+        yield
+        return
+    os.makedirs(CALLBACK_PROFILE_DIR, exist_ok=True)
+    path = os.path.join(CALLBACK_PROFILE_DIR, '%s-%d-%d' % (name, time.time() * 1000, os.getpid()))
+    if CALLBACK_PROFILER == 'pyinstrument':
+        # Optional; only needed when this profiler is picked.
+        from pyinstrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(path + '.html', 'w') as f:
+                f.write(profiler.output_html())
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path + '.prof')
+
+
+def timed_response(name, dispatch):
+    # Wraps Dash's wrapper of a callback, which returns the serialized JSON.
+    @wraps(dispatch)
+    def timed(*args, **kwargs):
+        labels = {'callback': name}
+        _local.rows = 0
+        outcome = 'error'
+        start = time.perf_counter()
+        try:
+            with profiled(name):
+                response = dispatch(*args, **kwargs)
+            outcome = 'ok'
+            observe('dash_callback_response_bytes', labels, len(response.encode()), BYTES_BUCKETS)
+            return response
+        except PreventUpdate:
+            outcome = 'no_update'
+            raise
+        finally:
+            observe('dash_callback_seconds', labels, time.perf_counter() - start)
+            increment('dash_callback_rows_total', labels, _local.rows)
+            increment('dash_callback_calls_total', dict(labels, outcome=outcome))
+            _local.rows = None
+            start_flusher()
+    return timed
+
+
+def instrument(app):
+    # Times every server-side callback registered on `app` after this call.
+    register = app.callback
+
+    @wraps(register)
+    def callback(*args, **kwargs):
+        known = set(app.callback_map)
+        decorate = register(*args, **kwargs)
+
+        def wrap(func):
+            name = func.__name__
+            decorate(timed_function(name, func))
+            for callback_id in set(app.callback_map) - known:
+                entry = app.callback_map[callback_id]
+                entry['callback'] = timed_response(name, entry['callback'])
+            return func
+        return wrap
+
+    app.callback = callback
+
+
+def register_routes(server):
+    @server.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @server.after_request
+    def record_request(response):
+        start = g.pop('request_start', None)
+        if start is None:
+            return response
+        seconds = time.perf_counter() - start
+        rule = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        observe('http_request_seconds', {'route': rule}, seconds)
+        start_flusher()
+        # Shown next to each request in the browser's network panel, so the
+        # rest of the round trip can be told apart from server time.
+        response.headers['Server-Timing'] = 'app;dur=%.1f' % (seconds * 1000)
+        return response
+
+    @server.route('/metrics')
+    def metrics():
+        return Response(render(collected_values()), mimetype='text/plain; version=0.0.4')
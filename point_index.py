@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+
+
+def key_codes(values):
+    # Something to compare rows by: the integer codes of a categorical, so
+    # no Python string is created per row, or the plain values otherwise.
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.codes.to_numpy()
+    return values.to_numpy()
+
+
+def is_sorted(values):
+    return len(values) < 2 or bool((values[1:] >= values[:-1]).all())
+
+
+def segment_rows(starts, counts):
+    # Row numbers of every [start, start + count) segment, concatenated.
+    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return offsets + np.arange(counts.sum())
+
+
+class PointIndex:
+    # Maps every pid to the [start, stop) row range it occupies in a table
+    # grouped by pid, so a point lookup is a binary search plus a slice
+    # instead of a comparison against every row.
+
+    def __init__(self, df, key='pid', time_column=None):
+        codes = key_codes(df[key])
+        # Codes follow pid order only when the categories themselves are sorted.
+        codes_ordered = (not isinstance(df[key].dtype, pd.CategoricalDtype)
+                         or df[key].cat.categories.is_monotonic_increasing)
+        if not (codes_ordered and is_sorted(codes)):
+            # Stable, so rows of one pid keep their original order.
+            order = np.argsort(df[key].to_numpy(), kind='stable')
+            df = df.iloc[order]
+            codes = key_codes(df[key])
+
+        if not (isinstance(df.index, pd.RangeIndex) and df.index.start == 0 and df.index.step == 1):
+            df = df.reset_index(drop=True)
+        self.frame = df
+        self.key = key
+        self.time_column = time_column
+
+        boundaries = np.flatnonzero(codes[1:] != codes[:-1]) + 1
+        self.starts = np.concatenate([[0], boundaries]).astype(np.int64)
+        self.stops = np.concatenate([boundaries, [len(codes)]]).astype(np.int64)
+        if len(codes) == 0:
+            self.starts = self.stops = np.zeros(0, dtype=np.int64)
+        self.keys = df[key].iloc[self.starts].to_numpy(dtype=object)
+        if time_column is not None:
+            self.times = df[time_column].to_numpy()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return self.bounds(key) is not None
+
+    def bounds(self, key):
+        i = np.searchsorted(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self.starts[i], self.stops[i]
+        return None
+
+    def lookup(self, key):
+        bounds = self.bounds(key)
+        if bounds is None:
+            return self.frame.iloc[0:0]
+        return self.frame.iloc[bounds[0]:bounds[1]]
+
+    def between(self, key, start, end):
+        # Rows of one pid with start <= time <= end; the table must be sorted
+        # by time within each pid.
+        bounds = self.bounds(key)
+        if bounds is None:
+            return self.frame.iloc[0:0]
+        times = self.times[bounds[0]:bounds[1]]
+        lo = bounds[0] + np.searchsorted(times, np.datetime64(start), side='left')
+        hi = bounds[0] + np.searchsorted(times, np.datetime64(end), side='right')
+        return self.frame.iloc[lo:hi]
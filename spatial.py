@@ -0,0 +1,58 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+EARTH_RADIUS = 6371008.8
+
+
+def to_unit_vectors(lat, lon):
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+def metres_to_chord(metres):
+    return 2 * np.sin(np.minimum(metres / (2 * EARTH_RADIUS), np.pi / 2))
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=np.float64)) for v in (lat1, lon1, lat2, lon2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class SpatialIndex:
+    # KD-tree over points on the unit sphere. Chord length grows with the
+    # great-circle distance, so Euclidean queries in 3-D are exact
+    # great-circle queries once the radius is converted.
+
+    def __init__(self, lat, lon):
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.tree = cKDTree(to_unit_vectors(self.lat, self.lon))
+        self.lat_order = np.argsort(self.lat, kind='stable')
+        self.sorted_lat = self.lat[self.lat_order]
+
+    def __len__(self):
+        return len(self.lat)
+
+    def within(self, lat, lon, radius):
+        # Indices and distances of every point within `radius` metres.
+        indices = np.asarray(self.tree.query_ball_point(to_unit_vectors(lat, lon),
+                                                        metres_to_chord(radius)), dtype=np.int64)
+        distances = haversine(lat, lon, self.lat[indices], self.lon[indices])
+        order = np.argsort(distances, kind='stable')
+        return indices[order], distances[order]
+
+    def in_bbox(self, south, west, north, east):
+        lo = np.searchsorted(self.sorted_lat, south, side='left')
+        hi = np.searchsorted(self.sorted_lat, north, side='right')
+        candidates = self.lat_order[lo:hi]
+        lon = self.lon[candidates]
+        if west <= east:
+            mask = (lon >= west) & (lon <= east)
+        else:
+            # Box crossing the antimeridian.
+            mask = (lon >= west) | (lon <= east)
+        return np.sort(candidates[mask])
@@ -0,0 +1,7 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# The bundled registry, whatever directory the tests are run from.
+os.environ.setdefault('DATASET_TRACKS', os.path.join(ROOT, 'tracks.json'))
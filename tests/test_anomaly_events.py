@@ -0,0 +1,69 @@
+from collections import deque
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from anomaly_events import EVENT_MIN_POINTS, EVENT_RADIUS_METRES, EVENT_WINDOW_DAYS, cluster_runs
+from spatial import EARTH_RADIUS, to_unit_vectors
+
+
+def brute_force_dbscan(runs, radius=EVENT_RADIUS_METRES, window_days=EVENT_WINDOW_DAYS,
+                       min_points=EVENT_MIN_POINTS):
+    # Textbook DBSCAN over the full distance matrix, in the metric
+    # cluster_runs uses. Returns the labels and the core mask.
+    days = (runs['onset'] - runs['onset'].min()).dt.days.to_numpy()
+    coordinates = np.column_stack([to_unit_vectors(runs['latitude'], runs['longitude']) * EARTH_RADIUS,
+                                   days * (radius / window_days)])
+    distances = np.sqrt(((coordinates[:, None, :] - coordinates[None, :, :]) ** 2).sum(axis=-1))
+    neighbours = distances <= radius
+    core = neighbours.sum(axis=1) >= min_points
+
+    labels = np.full(len(runs), -1)
+    cluster = 0
+    for seed in np.flatnonzero(core):
+        if labels[seed] >= 0:
+            continue
+        labels[seed] = cluster
+        queue = deque([seed])
+        while queue:
+            i = queue.popleft()
+            for j in np.flatnonzero(neighbours[i]):
+                if labels[j] < 0:
+                    labels[j] = cluster
+                    if core[j]:
+                        queue.append(j)
+        cluster += 1
+    return labels, core, neighbours
+
+
+def random_runs(seed, events=6, noise=150):
+    # A few tight space-time clusters over scattered noise.
+    rng = np.random.default_rng(seed)
+    centres = rng.uniform([52.0, 20.0], [52.01, 20.02], size=(events, 2))
+    sizes = rng.integers(3, 15, events)
+    latitude = np.concatenate([rng.normal(lat, 0.0002, n) for (lat, _), n in zip(centres, sizes)]
+                              + [rng.uniform(52.0, 52.01, noise)])
+    longitude = np.concatenate([rng.normal(lon, 0.0003, n) for (_, lon), n in zip(centres, sizes)]
+                               + [rng.uniform(20.0, 20.02, noise)])
+    onset = np.concatenate([rng.integers(0, 1000) + rng.integers(0, 20, n) for n in sizes]
+                           + [rng.integers(0, 1000, noise)])
+    return pd.DataFrame({'latitude': latitude, 'longitude': longitude,
+                         'onset': pd.Timestamp('2020-01-01') + pd.to_timedelta(onset, unit='D')})
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_cluster_runs_matches_brute_force(seed):
+    runs = random_runs(seed)
+    labels = cluster_runs(runs)
+    expected, core, neighbours = brute_force_dbscan(runs)
+    assert expected.max() >= 1
+
+    # Same noise, and the same clusters over the core runs.
+    np.testing.assert_array_equal(labels < 0, expected < 0)
+    pairs = set(zip(labels[core], expected[core]))
+    assert len(pairs) == len(set(labels[core])) == len(set(expected[core]))
+    # A border run may sit next to cores of two clusters; it has to join
+    # one of them.
+    for i in np.flatnonzero(~core & (labels >= 0)):
+        assert labels[i] in set(labels[neighbours[i] & core])
@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import dataset
+from anomaly_streaks import ANOMALY_MIN_STREAK, streak_summary
+from point_index import PointIndex
+
+
+def confirmed_anomaly_pids(anomaly_data):
+    # The shift/cumsum/groupby version streak_summary replaced.
+    is_anomaly = anomaly_data['is_anomaly'].eq(True)
+    anomaly_group = (
+        (is_anomaly != is_anomaly.shift())
+        | (anomaly_data['pid'] != anomaly_data['pid'].shift())
+    ).cumsum()
+    anomaly_streak_count = is_anomaly.groupby([anomaly_data['pid'], anomaly_group]).transform('sum')
+    return anomaly_data.loc[(anomaly_streak_count > ANOMALY_MIN_STREAK - 1) & is_anomaly, 'pid'].unique()
+
+
+def longest_streaks(anomaly_data):
+    longest = {}
+    for pid, flags in anomaly_data.groupby('pid', sort=False)['is_anomaly']:
+        run = best = 0
+        for flag in flags.eq(True):
+            run = run + 1 if flag else 0
+            best = max(best, run)
+        longest[pid] = best
+    return longest
+
+
+def random_anomalies(seed, points=300, steps=60):
+    rng = np.random.default_rng(seed)
+    flags = pd.Series(rng.random(points * steps) < rng.uniform(0.05, 0.6, points).repeat(steps), dtype=object)
+    flags[rng.random(len(flags)) < 0.02] = np.nan
+    return pd.DataFrame({'pid': np.repeat(['p%04d' % i for i in range(points)], steps), 'is_anomaly': flags})
+
+
+def anomaly_sets():
+    for name, track in dataset.TRACKS.items():
+        for level, source in track['anomalies'].items():
+            yield pytest.param(lambda path=source['path']: pd.read_csv(path), id='%s-%s' % (name, level))
+    for seed in range(3):
+        yield pytest.param(lambda seed=seed: random_anomalies(seed), id='random-%d' % seed)
+
+
+@pytest.mark.parametrize('load', anomaly_sets())
+def test_streak_summary_matches_reference(load):
+    anomaly_data = PointIndex(load()).frame
+    summary = streak_summary(anomaly_data).set_index('pid')
+
+    assert set(summary.index[summary['confirmed_anomaly']]) == set(confirmed_anomaly_pids(anomaly_data))
+    assert summary['longest_streak'].to_dict() == longest_streaks(anomaly_data)
@@ -0,0 +1,32 @@
+import pandas as pd
+
+import dataset
+import datastore
+import ingest
+
+# A Descending track; the default orbit is Ascending.
+TRACK = 'mz2_10'
+
+
+def test_date_range_covers_tracks_not_loaded(tmp_path, monkeypatch):
+    track = dict(dataset.TRACKS[TRACK], displacement=str(tmp_path / 'displacement.csv'))
+    matrix = ingest.read_matrix(dataset.TRACKS[TRACK]['displacement'])
+    later = matrix.iloc[-1:].set_axis(pd.DatetimeIndex(['2030-01-01'], name='Date'))
+    pd.concat([matrix, later]).to_csv(track['displacement'], date_format='%Y-%m-%d')
+    monkeypatch.setitem(dataset.TRACKS, TRACK, track)
+    monkeypatch.setattr(dataset, 'CACHE_DIR', str(tmp_path / 'cache'))
+
+    datastore.load()
+    first = min(ingest.read_matrix(track['displacement']).index.min() for track in dataset.TRACKS.values())
+    expected = (first, pd.Timestamp('2030-01-01'))
+    try:
+        # From the source file, then from the built snapshot, with the
+        # track never loaded.
+        assert datastore.registry_date_range() == expected
+        dataset.prepare_cache(TRACK)
+        assert datastore.registry_date_range() == expected
+        datastore.ensure_orbits([next(iter(dataset.ORBITS))])
+        assert TRACK not in datastore.current().tracks
+        assert datastore.registry_date_range() == expected
+    finally:
+        datastore.load()
@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import dataset
+import datastore
+import decomposition
+from decomposition import Decomposition, cell_velocities, column_width, grid_cells, grid_step, line_of_sight
+
+ASCENDING, DESCENDING = 'Ascending 124', 'Descending 175'
+CELL_METRES = 25
+YEAR = np.timedelta64(365, 'D')
+
+
+def synthetic_field(seed, n_cells=40):
+    # Grid cells near Wroclaw with known (vertical, east) velocities in
+    # mm/year. The last few cells are only seen from one orbit.
+    rng = np.random.default_rng(seed)
+    step = grid_step(CELL_METRES)
+    rows = int(51.1 / step) + rng.choice(400, n_cells, replace=False)
+    cols = np.floor(17.0 / column_width(rows, step)).astype(np.int64) + rng.integers(0, 400, n_cells)
+    return pd.DataFrame({
+        'row': rows, 'col': cols,
+        'vertical': rng.uniform(-25, 5, n_cells),
+        'east': rng.uniform(-8, 8, n_cells),
+        'orbits': [(ASCENDING, DESCENDING)] * (n_cells - 4) + [(ASCENDING,)] * 2 + [(DESCENDING,)] * 2,
+    })
+
+
+def track_store(name, orbit, field, dates, rng):
+    # A TrackStore of points scattered inside the field's cells, each moving
+    # with its cell's velocity projected on the orbit's line of sight plus
+    # a constant offset of its own.
+    east, up = line_of_sight(**dataset.GEOMETRY[orbit])
+    step = grid_step(CELL_METRES)
+    cells = field[field['orbits'].map(lambda orbits: orbit in orbits)]
+    per_cell = rng.integers(1, 6, len(cells))
+    rows, cols = np.repeat(cells['row'], per_cell).to_numpy(), np.repeat(cells['col'], per_cell).to_numpy()
+    latitude = (rows + rng.uniform(0.1, 0.9, len(rows))) * step
+    longitude = (cols + rng.uniform(0.1, 0.9, len(rows))) * column_width(rows, step)
+    rate = np.repeat(east * cells['east'] + up * cells['vertical'], per_cell).to_numpy()
+
+    pids = np.array(['%s%05d' % (name, i) for i in range(len(rows))], dtype=object)
+    years = (dates - dates[0]) / YEAR
+    displacement = rate[:, None] * years[None, :] + rng.uniform(-3, 3, len(rows))[:, None]
+    all_data = pd.DataFrame({
+        'pid': pd.Categorical(np.repeat(pids, len(dates))),
+        'timestamp': np.tile(dates, len(pids)),
+        'displacement': displacement.ravel().astype(np.float32),
+        'displacement_speed': np.float32(np.nan),
+    })
+    geo_data = pd.DataFrame({'pid': pids, 'latitude': latitude, 'longitude': longitude, 'height': 120.0})
+    anomalies = pd.DataFrame({'pid': pd.Categorical([]), 'timestamp': pd.to_datetime([]),
+                              'is_anomaly': np.zeros(0, dtype=bool)})
+    tables = {
+        'geo_data': geo_data,
+        'points': geo_data.assign(file=orbit, mean_velocity=np.nan)[dataset.POINT_COLUMNS],
+        'all_data': all_data,
+        'all_anomaly_data_95': anomalies,
+        'all_anomaly_data_99': anomalies.copy(),
+    }
+    return datastore.TrackStore(name, tables), (rows, cols)
+
+
+@pytest.fixture
+def tracks(monkeypatch):
+    monkeypatch.setitem(dataset.TRACKS, 'synthetic_asc', {'name': 'synthetic_asc', 'orbit': ASCENDING})
+    monkeypatch.setitem(dataset.TRACKS, 'synthetic_desc', {'name': 'synthetic_desc', 'orbit': DESCENDING})
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_decomposition_recovers_known_velocities(tracks, seed):
+    rng = np.random.default_rng(seed)
+    field = synthetic_field(seed)
+    # Interleaved acquisitions of the two orbits, neither on the 6-day axis
+    # everywhere, over slightly different spans.
+    ascending_dates = pd.date_range('2019-01-01', periods=90, freq='12D').to_numpy()
+    descending_dates = pd.date_range('2019-01-08', periods=95, freq='12D').to_numpy()
+    ascending, ascending_cells = track_store('synthetic_asc', ASCENDING, field, ascending_dates, rng)
+    descending, descending_cells = track_store('synthetic_desc', DESCENDING, field, descending_dates, rng)
+    # The points really fall in the cells they were drawn for.
+    for store, (rows, cols) in ((ascending, ascending_cells), (descending, descending_cells)):
+        points = store.point_data
+        np.testing.assert_array_equal(np.column_stack(grid_cells(points['latitude'], points['longitude'],
+                                                                 CELL_METRES)),
+                                      np.column_stack([rows, cols]))
+
+    result = Decomposition((ascending, descending), cell_metres=CELL_METRES)
+    both = field[field['orbits'].map(len) == 2].sort_values(['row', 'col'])
+    assert len(result) == len(both)
+    assert result.times[0] == descending_dates[0] and result.times[-1] <= ascending_dates[-1]
+
+    positions = [result.position(decomposition.cell_id(row, col)) for row, col in zip(both['row'], both['col'])]
+    years = (result.times - result.times[0]) / YEAR
+    np.testing.assert_allclose(result.vertical[positions], both['vertical'].to_numpy()[:, None] * years,
+                               atol=1e-3)
+    np.testing.assert_allclose(result.east[positions], both['east'].to_numpy()[:, None] * years, atol=1e-3)
+    for row, col in field.loc[field['orbits'].map(len) == 1, ['row', 'col']].itertuples(index=False):
+        assert result.position(decomposition.cell_id(row, col)) is None
+
+    velocities = cell_velocities(result).iloc[positions]
+    np.testing.assert_allclose(velocities['vertical'], both['vertical'].round(1), atol=0.051)
+    np.testing.assert_allclose(velocities['east_west'], both['east'].round(1), atol=0.051)
+
+
+def test_line_of_sight_points_to_the_satellite():
+    # Right-looking: an ascending pass looks east, so the ground-to-satellite
+    # vector points west and up; a descending one points east and up.
+    east, up = line_of_sight(incidence=39.0, heading=349.0)
+    assert east == pytest.approx(-np.sin(np.radians(39)) * np.cos(np.radians(11)))
+    assert up == pytest.approx(np.cos(np.radians(39)))
+    east, up = line_of_sight(incidence=39.0, heading=191.0)
+    assert east == pytest.approx(np.sin(np.radians(39)) * np.cos(np.radians(11)))
@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from downsample import GRAPH_MIN_POINTS, downsample_indices, lttb_indices, point_budget
+
+
+def random_series(seed, n):
+    # Irregular dates and a random walk with a few spikes.
+    rng = np.random.default_rng(seed)
+    days = np.cumsum(rng.integers(1, 13, n))
+    x = (pd.Timestamp('2015-01-01') + pd.to_timedelta(days, unit='D')).to_numpy()
+    y = np.cumsum(rng.normal(0, 1, n))
+    y[rng.integers(0, n, 5)] += rng.choice([-30, 30], 5)
+    return x, y
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('n, threshold', [(1000, 100), (1000, 3), (5000, 999), (101, 100)])
+def test_lttb_keeps_endpoints_within_budget(seed, n, threshold):
+    x, y = random_series(seed, n)
+    selected = lttb_indices(x.astype(np.int64).astype(np.float64), y, threshold)
+    assert selected[0] == 0
+    assert selected[-1] == n - 1
+    assert len(selected) <= threshold
+    assert (np.diff(selected) > 0).all()
+
+
+def test_lttb_keeps_short_series():
+    x, y = random_series(0, 50)
+    np.testing.assert_array_equal(lttb_indices(x.astype(np.int64).astype(np.float64), y, 50), np.arange(50))
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_downsample_skips_gaps_and_keeps_anomalies(seed):
+    rng = np.random.default_rng(seed)
+    x, y = random_series(seed, 3000)
+    y[:7] = np.nan
+    y[-4:] = np.nan
+    y[rng.integers(0, len(y), 200)] = np.nan
+    keep = rng.choice(np.flatnonzero(np.isfinite(y)), 40, replace=False)
+    threshold = 300
+
+    selected = downsample_indices(x, y, threshold, keep=keep)
+    valid = np.flatnonzero(np.isfinite(y))
+    assert selected[0] == valid[0]
+    assert selected[-1] == valid[-1]
+    assert np.isfinite(y[selected]).all()
+    assert np.isin(keep, selected).all()
+    assert len(selected) <= threshold + len(keep)
+    assert (np.diff(selected) > 0).all()
+
+
+def test_downsample_keeps_series_within_budget():
+    x, y = random_series(0, 400)
+    y[10] = np.nan
+    np.testing.assert_array_equal(downsample_indices(x, y, 400), np.arange(400))
+
+
+def test_point_budget_has_a_floor():
+    assert point_budget(10) == GRAPH_MIN_POINTS
+    assert point_budget(None) >= GRAPH_MIN_POINTS
+    assert point_budget(100000) > GRAPH_MIN_POINTS
@@ -0,0 +1,115 @@
+import io
+
+import flask
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import dataset
+import datastore
+import export
+
+ASCENDING = 'Ascending 124'
+START, END = pd.Timestamp('2019-03-01'), pd.Timestamp('2021-06-30')
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(dataset, 'CACHE_DIR', str(tmp_path))
+    datastore.load()
+    yield datastore.ensure_orbits(list(dataset.ORBITS))
+    datastore.load()
+
+
+def full_frame(store, pids, start, end):
+    # The export as a join of the whole tables, filtered afterwards.
+    frames = []
+    for name in dataset.TRACKS:
+        track = store.tracks[name]
+        frame = pd.DataFrame({
+            'pid': track.all_data['pid'].astype(object),
+            'orbit': dataset.TRACKS[name]['orbit'],
+            'timestamp': track.all_data['timestamp'],
+            'displacement': track.all_data['displacement'],
+            'velocity': track.all_data['displacement_speed'],
+        })
+        for level in ('95', '99'):
+            anomalies = getattr(track, 'all_anomaly_data_' + level).assign(
+                pid=lambda df: df['pid'].astype(object))
+            anomalies = anomalies.dropna(subset=['timestamp']).drop_duplicates(['pid', 'timestamp'], keep='last')
+            anomalies = anomalies.rename(columns={'lower_bound': 'lower_bound_' + level,
+                                                  'upper_bound': 'upper_bound_' + level,
+                                                  'is_anomaly': 'is_anomaly_' + level,
+                                                  'predicted_value': 'predicted_displacement'})
+            columns = ['pid', 'timestamp', 'lower_bound_' + level, 'upper_bound_' + level, 'is_anomaly_' + level]
+            if level == '95':
+                columns.append('predicted_displacement')
+            frame = frame.merge(anomalies[columns], on=['pid', 'timestamp'], how='left')
+        frames.append(frame.sort_values(['pid', 'timestamp'], kind='stable'))
+    frame = pd.concat(frames, ignore_index=True)[export.EXPORT_COLUMNS]
+    frame = frame[frame['pid'].isin(pids) & (frame['timestamp'] >= start) & (frame['timestamp'] <= end)]
+    return frame.reset_index(drop=True)
+
+
+def assert_same_export(actual, expected):
+    assert list(actual.columns) == export.EXPORT_COLUMNS
+    assert len(actual) == len(expected) > 0
+    np.testing.assert_array_equal(actual['pid'].to_numpy(dtype=object), expected['pid'].to_numpy(dtype=object))
+    np.testing.assert_array_equal(actual['orbit'].to_numpy(dtype=object), expected['orbit'].to_numpy(dtype=object))
+    np.testing.assert_array_equal(actual['timestamp'].to_numpy(dtype='datetime64[ns]'),
+                                  expected['timestamp'].to_numpy(dtype='datetime64[ns]'))
+    for column in export.EXPORT_COLUMNS[3:]:
+        if column.startswith('is_anomaly'):
+            np.testing.assert_array_equal(actual[column].astype('boolean').to_numpy(dtype=object, na_value=None),
+                                          expected[column].astype('boolean').to_numpy(dtype=object, na_value=None))
+        else:
+            np.testing.assert_allclose(actual[column].to_numpy(dtype=np.float64),
+                                       expected[column].to_numpy(dtype=np.float64), rtol=1e-6, equal_nan=True)
+
+
+def read_export(data, file_format):
+    if file_format == 'arrow':
+        return pa.ipc.open_stream(data).read_pandas()
+    if file_format == 'parquet':
+        return pq.read_table(io.BytesIO(data)).to_pandas()
+    return pd.read_csv(io.BytesIO(data), parse_dates=['timestamp'], dtype={'pid': object})
+
+
+def some_pids(store, seed=0, n=25):
+    pids = store.point_data['pid'].to_numpy()
+    return np.sort(np.random.default_rng(seed).choice(pids, min(n, len(pids)), replace=False))
+
+
+@pytest.mark.parametrize('chunk_points', [1, 7, 1000])
+def test_export_frames_match_full_frame(store, chunk_points):
+    pids = some_pids(store)
+    points = export.selected_points(store, pids)
+    frames = list(export.export_frames(store, points, START, END, chunk_points=chunk_points))
+    assert all(len(frame) for frame in frames)
+    assert_same_export(pd.concat(frames, ignore_index=True), full_frame(store, pids, START, END))
+
+
+@pytest.mark.parametrize('file_format', list(export.FORMATS))
+def test_export_route_matches_full_frame(store, file_format):
+    server = flask.Flask(__name__)
+    export.register_routes(server)
+    pids = some_pids(store, seed=1)
+    response = server.test_client().post('/export/timeseries', json={
+        'pids': list(pids), 'orbit': [ASCENDING], 'start': str(START.date()), 'end': str(END.date()),
+        'format': file_format})
+    assert response.status_code == 200
+
+    ascending = store.point_data.loc[store.point_data['file'] == ASCENDING, 'pid']
+    expected = full_frame(store, pids[np.isin(pids, ascending)], START, END)
+    assert_same_export(read_export(response.get_data(), file_format), expected)
+
+
+def test_export_rejects_bad_requests(store):
+    server = flask.Flask(__name__)
+    export.register_routes(server)
+    client = server.test_client()
+    assert client.get('/export/timeseries?format=xlsx').status_code == 400
+    assert client.get('/export/timeseries?orbit=Sideways').status_code == 400
+    assert client.get('/export/timeseries?bbox=1,2,3').status_code == 400
@@ -0,0 +1,149 @@
+import os
+import shutil
+
+import flask
+import numpy as np
+import pandas as pd
+import pytest
+
+import dataset
+import datastore
+import ingest
+
+# Ingesting the last HELD_BACK dates of a track must leave the running app,
+# its published snapshot and a rebuild from the updated sources identical.
+TRACK = 'mz2_10'
+HELD_BACK = 15
+
+
+@pytest.fixture(params=['files', 'detect'])
+def track(request, tmp_path, monkeypatch):
+    # A copy of the track's sources without its last HELD_BACK dates, with a
+    # cache of its own. Yields the track and the held back rows.
+    source = dataset.TRACKS[TRACK]
+    track = dict(source, anomalies={level: dict(anomalies) for level, anomalies in source['anomalies'].items()})
+    for field in ('geo', 'displacement'):
+        track[field] = str(tmp_path / ('%s.csv' % field))
+        shutil.copy(source[field], track[field])
+    for level, anomalies in track['anomalies'].items():
+        anomalies['path'] = str(tmp_path / ('anomalies_%s.csv' % level))
+        shutil.copy(source['anomalies'][level]['path'], anomalies['path'])
+
+    matrix = ingest.read_matrix(track['displacement'])
+    matrix.iloc[:-HELD_BACK].to_csv(track['displacement'], date_format='%Y-%m-%d')
+
+    monkeypatch.setitem(dataset.TRACKS, TRACK, track)
+    monkeypatch.setattr(dataset, 'CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(dataset, 'ANOMALY_SOURCE', request.param)
+    datastore.load()
+    yield track, matrix.iloc[-HELD_BACK:]
+    datastore.load()
+
+
+def comparable(df):
+    # Categoricals as plain values, so tables read back from a snapshot
+    # compare equal to freshly built ones.
+    return df.astype({column: object for column in df.columns
+                      if isinstance(df[column].dtype, pd.CategoricalDtype)}).reset_index(drop=True)
+
+
+def assert_same_tables(store, expected):
+    pd.testing.assert_frame_equal(comparable(store.all_data), comparable(expected.all_data))
+    pd.testing.assert_frame_equal(comparable(store.point_data), comparable(expected.point_data))
+    for level in ('95', '99'):
+        pd.testing.assert_frame_equal(comparable(getattr(store, 'all_anomaly_data_' + level)),
+                                      comparable(getattr(expected, 'all_anomaly_data_' + level)))
+
+
+def rebuilt():
+    return datastore.TrackStore(TRACK, dataset.build_track_tables(dataset.TRACKS[TRACK]))
+
+
+def restarted():
+    datastore.load()
+    return datastore.ensure_tracks([TRACK]).tracks[TRACK]
+
+
+def test_ingest_matches_rebuild(track):
+    track, held_back = track
+    before = datastore.ensure_tracks([TRACK]).tracks[TRACK]
+    result = ingest.ingest_matrix(held_back, TRACK)
+    assert (result['rows'], result['dates']) == (held_back.size, HELD_BACK)
+
+    ingested = datastore.current().tracks[TRACK]
+    assert ingested.key == dataset.source_hash(track)
+    assert_same_tables(ingested, rebuilt())
+    assert_same_tables(restarted(), ingested)
+
+    if dataset.ANOMALY_SOURCE == 'detect':
+        # Detected again over the new dates: the last prediction is for the
+        # last ingested date and compares against its value.
+        last = ingested.all_anomaly_data_99.groupby('pid', observed=True).tail(1).set_index('pid')
+        assert (last['timestamp'] == held_back.index[-1]).all()
+        np.testing.assert_allclose(last['actual_value'], held_back.iloc[-1][last.index].to_numpy())
+    else:
+        # The stored anomaly sets keep the dates they were computed for, and
+        # the new dates have none.
+        for level in ('95', '99'):
+            pd.testing.assert_frame_equal(comparable(getattr(ingested, 'all_anomaly_data_' + level)),
+                                          comparable(getattr(before, 'all_anomaly_data_' + level)))
+        assert ingested.all_anomaly_data_99['timestamp'].max() < held_back.index[0]
+
+
+def test_ingest_new_point(track):
+    track, held_back = track
+    datastore.ensure_tracks([TRACK])
+    held_back = held_back.assign(NEWPOINT=np.arange(HELD_BACK, dtype=np.float64))
+    ingest.ingest_matrix(held_back, TRACK)
+
+    ingested = datastore.current().tracks[TRACK]
+    assert 'NEWPOINT' in pd.read_csv(track['displacement'], nrows=0).columns
+    assert 'NEWPOINT' in ingested.all_data_index
+    assert_same_tables(ingested, rebuilt())
+    assert_same_tables(restarted(), ingested)
+
+
+def test_ingest_partial_matrix(track):
+    track, held_back = track
+    datastore.ensure_tracks([TRACK])
+    ingest.ingest_matrix(held_back.iloc[:, 3:], TRACK)
+
+    ingested = datastore.current().tracks[TRACK]
+    assert len(ingested.all_data) == len(ingest.read_matrix(track['displacement']).melt())
+    assert_same_tables(ingested, rebuilt())
+    assert_same_tables(restarted(), ingested)
+
+
+def test_ingest_rejects_backfill(track):
+    track, held_back = track
+    before = datastore.ensure_tracks([TRACK]).tracks[TRACK]
+    source = open(track['displacement']).read()
+    stored = ingest.read_matrix(track['displacement']).iloc[-2:]
+
+    with pytest.raises(ingest.IngestError):
+        ingest.ingest_matrix(pd.concat([stored, held_back]), TRACK)
+    assert datastore.current().tracks[TRACK] is before
+    assert open(track['displacement']).read() == source
+
+
+def upload_client(monkeypatch, token):
+    monkeypatch.setattr(ingest, 'INGEST_TOKEN', token)
+    server = flask.Flask(__name__)
+    ingest.register_routes(server)
+    return server.test_client()
+
+
+def test_ingest_route(track, monkeypatch):
+    track, held_back = track
+    path = '/ingest/%s' % os.path.basename(dataset.TRACKS[TRACK]['displacement'])
+    body = held_back.to_csv(date_format='%Y-%m-%d')
+    stored = ingest.read_matrix(track['displacement']).iloc[-1:].to_csv(date_format='%Y-%m-%d')
+
+    assert upload_client(monkeypatch, None).post(path, data=body).status_code == 404
+    client = upload_client(monkeypatch, 'secret')
+    assert client.post(path, data=body).status_code == 403
+    assert client.post(path, data=body, headers={'X-Ingest-Token': 'wrong'}).status_code == 403
+    assert client.post(path, data=stored, headers={'X-Ingest-Token': 'secret'}).status_code == 400
+    response = client.post(path, data=body, headers={'X-Ingest-Token': 'secret'})
+    assert response.status_code == 200
+    assert response.get_json()['dates'] == HELD_BACK
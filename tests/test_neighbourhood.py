@@ -0,0 +1,33 @@
+import app
+import dataset
+import datastore
+
+ASCENDING, DESCENDING = 'Ascending 124', 'Descending 175'
+RADIUS = 5000
+
+
+def listed_pids(result):
+    # pids in the neighbourhood list, after the summary line.
+    items = result.children[1].children[1:]
+    return [item.children.split(' ')[0] for item in items]
+
+
+def test_neighbourhood_follows_orbit_filter(tmp_path, monkeypatch):
+    monkeypatch.setattr(dataset, 'CACHE_DIR', str(tmp_path))
+    datastore.load()
+    try:
+        store = datastore.ensure_orbits([ASCENDING])
+        centre = store.spatial_points.iloc[0]
+        point = {'pid': centre['pid'], 'lat': centre['latitude'], 'lon': centre['longitude']}
+        expected = listed_pids(app.display_neighbourhood(point, RADIUS, [ASCENDING]))
+
+        # The same answer after this worker has loaded the other orbit.
+        store = datastore.ensure_orbits([ASCENDING, DESCENDING])
+        files = store.spatial_points.set_index('pid')['file']
+        assert listed_pids(app.display_neighbourhood(point, RADIUS, ASCENDING)) == expected
+        assert set(files[expected]) == {ASCENDING}
+
+        both = listed_pids(app.display_neighbourhood(point, RADIUS, [ASCENDING, DESCENDING]))
+        assert DESCENDING in set(files[both])
+    finally:
+        datastore.load()
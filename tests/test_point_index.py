@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from point_index import PointIndex, segment_rows
+
+
+def random_table(seed, layout, n_points=60):
+    # Rows of every pid in time order, the pids themselves shuffled and
+    # interleaved unless the layout is 'sorted'.
+    rng = np.random.default_rng(seed)
+    pids = np.array(['P%04d' % i for i in rng.permutation(1000)[:n_points]], dtype=object)
+    counts = rng.integers(1, 30, n_points)
+    pid = np.repeat(pids, counts)
+    timestamp = np.concatenate([np.sort(rng.choice(2000, count, replace=False)) for count in counts])
+    df = pd.DataFrame({
+        'pid': pid,
+        'timestamp': pd.Timestamp('2015-01-01') + pd.to_timedelta(timestamp, unit='D'),
+        'displacement': rng.normal(0, 5, len(pid)),
+    })
+    if layout == 'sorted':
+        df = df.sort_values('pid', kind='stable')
+    else:
+        df = df.iloc[rng.permutation(len(df))].sort_values('timestamp', kind='stable')
+    if layout == 'categorical':
+        # Categories in first-seen order, so the codes do not follow pid order.
+        df['pid'] = pd.Categorical(df['pid'], categories=pd.unique(df['pid']))
+    return df.set_index(pd.Index(rng.permutation(len(df))))
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('layout', ['sorted', 'shuffled', 'categorical'])
+def test_point_index_matches_groupby(seed, layout):
+    df = random_table(seed, layout)
+    index = PointIndex(df, time_column='timestamp')
+    groups = df.groupby(df['pid'].astype(object), sort=True)
+
+    np.testing.assert_array_equal(index.keys, np.array(list(groups.groups), dtype=object))
+    np.testing.assert_array_equal(index.stops - index.starts, groups.size().to_numpy())
+    np.testing.assert_array_equal(index.starts[1:], index.stops[:-1])
+    assert index.starts[0] == 0 and index.stops[-1] == len(df)
+
+    for pid, group in groups:
+        rows = index.lookup(pid)
+        np.testing.assert_array_equal(rows['timestamp'].to_numpy(), group['timestamp'].to_numpy())
+        np.testing.assert_array_equal(rows['displacement'].to_numpy(), group['displacement'].to_numpy())
+
+        start, end = group['timestamp'].iloc[len(group) // 3], group['timestamp'].iloc[-1]
+        expected = group[(group['timestamp'] >= start) & (group['timestamp'] <= end)]
+        np.testing.assert_array_equal(index.between(pid, start, end)['displacement'].to_numpy(),
+                                      expected['displacement'].to_numpy())
+
+
+def test_point_index_missing_key():
+    index = PointIndex(random_table(0, 'shuffled'), time_column='timestamp')
+    assert 'Q0000' not in index
+    assert index.bounds('Q0000') is None
+    assert index.lookup('Q0000').empty
+    assert index.between('Q0000', '2015-01-01', '2030-01-01').empty
+    assert len(PointIndex(random_table(0, 'sorted').iloc[0:0])) == 0
+
+
+def test_segment_rows():
+    starts = np.array([5, 0, 12, 3])
+    counts = np.array([2, 3, 0, 1])
+    expected = np.concatenate([np.arange(start, start + count) for start, count in zip(starts, counts)])
+    np.testing.assert_array_equal(segment_rows(starts, counts), expected)
@@ -0,0 +1,128 @@
+import os
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+import datastore
+
+# Fitted windows kept; each holds a few floats per point of one track.
+TREND_CACHE_SIZE = int(os.environ.get('TREND_CACHE_SIZE', 16))
+# Huber reweighting passes after the plain least-squares fit, so a single bad
+# epoch cannot drag a point's trend; 0 gives ordinary least squares.
+TREND_ROBUST_ITERATIONS = int(os.environ.get('TREND_ROBUST_ITERATIONS', 3))
+TREND_HUBER_K = 1.345
+
+TREND_COLUMNS = ['velocity', 'velocity_se', 'acceleration', 'acceleration_se', 'r2', 'observations']
+
+
+def group_medians(group, values, starts, counts):
+    # Median of the non-negative `values` within each contiguous group; empty
+    # groups give NaN. One sort of group + value scaled into [0, 1) orders
+    # the rows by group and then value, much faster than a lexsort.
+    scale = values.max() * (1 + 1e-6) if len(values) else 1.0
+    if scale == 0:
+        return np.where(counts > 0, 0.0, np.nan)
+    ordered = (np.sort(group + values / scale) - group) * scale
+    lower = starts + np.maximum(counts - 1, 0) // 2
+    upper = starts + counts // 2
+    valid = counts > 0
+    medians = np.full(len(counts), np.nan)
+    medians[valid] = (ordered[lower[valid]] + ordered[upper[valid]]) / 2
+    return medians
+
+
+def fit_trends(group, t, y, n_groups, degree=1, iterations=TREND_ROBUST_ITERATIONS):
+    # Fits y = a + v*t (+ c*t^2) to every group at once. Rows must be sorted
+    # by group and t is in years. Each group's normal equations are built
+    # from per-group sums with bincount and all of them are inverted in one
+    # batched call, so the fit is one least-squares solve over the
+    # (dates x points) data whatever the pattern of missing dates.
+    p = degree + 1
+    counts = np.bincount(group, minlength=n_groups)
+    starts = np.cumsum(counts) - counts
+
+    # Centred on each group's mean epoch, so the velocity of a quadratic fit
+    # is the one at the middle of the window.
+    t = t - (np.bincount(group, weights=t, minlength=n_groups) / np.maximum(counts, 1))[group]
+    powers = np.vstack([t ** k for k in range(2 * p - 1)])
+
+    # Dates are unique per point, so p observations determine the fit; one
+    # more leaves a residual to estimate its errors from.
+    fitted = np.flatnonzero(counts > p)
+    weights = np.ones(len(y))
+    for iteration in range(iterations + 1):
+        normal = np.empty((len(fitted), p, p))
+        rhs = np.empty((len(fitted), p))
+        for k in range(2 * p - 1):
+            sums = np.bincount(group, weights=weights * powers[k], minlength=n_groups)[fitted]
+            for i in range(max(0, k - p + 1), min(k, p - 1) + 1):
+                normal[:, i, k - i] = sums
+        for i in range(p):
+            rhs[:, i] = np.bincount(group, weights=weights * powers[i] * y, minlength=n_groups)[fitted]
+
+        inverse = np.linalg.inv(normal)
+        coefficients = np.zeros((n_groups, p))
+        coefficients[fitted] = np.einsum('gij,gj->gi', inverse, rhs)
+        row_coefficients = coefficients[group]
+        residuals = y - np.einsum('ri,ir->r', row_coefficients, powers[:p])
+
+        if iteration == iterations:
+            break
+        # Huber weights against a robust scale (1.4826 * MAD) of each group.
+        scale = 1.4826 * group_medians(group, np.abs(residuals), starts, counts)
+        limit = TREND_HUBER_K * scale[group]
+        absolute = np.abs(residuals)
+        # A zero scale means most residuals are zero; leave such groups as they are.
+        weights = np.where((absolute > limit) & (limit > 0), limit / np.maximum(absolute, 1e-12), 1.0)
+
+    weight_sums = np.bincount(group, weights=weights, minlength=n_groups)
+    mean_y = np.bincount(group, weights=weights * y, minlength=n_groups) / np.maximum(weight_sums, 1e-12)
+    rss = np.bincount(group, weights=weights * residuals ** 2, minlength=n_groups)[fitted]
+    tss = np.bincount(group, weights=weights * (y - mean_y[group]) ** 2, minlength=n_groups)[fitted]
+    variance = rss / (counts[fitted] - p)
+
+    result = pd.DataFrame(np.nan, index=np.arange(n_groups), columns=TREND_COLUMNS)
+    result['observations'] = counts
+    result.loc[fitted, 'velocity'] = coefficients[fitted, 1]
+    result.loc[fitted, 'velocity_se'] = np.sqrt(variance * inverse[:, 1, 1])
+    if degree >= 2:
+        result.loc[fitted, 'acceleration'] = 2 * coefficients[fitted, 2]
+        result.loc[fitted, 'acceleration_se'] = 2 * np.sqrt(variance * inverse[:, 2, 2])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result.loc[fitted, 'r2'] = np.where(tss > 0, 1 - rss / tss, np.nan)
+    return result
+
+
+@lru_cache(maxsize=TREND_CACHE_SIZE)
+def track_trends(track, start=None, end=None, degree=1):
+    # Velocity [mm/year], acceleration [mm/year^2], their standard errors and
+    # R^2 of every point of `track` over start..end, indexed by pid.
+    index = track.all_data_index
+    group = np.repeat(np.arange(len(index), dtype=np.int64), index.stops - index.starts)
+    times = index.times
+    in_window = ~np.isnan(track.all_data['displacement'].to_numpy())
+    if start is not None:
+        in_window &= times >= np.datetime64(start)
+    if end is not None:
+        in_window &= times <= np.datetime64(end)
+
+    times = times[in_window]
+    t = (times - times.min()) / np.timedelta64(1, 'D') / 365 if len(times) else np.zeros(0)
+    y = track.all_data['displacement'].to_numpy(dtype=np.float64)[in_window]
+    result = fit_trends(group[in_window], t, y, len(index), degree=degree)
+    result.index = pd.Index(index.keys, name='pid')
+    return result
+
+
+def point_trends(store, points, start=None, end=None, degree=1):
+    # track_trends of every loaded track, in the row order of `points`.
+    frames = [track_trends(track, start, end, degree) for track in store.tracks.values()]
+    if not frames:
+        return pd.DataFrame(np.nan, index=points.index, columns=TREND_COLUMNS)
+    trends = pd.concat(frames).reindex(points['pid'].to_numpy())
+    trends.index = points.index
+    return trends
+
+
+datastore.on_swap(track_trends.cache_clear)
@@ -0,0 +1,18 @@
+# Production entry point: `gunicorn wsgi:server` (settings in gunicorn.conf.py).
+#
+# The gunicorn master checks the per-track dataset caches before forking.
+# A track is built once, by whichever worker first needs it, and every
+# worker then memory-maps the same read-only Feather files, so numeric
+# columns and string codes are shared through the page cache and adding a
+# worker adds concurrency without another copy of the tables or another CSV
+# parse. Workers poll each loaded track's CURRENT pointer and swap to
+# snapshots published by ingestion in any process.
+import datastore
+import ingest
+from app import app
+
+# The Flask application behind the Dash app; point any WSGI server at this.
+server = app.server
+
+datastore.start_refresher()
+ingest.start_watcher()